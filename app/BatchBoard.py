@@ -0,0 +1,178 @@
+"""Batched boards on NumPy, for bulk self-play, engine tuning and win-rate statistics.
+
+N games are kept as one stacked array and advanced in lockstep: a vector of columns is applied to every game at
+once, and wins are detected across the whole batch with vectorized window sums. Results follow Board.check_win.
+NumPy is only needed here, the bot itself does not import this module.
+
+Measure the self-play rate from the repository root with:
+    python -m app.BatchBoard --games 1000000 --batch 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.Board import Board, WIDTH, HEIGHT
+
+# Status of a game that has not ended yet. Other statuses are the same as Board.check_win: 1, -1 or 0 (Tie)
+ONGOING = 2
+
+
+class BatchBoard:
+    """ A batch of Connect 4 boards
+
+    Attributes:
+        grid - Array of shape (N, 6, 7). Row 0 is the topmost row, same as Board.grid. Each element is either
+               1 (RED TOKEN), -1 (YELLOW TOKEN) or 0 (EMPTY)
+        heights - Array of shape (N, 7), the number of tokens in each column
+        moves - Array of shape (N,), the number of tokens on each board
+    """
+    def __init__(self, size: int):
+        self.grid = np.zeros((size, HEIGHT, WIDTH), dtype=np.int8)
+        self.heights = np.zeros((size, WIDTH), dtype=np.int8)
+        self.moves = np.zeros(size, dtype=np.int16)
+
+
+    @classmethod
+    def from_boards(cls, boards):
+        """Builds a batch holding the positions of the given boards
+
+        :param boards: List of Board
+        :return: BatchBoard
+        """
+        batch = cls(len(boards))
+        batch.grid[:] = np.array([board.grid for board in boards], dtype=np.int8).reshape(-1, HEIGHT, WIDTH)
+        batch.heights[:] = (batch.grid != 0).sum(axis=1)
+        batch.moves[:] = batch.heights.sum(axis=1)
+        return batch
+
+
+    def __len__(self):
+        return len(self.moves)
+
+
+    def to_board(self, index: int):
+        """ Returns the position of one game of the batch as a Board """
+        board = Board()
+        for row in range(HEIGHT - 1, -1, -1):
+            for col in range(WIDTH):
+                if self.grid[index, row, col]:
+                    board.insert_token(int(self.grid[index, row, col]), col)
+        return board
+
+
+    def legal_moves(self):
+        """ Returns a boolean array of shape (N, 7), True where the column is not full """
+        return self.heights < HEIGHT
+
+
+    def insert_tokens(self, token: int, columns, active=None):
+        """Inserts a token into every board of the batch, each at its own column
+
+        :param token (int): Token colour. 1 is RED, -1 is YELLOW
+        :param columns: Integer array of shape (N,), the column to insert the token into for each board
+        :param active: Boolean array of shape (N,). Boards that are False are left untouched. All boards if None
+        :return: Boolean array of shape (N,), True where the insertion was successful
+        """
+        index = np.arange(len(self.moves))
+        ok = self.heights[index, columns] < HEIGHT
+        if active is not None:
+            ok &= active
+        index, columns = index[ok], columns[ok]
+        self.grid[index, HEIGHT - 1 - self.heights[index, columns], columns] = token
+        self.heights[index, columns] += 1
+        self.moves[index] += 1
+        return ok
+
+
+    def check_win(self):
+        """Checks every board for a line of 4 with vectorized window sums over the four directions
+
+        :return: Array of shape (N,) with ONGOING if the game continues, 0 if it is a Tie, 1 if RED TOKEN wins and
+                 -1 if YELLOW TOKEN wins
+        """
+        g = self.grid
+        windows = (
+            g[:, :, :-3] + g[:, :, 1:-2] + g[:, :, 2:-1] + g[:, :, 3:],                   # Horizontal
+            g[:, :-3] + g[:, 1:-2] + g[:, 2:-1] + g[:, 3:],                               # Vertical
+            g[:, :-3, :-3] + g[:, 1:-2, 1:-2] + g[:, 2:-1, 2:-1] + g[:, 3:, 3:],          # \ direction
+            g[:, :-3, 3:] + g[:, 1:-2, 2:-1] + g[:, 2:-1, 1:-2] + g[:, 3:, :-3],          # / direction
+        )
+        red = np.zeros(len(self.moves), dtype=bool)
+        yellow = np.zeros(len(self.moves), dtype=bool)
+        for sums in windows:
+            sums = sums.reshape(len(sums), -1)
+            red |= (sums == 4).any(axis=1)
+            yellow |= (sums == -4).any(axis=1)
+
+        status = np.full(len(self.moves), ONGOING, dtype=np.int8)
+        status[self.moves == WIDTH * HEIGHT] = 0
+        status[yellow] = -1
+        status[red] = 1
+        return status
+
+
+def random_playout(size: int, rng: np.random.Generator):
+    """Plays a batch of games with uniformly random legal moves until every game has ended
+
+    :param size (int): Number of games
+    :param rng: NumPy random generator
+    :return (Tuple): (BatchBoard with the final positions, Array of the results)
+    """
+    batch = BatchBoard(size)
+    status = np.full(size, ONGOING, dtype=np.int8)
+    token = 1
+    for _ in range(WIDTH * HEIGHT):
+        active = status == ONGOING
+        if not active.any():
+            break
+        # A random legal column per game: the column with the largest random weight among the columns not full
+        weights = rng.random((size, WIDTH))
+        weights[~batch.legal_moves()] = -1
+        batch.insert_tokens(token, weights.argmax(axis=1), active)
+        status = np.where(active, batch.check_win(), status)
+        token = -token
+    return batch, status
+
+
+def self_play(games: int, batch_size: int = 100000, seed: int = None):
+    """Plays random games in batches and gathers win-rate statistics
+
+    :param games (int): Total number of games
+    :param batch_size (int): Number of games played in lockstep
+    :param seed (int): Seed of the random generator
+    :return (Dict): Counts of 'red', 'yellow' and 'tie' results, and the mean game length in 'mean_moves'
+    """
+    rng = np.random.default_rng(seed)
+    counts = {'red': 0, 'yellow': 0, 'tie': 0}
+    total_moves = 0
+    played = 0
+    while played < games:
+        size = min(batch_size, games - played)
+        batch, status = random_playout(size, rng)
+        counts['red'] += int((status == 1).sum())
+        counts['yellow'] += int((status == -1).sum())
+        counts['tie'] += int((status == 0).sum())
+        total_moves += int(batch.moves.sum())
+        played += size
+    counts['mean_moves'] = total_moves / max(played, 1)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk random self-play on batched boards')
+    parser.add_argument('--games', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=100000, help='Number of games played in lockstep')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    stats = self_play(args.games, args.batch, args.seed)
+    elapsed = time.perf_counter() - start
+    print(f'{args.games} games in {elapsed:.1f}s ({args.games / elapsed * 60:,.0f} games/minute)')
+    print(f'RED wins: {stats["red"] / args.games:.2%}, YELLOW wins: {stats["yellow"] / args.games:.2%}, '
+          f'Ties: {stats["tie"] / args.games:.2%}, Mean length: {stats["mean_moves"]:.1f} moves')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,113 @@
+HEIGHT = 6
+WIDTH = 7
+
+# Layout of a bitboard. Every column takes 7 bits: the 6 playable cells from bottom (bit 0) to top (bit 5), followed
+# by a sentinel bit that is always empty, so that shifting never carries a line from one column into the next.
+#
+#   5 12 19 26 33 40 47
+#   4 11 18 25 32 39 46
+#   3 10 17 24 31 38 45
+#   2  9 16 23 30 37 44
+#   1  8 15 22 29 36 43
+#   0  7 14 21 28 35 42
+COLUMN_BITS = HEIGHT + 1
+
+# Bit index of the bottom cell, and one past the topmost cell, of every column
+COLUMN_BOTTOM = tuple(col * COLUMN_BITS for col in range(WIDTH))
+COLUMN_LIMIT = tuple(col * COLUMN_BITS + HEIGHT for col in range(WIDTH))
+
+# Maps every index of the 1D grid (row-major, topmost row first) to its bit index in the bitboard
+GRID_TO_BIT = tuple(col * COLUMN_BITS + (HEIGHT - 1 - row) for row in range(HEIGHT) for col in range(WIDTH))
+
+# Shift amounts for the four line directions: Vertical, Horizontal, \ direction and / direction
+DIRECTIONS = (1, COLUMN_BITS, COLUMN_BITS - 1, COLUMN_BITS + 1)
+
+BOARD_HEADER = '0️⃣ 1️⃣ 2️⃣ 3️⃣ 4️⃣ 5️⃣ 6️⃣\n\n'
+
+# Rendered rows, keyed by row contents: Bit i set means a RED token in column i, bit (i + 7) means a YELLOW token.
+# There are only 3^7 possible rows, so the cache is shared by every board and never needs eviction
+_ROW_CACHE = dict()
+
+
+def render_row(key):
+    """Returns the emoji string of a row, rendering it only the first time the row contents are seen
+
+    :param key (int): Row contents. Bit i set means a RED token in column i, bit (i + 7) means a YELLOW token
+    :return (str): The row, followed by a linebreak
+    """
+    row = _ROW_CACHE.get(key)
+    if row is None:
+        row = ''.join('🔴 ' if key >> col & 1 else '🟡 ' if key >> (col + WIDTH) & 1 else '⚪ '
+                      for col in range(WIDTH)) + '\n'
+        _ROW_CACHE[key] = row
+    return row
 
 
 class Board:
     """Represents a board for the game of "Connect 4"
 
+    Internally, the board is kept as two bitboards (One per token colour, see layout above) and the height of each
+    column, so inserting a token is O(1) and checking for win only needs a few shifts on the last mover's bitboard.
+
     Attributes:
-        grid (List) -   A 1D-grid of length (7*6 = 42) representing the board itself. Since the board in Connect 4
-                        consists of 6 rows and 7 columns. Indices [0-6] represents the topmost row, and so on.
-                        Each element should be either 1 (RED TOKEN), -1 (YELLOW TOKEN) or 0 (EMPTY)
+        boards (List) - Two integer bitboards. Index 0 holds the RED tokens, index 1 holds the YELLOW tokens
+        heights (List) - For each column, the bit index where the next token in that column will land
+        moves (int) - Number of tokens inserted so far
+        last_token (int) - Token colour of the last inserted token. 0 if the board is empty
+        row_keys (List) - Contents of each row (topmost row first) as the key of the shared row render cache
     """
 
 
     def __init__(self):
-        self.grid = [0] * 7 * 6
+        self.boards = [0, 0]
+        self.heights = list(COLUMN_BOTTOM)
+        self.moves = 0
+        self.last_token = 0
+        self.row_keys = [0] * HEIGHT
+        self._rendered = None   # Memoized __str__. Reset on every successful insert_token
+
+
+    @property
+    def grid(self):
+        """A 1D-grid of length (7*6 = 42) representing the board itself. Since the board in Connect 4 consists of
+        6 rows and 7 columns. Indices [0-6] represents the topmost row, and so on. Each element is either
+        1 (RED TOKEN), -1 (YELLOW TOKEN) or 0 (EMPTY). The grid is built from the bitboards on each access
+
+        :return (List): The 1D-grid of the board
+        """
+        red, yellow = self.boards
+        return [1 if red >> bit & 1 else -1 if yellow >> bit & 1 else 0 for bit in GRID_TO_BIT]
+
+
+    def copy(self):
+        """ Returns an independent copy of the board """
+        board = Board.__new__(Board)
+        board.boards = list(self.boards)
+        board.heights = list(self.heights)
+        board.moves = self.moves
+        board.last_token = self.last_token
+        board.row_keys = list(self.row_keys)
+        board._rendered = self._rendered
+        return board
+
+
+    def key(self):
+        """A unique key of the position that fits in 64 bits: The RED bitboard plus the bitboard of all tokens.
+        Within a column of h tokens, all tokens form the run of bits 2^h - 1 from the bottom, and the RED tokens are
+        some r < 2^h, so the column adds up to 2^h - 1 + r, between 2^h - 1 and 2^(h+1) - 2. The sum may carry into
+        the sentinel bit, as for a full column with a RED token at the bottom, but never past the 7 bits of the column.
+        Every height has its own disjoint range, so h and then r can be read back from the sum, and two different
+        column contents never share a key
+
+        :return (int): Key of the position
+        """
+        red, yellow = self.boards
+        return red + (red | yellow)
+
+
+    def is_column_full(self, column):
+        """ Returns True if no more tokens can be inserted into the column """
+        return self.heights[column] == COLUMN_LIMIT[column]
 
 
     def insert_token(self, token, column):
@@ -21,58 +117,48 @@ class Board:
         :param column (int): Column number to insert the token. Should be in range [0, 6]
         :return (bool): True if insertion successful. False otherwise
         """
-        for i in range(35+column, -1, -7):
-            if not self.grid[i]:
-                self.grid[i] = token
-                return True
-        return False
+        bit = self.heights[column]
+        if bit == COLUMN_LIMIT[column]:
+            return False
+        self.boards[(1 - token) >> 1] |= 1 << bit
+        self.heights[column] = bit + 1
+        self.moves += 1
+        self.last_token = token
+        self.row_keys[COLUMN_LIMIT[column] - 1 - bit] |= 1 << (column if token == 1 else column + WIDTH)
+        self._rendered = None
+        return True
 
 
     def check_win(self):
-        """Performs a brute force checking whether the game continues, or RED/YELLOW wins, or Tie
+        """Checks whether the game continues, or RED/YELLOW wins, or Tie. Only the last mover could have completed
+        a line, so only their bitboard is tested: For each direction, a line of 4 exists when a pair of adjacent
+        tokens is followed by another such pair two steps further.
 
         :return (None|int): Returns None if the game continues
                             Returns 0 if it is a Tie
                             Returns 1 if RED TOKEN wins
                             Returns -1 if YELLOW TOKEN wins
         """
-        # Tie checking
-        if all(self.grid):
+        if not self.moves:
+            return None
+        board = self.boards[(1 - self.last_token) >> 1]
+        for shift in DIRECTIONS:
+            pairs = board & (board >> shift)
+            if pairs & (pairs >> 2 * shift):
+                return self.last_token
+        # Tie checking. Only after win checking, since the move that fills the board may also complete a line
+        if self.moves == WIDTH * HEIGHT:
             return 0
-        # Check Horizontally
-        for row in range(0, 42, 7):
-            for offset in range(4):
-                if sum(self.grid[row+offset: row+offset+4]) in (4, -4):
-                    return sum(self.grid[row+offset: row+offset+4]) // 4
-        # Check vertically.
-        for col in range(7):
-            for idx in range(col, 15 + col, 7):
-                tot = sum(self.grid[idx+offset*7] for offset in range(4) )
-                if tot in (4, -4):
-                    return tot // 4
-        # Check \ and / direction
-        for row in range(0,15,7):
-            for col in range(4):
-                # \ direction
-                tot = sum(self.grid[row+col+offset] for offset in range(0,25,8))
-                if tot in (4, -4):
-                    return tot // 4
-                # / direction
-                tot = sum(self.grid[row+6-col+offset] for offset in range(0,19,6))
-                if tot in (4, -4):
-                    return tot // 4
         return None
 
 
     def __str__(self):
         """String representation of the board. First line is the column number followed by a linebreak.
-        The rest will be the board tokens. Note that emoji is used
+        The rest will be the board tokens. Note that emoji is used. The string is memoized until the next
+        insertion, and rows come from the shared row cache, so only a row whose contents were never seen is rendered
 
         :return (str): String representatin of the board
         """
-        res = '0️⃣ 1️⃣ 2️⃣ 3️⃣ 4️⃣ 5️⃣ 6️⃣\n\n'
-        for row in range(6):
-            for col in range(7):
-                res += '⚪ ' if not self.grid[row*7+col] else '🔴 ' if self.grid[row*7+col] == 1 else '🟡 '
-            res += '\n'
-        return res
+        if self._rendered is None:
+            self._rendered = BOARD_HEADER + ''.join([render_row(key) for key in self.row_keys])
+        return self._rendered
@@ -0,0 +1,108 @@
+""" Local message broker of the sharded deployment. Every shard process connects to it over a Unix socket, and it
+relays messages between them. See app.Shard for what the shards say to each other.
+
+The protocol is JSON lines. A connection starts with {"op": "hello", "shard": id}. After that, every line carries
+the id of its destination in "to", and is delivered to that shard with the id of the sender added in "from".
+Messages are delivered in the order they were sent by each sender. Messages to a shard that is not connected are
+dropped and reported.
+
+Run with `python -m app.Broker --socket /tmp/connect4.sock` before starting the shards.
+"""
+import argparse
+import asyncio
+import json
+import os
+
+DEFAULT_SOCKET = '/tmp/connect4-broker.sock'
+
+
+class Broker:
+    """ Relays JSON lines between the shards connected to a Unix socket
+
+    Attributes:
+        socket_path - Path of the Unix socket
+        shards - Dictionary of shard id -> StreamWriter of the shard's connection
+        relayed - Number of messages relayed
+        dropped - Number of messages dropped because their destination was not connected
+    """
+    def __init__(self, socket_path: str = DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self.shards = dict()
+        self.relayed = 0
+        self.dropped = 0
+        self._server = None
+        self._connections = set()
+
+
+    async def start(self):
+        """ Starts listening on the socket. A stale socket file from an earlier run is replaced """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.socket_path)
+
+
+    async def close(self):
+        """ Stops listening and disconnects every shard """
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for writer in list(self.shards.values()):
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        shard = None
+        self._connections.add(asyncio.current_task())
+        try:
+            hello = json.loads(await reader.readline())
+            shard = hello['shard']
+            self.shards[shard] = writer
+            print(f'Broker: shard {shard} connected')
+            async for line in reader:
+                message = json.loads(line)
+                message['from'] = shard
+                destination = self.shards.get(message.get('to'))
+                if destination is None:
+                    self.dropped += 1
+                    print(f"Broker: dropped {message.get('op')!r} from shard {shard} to {message.get('to')!r}")
+                    continue
+                destination.write(json.dumps(message).encode() + b'\n')
+                self.relayed += 1
+        except (ValueError, KeyError) as error:
+            print(f'Broker: bad message from shard {shard}: {error!r}')
+        except ConnectionError:
+            pass
+        finally:
+            if shard is not None and self.shards.get(shard) is writer:
+                del self.shards[shard]
+                print(f'Broker: shard {shard} disconnected')
+            writer.close()
+            self._connections.discard(asyncio.current_task())
+
+
+async def serve(socket_path: str):
+    broker = Broker(socket_path)
+    await broker.start()
+    print(f'Broker listening on {socket_path}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await broker.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Relays messages between the shards of the bot')
+    parser.add_argument('--socket', default=os.getenv('BROKER_SOCKET', DEFAULT_SOCKET),
+                        help='Path of the Unix socket')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import discord
+
+# Message components only exist from discord.py 2.0 onwards. Without them, games fall back to the emoji pad
+try:
+    from discord import ui
+except ImportError:
+    ui = None
+
+BUTTONS_SUPPORTED = ui is not None
+COLUMN_LABELS = ('0️⃣', '1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣')
+
+
+if BUTTONS_SUPPORTED:
+    class ColumnButton(ui.Button):
+        """ A button making a move in one column """
+        def __init__(self, column: int, disabled: bool):
+            super().__init__(style=discord.ButtonStyle.secondary, emoji=COLUMN_LABELS[column], disabled=disabled,
+                             row=column // 4)
+            self.column = column
+
+
+        async def callback(self, interaction):
+            await self.view.on_press(interaction, self.column)
+
+
+    class ColumnPad(ui.View):
+        """ A row of column buttons sent together with the board. Buttons of full columns are disabled, so invalid
+        moves cannot be made from the pad
+
+        Attributes:
+            on_press - Coroutine function (interaction, column) called when a button is pressed
+        """
+        def __init__(self, board, on_press):
+            super().__init__(timeout=None)
+            self.on_press = on_press
+            for column in range(len(COLUMN_LABELS)):
+                self.add_item(ColumnButton(column, board.is_column_full(column)))
@@ -0,0 +1,253 @@
+import asyncio
+from concurrent.futures import BrokenExecutor
+import time
+
+from app.Board import WIDTH, HEIGHT, COLUMN_BITS
+
+# Seconds the engine may think about a single move, and number of worker processes running the searches
+SEARCH_TIME_BUDGET = 1.5
+ENGINE_WORKERS = 2
+
+# Transposition table entries kept per worker process before the table is cleared
+TABLE_LIMIT = 1 << 20
+
+# Scores at or above WIN_SCORE mean a forced win, and the sooner the win the higher the score
+WIN_SCORE = 1000
+
+# Same bit layout as the bitboards of app.Board: 7 bits per column, bit 0 being the bottom cell
+BOTTOM_MASK = sum(1 << (col * COLUMN_BITS) for col in range(WIDTH))
+BOARD_MASK = BOTTOM_MASK * ((1 << HEIGHT) - 1)
+COLUMN_MASKS = tuple(((1 << HEIGHT) - 1) << (col * COLUMN_BITS) for col in range(WIDTH))
+
+# Columns sorted from the center outwards. Central cells take part in more lines, so they are searched first
+MOVE_ORDER = (3, 2, 4, 1, 5, 0, 6)
+
+# Move order when a column is known to be good (From the transposition table or a previous iteration): That column
+# first, then the others from the center outwards
+FIRST_ORDERS = {None: MOVE_ORDER}
+FIRST_ORDERS.update({first: (first,) + tuple(col for col in MOVE_ORDER if col != first) for first in MOVE_ORDER})
+
+# Cells of the center column, the two columns next to it, and the two after that. Used by the evaluation
+CENTER_MASKS = (COLUMN_MASKS[3], COLUMN_MASKS[2] | COLUMN_MASKS[4], COLUMN_MASKS[1] | COLUMN_MASKS[5])
+
+# Flags of transposition table entries
+EXACT, LOWER, UPPER = 0, 1, 2
+
+_table = dict()
+_pool = None
+
+
+class _Timeout(Exception):
+    """ Raised inside the search once the time budget is used up """
+
+
+class _Search:
+    """ State of one iterative deepening search
+
+    Attributes:
+        deadline - Value of time.monotonic() after which the search is abandoned
+        nodes - Number of positions visited
+    """
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.nodes = 0
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+def winning_cells(position, mask):
+    """Returns the empty cells that would complete a line of 4 for the stones in position
+
+    :param position (int): Bitboard of the stones of one player
+    :param mask (int): Bitboard of all the stones on the board
+    :return (int): Bitboard of the winning cells
+    """
+    # Vertical. A line can only be completed on top
+    cells = (position << 1) & (position << 2) & (position << 3)
+    # Horizontal, / and \ directions. The missing stone may be at any of the 4 places
+    for shift in (COLUMN_BITS, COLUMN_BITS + 1, COLUMN_BITS - 1):
+        pair = (position << shift) & (position << 2 * shift)
+        cells |= pair & (position << 3 * shift)
+        cells |= pair & (position >> shift)
+        pair = (position >> shift) & (position >> 2 * shift)
+        cells |= pair & (position << shift)
+        cells |= pair & (position >> 3 * shift)
+    return cells & (BOARD_MASK ^ mask)
+
+
+def _evaluate(position, opponent, own_wins, opp_wins):
+    """Heuristic score of a position for the player to move, used when the search runs out of depth.
+    Stays far below WIN_SCORE so that it never gets mistaken for a forced result"""
+    score = 4 * (_popcount(own_wins) - _popcount(opp_wins))
+    for weight, cells in zip((3, 2, 1), CENTER_MASKS):
+        score += weight * (_popcount(position & cells) - _popcount(opponent & cells))
+    return score
+
+
+def _negamax(position, mask, moves, depth, alpha, beta, search):
+    """Negamax with alpha-beta pruning and a transposition table
+
+    :param position (int): Bitboard of the stones of the player to move
+    :param mask (int): Bitboard of all the stones on the board
+    :param moves (int): Number of stones on the board
+    :param depth (int): Remaining depth. The position is evaluated heuristically once it reaches 0
+    :return (int): Score of the position for the player to move
+    """
+    search.nodes += 1
+    if not search.nodes & 1023 and time.monotonic() > search.deadline:
+        raise _Timeout
+
+    possible = (mask + BOTTOM_MASK) & BOARD_MASK
+    own_wins = winning_cells(position, mask)
+    if own_wins & possible:
+        return WIN_SCORE + WIDTH * HEIGHT - moves
+
+    # Moves that do not hand the opponent an immediate win, either by ignoring their threat or playing below it
+    opponent = position ^ mask
+    opp_wins = winning_cells(opponent, mask)
+    forced = possible & opp_wins
+    if forced:
+        if forced & (forced - 1):
+            return -(WIN_SCORE + WIDTH * HEIGHT - moves - 1)
+        possible = forced
+    candidates = possible & ~(opp_wins >> 1)
+    if not candidates:
+        return -(WIN_SCORE + WIDTH * HEIGHT - moves - 1)
+    if moves >= WIDTH * HEIGHT - 2:
+        return 0
+    if not depth:
+        return _evaluate(position, opponent, own_wins, opp_wins)
+
+    alpha_orig = alpha
+    key = position + mask
+    entry = _table.get(key)
+    first = None
+    if entry is not None:
+        entry_depth, flag, value, first = entry
+        if entry_depth >= depth:
+            if flag == EXACT:
+                return value
+            if flag == LOWER:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+
+    best, best_col = -WIN_SCORE * 2, None
+    for col in FIRST_ORDERS[first]:
+        move = candidates & COLUMN_MASKS[col]
+        if not move:
+            continue
+        score = -_negamax(opponent, mask | move, moves + 1, depth - 1, -beta, -alpha, search)
+        if score > best:
+            best, best_col = score, col
+        if score > alpha:
+            alpha = score
+        if alpha >= beta:
+            break
+
+    flag = UPPER if best <= alpha_orig else LOWER if best >= beta else EXACT
+    _table[key] = (depth, flag, best, best_col)
+    return best
+
+
+def _search_root(position, mask, moves, depth, first, search):
+    """Searches every move of the root position to the given depth
+
+    :param first (int|None): Column searched before the others. Normally the best move of the previous iteration
+    :return (Tuple): (Best column, its score)
+    """
+    possible = (mask + BOTTOM_MASK) & BOARD_MASK
+    alpha, beta = -WIN_SCORE * 2, WIN_SCORE * 2
+    best_col = None
+    for col in FIRST_ORDERS[first]:
+        move = possible & COLUMN_MASKS[col]
+        if not move:
+            continue
+        if winning_cells(position, mask) & move:
+            return col, WIN_SCORE + WIDTH * HEIGHT - moves
+        score = -_negamax(position ^ mask, mask | move, moves + 1, depth - 1, -beta, -alpha, search)
+        if best_col is None or score > alpha:
+            alpha, best_col = score, col
+    return best_col, alpha
+
+
+def analyse(red: int, yellow: int, token: int, time_budget: float = None, max_depth: int = None):
+    """Searches a position by iterative deepening, until the time budget is used up, the maximum depth is reached
+    or the result is decided. All arguments are plain integers taken from Board.boards, so this runs fine inside
+    a worker process
+
+    :param red (int): Bitboard of the RED tokens
+    :param yellow (int): Bitboard of the YELLOW tokens
+    :param token (int): Token colour of the player to move. 1 is RED, -1 is YELLOW
+    :param time_budget (float): Seconds the search may take. No limit if None
+    :param max_depth (int): Deepest iteration to search. No limit if None
+    :return (Tuple): (Best column, its score from the last completed iteration). (None, 0) if the board is full
+    """
+    if len(_table) > TABLE_LIMIT:
+        _table.clear()
+    position = red if token == 1 else yellow
+    mask = red | yellow
+    moves = _popcount(mask)
+    possible = (mask + BOTTOM_MASK) & BOARD_MASK
+    best = next((col for col in MOVE_ORDER if possible & COLUMN_MASKS[col]), None)
+    if best is None:
+        return None, 0
+
+    search = _Search(time.monotonic() + time_budget if time_budget is not None else float('inf'))
+    last_depth = WIDTH * HEIGHT - moves if max_depth is None else min(max_depth, WIDTH * HEIGHT - moves)
+    score = 0
+    for depth in range(1, last_depth + 1):
+        try:
+            best, score = _search_root(position, mask, moves, depth, best, search)
+        except _Timeout:
+            break
+        # The result is decided, searching deeper would not change it
+        if abs(score) >= WIN_SCORE:
+            break
+    return best, score
+
+
+def best_move(red: int, yellow: int, token: int, time_budget: float = SEARCH_TIME_BUDGET):
+    """Chooses a move by iterative deepening under a time budget
+
+    :param red (int): Bitboard of the RED tokens
+    :param yellow (int): Bitboard of the YELLOW tokens
+    :param token (int): Token colour of the engine. 1 is RED, -1 is YELLOW
+    :param time_budget (float): Seconds the search may take
+    :return (int): Column to play. None if the board is full
+    """
+    return analyse(red, yellow, token, time_budget)[0]
+
+
+def get_pool():
+    """ Returns the process pool running the searches, creating it on first use. multiprocessing is only imported
+    then, as it weighs on the startup of the bot """
+    global _pool
+    if _pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _pool = ProcessPoolExecutor(max_workers=ENGINE_WORKERS)
+    return _pool
+
+
+async def search(board, token: int, time_budget: float = SEARCH_TIME_BUDGET):
+    """Finds the engine's move in the process pool, so the event loop keeps serving other games meanwhile
+
+    :param board: Board of the game
+    :param token (int): Token colour of the engine. 1 is RED, -1 is YELLOW
+    :param time_budget (float): Seconds the search may take
+    :return (int): Column to play
+    """
+    global _pool
+    red, yellow = board.boards
+    pool = get_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, best_move, red, yellow, token, time_budget)
+    except BrokenExecutor:
+        # A worker process died, and the pool refuses any further search. The next search starts a new pool
+        if _pool is pool:
+            _pool = None
+        raise
@@ -0,0 +1,62 @@
+import discord
+
+from app.Player import Player
+import app.Engine as engine
+import app.OpeningBook as opening_book
+
+ENGINE_NAME = '🤖 Connect 4 Bot'
+
+
+class EngineUser:
+    """ Stands in for the Discord user of the computer opponent, providing the attributes that the game reads
+
+    Attributes:
+        id - Id of the user. 0 is never used by Discord
+        name - Display name of the computer opponent
+        mention - Same as name, as the computer opponent cannot be mentioned
+    """
+    __slots__ = ('id', 'name', 'mention')
+
+    def __init__(self):
+        self.id = 0
+        self.name = ENGINE_NAME
+        self.mention = ENGINE_NAME
+
+
+ENGINE_USER = EngineUser()
+
+
+class EnginePlayer(Player):
+    """ The computer opponent. A new instance is created for every game against the bot, since games are looked up
+    by Player in GameHub. It plays in the channel of its human opponent.
+
+    Attributes:
+        time_budget - Seconds the engine may think about each move
+    """
+    __slots__ = ('time_budget',)
+    is_engine = True
+
+    def __init__(self, channel: discord.abc.Messageable, time_budget: float = engine.SEARCH_TIME_BUDGET):
+        super().__init__(ENGINE_USER, channel)
+        self.time_budget = time_budget
+
+
+    @property
+    def user(self):
+        """ The computer opponent has no Discord user """
+        return ENGINE_USER
+
+
+    async def choose_move(self, board, token: int):
+        """ Looks up the move in the opening book, or searches for it in the engine's process pool when the position
+        is not in the book
+
+        :param board: Board of the game
+        :param token: Token colour of the engine. 1 is RED, -1 is YELLOW
+        :return: Column to play
+        """
+        if opening_book.book is not None:
+            entry = opening_book.book.probe(board)
+            if entry is not None:
+                return entry[0]
+        return await engine.search(board, token, self.time_budget)
@@ -1,8 +1,13 @@
-from app.GameInstance import GameInstance
+import asyncio
+
+from app.GameInstance import GameInstance, BUTTON_INPUT
 from app.Player import Player
+from app.EnginePlayer import EnginePlayer
+from app.Engine import MOVE_ORDER
 import app.Utilities as util
+import app.Tracing as tracing
 from app.MatchConfirmation import MatchConfirmation
-import asyncio
+from app.TimerWheel import TimerWheel
 
 
 GAMEHUB_TITLE = '♟️Game Hub ♟️'
@@ -12,6 +17,15 @@ REMATCH_CONFIRMED = '**{}**, Your request for rematch is confirmed! ✅'
 REMATCH_TIMEOUT = 'The rematch request between **{}** and **{}** had timed out after 30 seconds 🕑. See you later! 🙋‍♂️'
 QUIT_CONFIRMED = '**{}** had cancelled the rematch. See you soon! 🙋‍♂️'
 REMATCH_START = 'A rematch between **{}** and **{}** is starting! How exciting 💪'
+BOT_UNAVAILABLE = '🛑 **{}**, you are already in game or in the matchmaking queue! 🛑'
+BOT_GAME_START = '**{}** challenges **{}**! Let the game begin...⚔️'
+
+# Seconds both players have to accept a rematch, and seconds a player has to make each move before forfeiting
+REMATCH_SECONDS = 30
+TURN_SECONDS = 120
+# Games started per second by start_games. Each start sends the board to both players, and Discord allows a bot about
+# 50 requests per second
+GAMES_STARTED_PER_SECOND = 10
 
 
 class GameHub:
@@ -21,22 +35,30 @@ class GameHub:
     Attributes:
         gamehub - A Dictionary containing Player -> Game Instance
         rematches - A Dictionary containing Player -> MatchConfirmation (For Rematch)
-        event_loop - Event loop used for the async 30 second timeout
+        timers - Timer wheel running the 30 second rematch timeout and the move clock
+        turn_seconds - Seconds a player has to make each move before forfeiting the game. None for no move clock
+        result_hooks - Functions (game, status) called when a game ends. See GameInstance.announce_result
+        board_messages - A Dictionary containing message id -> Game Instance, of the live board messages. Reactions
+                         are routed through it, see GameInstance.message_index
     """
-    def __init__(self, event_loop):
+    def __init__(self, timers: TimerWheel, turn_seconds: float = TURN_SECONDS):
         self.gamehub = dict()
         self.rematches = dict()
-        self.event_loop = event_loop
+        self.timers = timers
+        self.turn_seconds = turn_seconds
+        self.result_hooks = []
+        self.board_messages = dict()
 
 
-    # Runs after 30 seconds to check if the rematch confirmation is still pending
-    async def rematch_callback(self, key):
-        await asyncio.sleep(30)
-        rematch_req = self.rematches.pop(key, None)
-        if rematch_req is None:
+    # Runs from the timer wheel after 30 seconds to check if the rematch confirmation is still pending. A newer offer
+    # between the same players is left alone
+    async def rematch_callback(self, rematch_req: MatchConfirmation):
+        if self.rematches.get(rematch_req.player1) is not rematch_req:
             return
 
-        self.rematches.pop(rematch_req.player2, None)
+        del self.rematches[rematch_req.player1]
+        if self.rematches.get(rematch_req.player2) is rematch_req:
+            del self.rematches[rematch_req.player2]
         rematch_req.player1.status = Player.IDLE
         rematch_req.player2.status = Player.IDLE
 
@@ -51,6 +73,7 @@ class GameHub:
         if rematch_req is None:
             return
         player1, player2 = rematch_req.player1, rematch_req.player2
+        self.timers.cancel(rematch_req.timer)
         self.rematches.pop(player1, None)
         self.rematches.pop(player2, None)
         player1.status = Player.IDLE
@@ -76,6 +99,7 @@ class GameHub:
         if rematch_req.isP1Ready and rematch_req.isP2Ready:
             player1, player2 = rematch_req.player1, rematch_req.player2
             # Remove from confirmation first
+            self.timers.cancel(rematch_req.timer)
             self.rematches.pop(player1, None)
             self.rematches.pop(player2, None)
 
@@ -88,45 +112,170 @@ class GameHub:
             await self.init_game(player2, player1)
 
 
-    # Starts a new game given 2 players
-    async def init_game(self, player1: Player, player2: Player):
-        game = GameInstance(player1, player2)
+    # Starts a new game given 2 players, and returns it. Button presses reach the shard of the channel, so players
+    # from other shards use the emoji pad. Without rematch, the players are free once the game ends
+    async def init_game(self, player1: Player, player2: Player, rematch: bool = True):
+        game = GameInstance(player1, player2, on_move=self.action, result_hooks=self.result_hooks,
+                            button_input=BUTTON_INPUT and not (player1.is_remote or player2.is_remote),
+                            rematch=rematch, message_index=self.board_messages)
         self.gamehub[player1] = game
         self.gamehub[player2] = game
 
         await game.action()
+        self.start_turn_clock(game)
+        await self.engine_turn(game)
+        return game
+
+
+    # Starts a batch of games, such as a round of a tournament, per_second games at a time so that hundreds of boards
+    # are not sent to Discord at once. The games started first are played while the rest wait their turn.
+    # Pairs refused by ready(player1, player2) when their turn comes are skipped, such as when a player left meanwhile.
+    # Returns the pairs whose game failed to start, with their players released
+    async def start_games(self, pairs, rematch: bool = True, per_second: int = GAMES_STARTED_PER_SECOND, ready=None):
+        failed = []
+        for i, (player1, player2) in enumerate(pairs):
+            if i and i % per_second == 0:
+                await asyncio.sleep(1.0)
+            if ready is not None and not ready(player1, player2):
+                continue
+            try:
+                await self.init_game(player1, player2, rematch)
+            except Exception as error:
+                print(f'Failed to start the game of {player1.user_id} and {player2.user_id}: {error!r}')
+                for player in (player1, player2):
+                    game = self.gamehub.pop(player, None)
+                    if game is not None:
+                        self.timers.cancel(game.turn_timer)
+                        game.turn_timer = None
+                    player.status = Player.IDLE
+                failed.append((player1, player2))
+        return failed
+
+
+    # Resumes a game from a snapshot. Its moves are replayed on a new board, and the move clock restarts with the time
+    # the player in turn had left. The old board messages are gone, so the caller has the board sent afresh, see
+    # GameInstance.schedule_render, and starts the computer opponent's turn, see engine_turn
+    def restore_game(self, player1: Player, player2: Player, columns, started: float, seconds_left: float = None):
+        game = GameInstance(player1, player2, on_move=self.action, result_hooks=self.result_hooks,
+                            button_input=BUTTON_INPUT and not (player1.is_remote or player2.is_remote),
+                            message_index=self.board_messages)
+        for column in columns:
+            game.board.insert_token(1 if game.turn == game.player1 else -1, column)
+            game.history.append(column)
+            game.change_side()
+        game.started = started
+        self.gamehub[player1] = game
+        self.gamehub[player2] = game
+        self.start_turn_clock(game, seconds_left)
+        return game
+
+
+    # Resumes a rematch offer from a snapshot, timing out after the seconds it had left, or the full REMATCH_SECONDS
+    # if its timeout was not set yet
+    def restore_rematch(self, player1: Player, player2: Player, is_p1_ready: bool, is_p2_ready: bool,
+                        seconds_left: float = None):
+        rematch_req = MatchConfirmation(player1, player2)
+        rematch_req.isP1Ready = is_p1_ready
+        rematch_req.isP2Ready = is_p2_ready
+        player1.status = Player.IN_GAME
+        player2.status = Player.IN_GAME
+        self.rematches[player1] = rematch_req
+        self.rematches[player2] = rematch_req
+        rematch_req.timer = self.timers.schedule(REMATCH_SECONDS if seconds_left is None else seconds_left,
+                                                 self.rematch_callback, rematch_req)
+
+
+    # Starts a game between the player and the computer opponent. The player moves first
+    async def play_bot(self, player: Player):
+        if player.status != Player.IDLE:
+            await player.channel.send(embed=util.create_embed(GAMEHUB_TITLE,
+                                                              BOT_UNAVAILABLE.format(player.user.name)))
+            return
+        engine_player = EnginePlayer(player.channel)
+        await player.channel.send(embed=util.create_embed(GAMEHUB_TITLE,
+                                                          BOT_GAME_START.format(player.user.name,
+                                                                                engine_player.user.name)))
+        await self.init_game(player, engine_player)
+
+
+    # If it is the computer opponent's turn, let it make its move. The search runs in the engine's process pool,
+    # so the event loop keeps serving other games while it thinks. The computer opponent has no move clock, so if the
+    # search fails it plays the first column that is not full, from the center outwards, rather than hold up the game
+    async def engine_turn(self, game: GameInstance):
+        if not game.turn.is_engine:
+            return
+        try:
+            column = await game.turn.choose_move(game.board, 1 if game.turn == game.player1 else -1)
+        except Exception as error:
+            print(f'The computer opponent failed to choose a move: {error!r}')
+            column = next(col for col in MOVE_ORDER if not game.board.is_column_full(col))
+        await self.action(game.turn, column)
+
+
+    # Restarts the move clock for the player in turn, with the full turn_seconds unless given the seconds left. If they
+    # do not move in time, they forfeit the game. The computer opponent always moves, so it has no clock
+    def start_turn_clock(self, game: GameInstance, seconds: float = None):
+        self.timers.cancel(game.turn_timer)
+        game.turn_timer = None
+        if self.turn_seconds is not None and not game.turn.is_engine:
+            game.turn_timer = self.timers.schedule(self.turn_seconds if seconds is None else seconds,
+                                                   self.turn_callback, game)
+
+
+    # Runs from the timer wheel once the player in turn ran out of time. They forfeit the game
+    async def turn_callback(self, game: GameInstance):
+        if self.gamehub.get(game.turn) is not game:
+            return
+        if await game.forfeit(game.turn):
+            await self.end_game(game)
 
 
     # Called when player makes a action. Put tokens into the board, check win etc...
+    @tracing.traced('GameHub.action')
     async def action(self, player: Player, column: int):
         if player not in self.gamehub or self.gamehub[player].turn != player:
             return
-        is_end = await self.gamehub[player].action(column)
-
-        # RAN ONLY IF GAME ENDED ================
-        # Game ended. Wait for rematch requests
+        game = self.gamehub[player]
+        tracing.tag_game(game)
+        moves = game.board.moves
+        is_end = await game.action(column)
         if is_end:
-            # Remove the game instance from the game hub dictionary
-            game = self.gamehub.pop(player, None)
-            player1, player2 = game.player1, game.player2
-            self.gamehub.pop(player1, None)
-            self.gamehub.pop(player2, None)
-
-            # Push into rematch dictionary.
-            rematch_req = MatchConfirmation(player1, player2)
-            self.rematches[player1] = rematch_req
-            self.rematches[player2] = rematch_req
-
-            # Prompts for rematch
-            rematch_prompt = util.create_embed(GAMEHUB_TITLE,
-                                               REMATCH_PROMPT.format(game.player1.user.name, game.player2.user.name))
-            await util.send_embed(game.player1.channel, game.player2.channel, rematch_prompt)
-
-            # After 30 seconds, the rematch request time out
-            self.event_loop.create_task( self.rematch_callback(game.player1) )
-
-
+            await self.end_game(game)
+        # The move was made (not invalid) and the game continues. Restart the clock for the other player
+        elif is_end is False and game.board.moves != moves:
+            self.start_turn_clock(game)
+            await self.engine_turn(game)
+
+
+    # Game ended. Remove it from the game hub and wait for rematch requests
+    async def end_game(self, game: GameInstance):
+        self.timers.cancel(game.turn_timer)
+        game.turn_timer = None
+
+        # Remove the game instance from the game hub dictionary
+        player1, player2 = game.player1, game.player2
+        self.gamehub.pop(player1, None)
+        self.gamehub.pop(player2, None)
+        if not game.rematch:
+            player1.status = Player.IDLE
+            player2.status = Player.IDLE
+            return
 
+        # Push into rematch dictionary.
+        rematch_req = MatchConfirmation(player1, player2)
+        self.rematches[player1] = rematch_req
+        self.rematches[player2] = rematch_req
 
+        # After 30 seconds, the rematch request time out. Armed before prompting, so that an answer given while the
+        # prompt is sent can cancel it
+        rematch_req.timer = self.timers.schedule(REMATCH_SECONDS, self.rematch_callback, rematch_req)
 
+        # Prompts for rematch
+        rematch_prompt = util.create_embed(GAMEHUB_TITLE,
+                                           REMATCH_PROMPT.format(player1.user.name, player2.user.name))
+        await util.send_embed(player1.channel, player2.channel, rematch_prompt)
 
+        # The computer opponent is always up for a rematch
+        for p in (player1, player2):
+            if p.is_engine:
+                await self.accept_rematch(p)
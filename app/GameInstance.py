@@ -1,122 +1,365 @@
+import asyncio
+import time
+
 from app.Board import Board
 from app.Player import Player
 import app.Utilities as util
+import app.Tracing as tracing
+import app.ColumnPad as column_pad
 
 GAME_TITLE = '🔴 \t**Connect 4**\t 🟡'
 BOARD_STATUS = 'Game: **{}** VS **{}**. Current turn: **{}**.\n\n{}'
 PROMPT_TURN = "**{}**, It's your turn now! Enter command `() [0-6]` (column no) or react to the emojis" \
               " 0️⃣1️⃣2️⃣3️⃣4️⃣5️⃣6️⃣ to make your move!"
+PROMPT_TURN_BUTTONS = "**{}**, It's your turn now! Enter command `() [0-6]` (column no) or press the column buttons" \
+                      " below to make your move!"
 WINNER_DETERMINED = 'The war ended with **{0}** being victorious over **{1}**! Congratulations **{0}**!'
 INVALID_MOVE = '❌ **{}**, the move was invalid. Select again! ❌'
 TIE = 'The war ended in a tie. Try again **{}** and **{}**! '
+FORFEIT = '⏰ **{1}** ran out of time! **{0}** wins by forfeit. Congratulations **{0}**!'
+REPLAY_HINT = '\n\nReplay this game with `() replay {}`'
+ENGINE_THINKING = '**{}** is thinking... 🤔'
+WATCH_STATUS = '**{}** 🔴 VS **{}** 🟡\n\n{}\n{}'
+WATCH_TURN = 'Current turn: **{}**'
+COLUMN_EMOJIS = ('0️⃣', '1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣')
+
+# Whether games keep one board message per channel and edit it on every move, instead of deleting the previous
+# messages and sending new ones. Editing costs 1 API call per channel per move, instead of about 10
+PERSISTENT_BOARD = True
+
+# Whether moves are made with a row of column buttons sent along with the board, instead of the emoji pad.
+# Buttons come in the same API call as the board, and full columns are disabled. Needs discord.py 2.0
+BUTTON_INPUT = column_pad.BUTTONS_SUPPORTED
 
 
 class GameInstance:
-    def __init__(self, player1: Player, player2: Player):
+    """ A game of Connect 4 between two players.
+
+    Attributes:
+        board - The board of the game
+        player1 - Player 1, RED, moves first
+        player2 - Player 2, YELLOW, moves second
+        turn - Player whose turn it is
+        persistent_board - Whether the board messages are edited in place. See PERSISTENT_BOARD
+        board_msgs - In persistent mode, the board message of each channel. Sent once and edited on every move
+        notice - In persistent mode, a note shown under the board until the next move, like an invalid move
+        prev_msg - Otherwise, the messages of the previous move, deleted before the next board is sent
+        on_move - Coroutine function (player, column) making a move. Called when a column button is pressed
+        button_input - Whether the board comes with column buttons instead of the emoji pad. See BUTTON_INPUT
+        status - Result of the game once it has ended (1, -1 or 0, see Board.check_win). None while it continues
+        forfeited - Player who forfeited the game by running out of time. None otherwise
+        turn_timer - Timer of the move clock of the player in turn. Managed by GameHub
+        result_hooks - Functions (game, status) called once the game has ended, such as to persist the stats
+        started - Unix time the game started
+        history - Columns of the moves made so far, in order
+        log_id - Id of the game in the move log, given by its result hook once the game has ended. None otherwise
+        rematch - Whether the players are offered a rematch once the game ends. See GameHub.end_game
+        message_index - A Dictionary containing message id -> GameInstance, shared by the games. The game registers
+                        its live board messages in it, and removes them once they are deleted or the game has ended
+        watchers - A Dictionary containing channel id -> Watcher, of the channels spectating the game. See
+                   app.Spectators
+
+    Moves go through a pipeline of two stages. The game state is updated synchronously by action(), so moves are
+    applied strictly in arrival order and no move can interleave with another. Sending the board to Discord happens
+    in a single render task per game, which always renders the latest state: Moves made while a render is in flight
+    are coalesced into the next render instead of being dropped or waiting for Discord. Spectators are updated by
+    their own tasks, so they never hold up the render of the players.
+    """
+    def __init__(self, player1: Player, player2: Player, persistent_board: bool = PERSISTENT_BOARD,
+                 on_move=None, button_input: bool = BUTTON_INPUT, result_hooks=(), rematch: bool = True,
+                 message_index: dict = None):
         player1.status = Player.IN_GAME
         player2.status = Player.IN_GAME
         self.board: Board = Board()
         self.player1 = player1  # Player1 will be RED, and moves first
         self.player2 = player2  # Player2 will be YELLOW, and moves second
         self.turn = player1
+        self.persistent_board = persistent_board
+        self.board_msgs = []
+        self.notice = None
         self.prev_msg = []
-        self.is_busy = False     # A flag to indicate whether the game is ready. Because sending emoji takes time,
-                                 # If a player reacts before emoji finish sending, the game will be messed up
+        self.on_move = on_move
+        self.button_input = button_input and on_move is not None
+        self.status = None
+        self.forfeited = None
+        self.turn_timer = None
+        self.result_hooks = result_hooks
+        self.started = time.time()
+        self.history = bytearray()
+        self.log_id = None
+        self.rematch = rematch
+        self.message_index = message_index if message_index is not None else dict()
+        self.watchers = dict()
+        self._watch_embed = None        # ((moves, status), embed) of the last state shown to the spectators
+        self._render_pending = False
+        self._render_task = None
+        self._announced = False
 
 
     async def clear_prev_msg(self):
-        """ Deletes all messages in self.prev_msg list """
-        while len(self.prev_msg):
-            msg = self.prev_msg.pop()
-            if msg is not None:
-                await msg.delete()
+        """ Deletes all messages in self.prev_msg list, concurrently """
+        msgs = [m for m in self.prev_msg if m is not None]
+        self.prev_msg.clear()
+        self.unindex(msgs)
+        results = await asyncio.gather(*(m.delete() for m in msgs), return_exceptions=True)
+        for msg, result in zip(msgs, results):
+            if isinstance(result, Exception):
+                util.report_failure(msg.channel, 'delete', result)
 
 
+    @tracing.traced('GameInstance.action')
     async def action(self, column: int = None):
         """ Main function called when a player makes a move. Procedure are:
-        Insert Token -> Check for game end -> Delete previous messages -> Print board -> Prompt move or announce result
+        Insert Token -> Check for game end -> Schedule render of the board -> (If ended) Wait for the board and the
+        result to be sent
+
+        The caller is responsible for only passing moves of the player in turn. Moves arriving after the game has
+        ended are rejected without any API call.
 
-        :returns True if the game is ended after current turn. Otherwise False
+        :returns True if the game is ended after current turn. False if it continues. None if the game had already
+                 ended before this move
         """
-        if self.is_busy:
-            return
+        if self.status is not None:
+            return None
 
-        status = None
         # The column is None when the game initializes and this function is called. Then, it only prints board
         # and prompt user for input. In other cases, we would want to insert a token into the board
         if column is not None:
             # Attempts to insert token. If failed, send error message and return
             if not self.board.insert_token(1 if self.turn == self.player1 else -1, column):
-                await self.turn.channel.send(embed=util.create_embed(GAME_TITLE,
-                                                                     INVALID_MOVE.format(self.turn.user.name)))
+                await self.invalid_move()
                 return False
-            status = self.board.check_win()
+            self.history.append(column)
+            self.status = self.board.check_win()
             self.change_side()
+            self.notice = None
 
-        self.is_busy = True
-        await self.clear_prev_msg()
-        await self.print_board(status)
+        self.schedule_render()
 
         # The game continues
-        if status is None:
-            await self.prompt_input()
-            self.is_busy = False
+        if self.status is None:
             return False
+        # The game ended. Make sure the final board and the result are out before the caller moves on
+        await self.flush()
+        return True
+
+
+    async def forfeit(self, player: Player):
+        """ Ends the game with the player losing, such as when their move clock runs out
+
+        :returns True once the game is ended, same as action(). None if the game had already ended
+        """
+        if self.status is not None:
+            return None
+        self.forfeited = player
+        self.status = -1 if player == self.player1 else 1
+        self.schedule_render()
+        await self.flush()
+        return True
+
+
+    def schedule_render(self):
+        """ Marks the board as changed, and starts the render task unless one is already running. A running task
+        picks the change up once its current render finishes. The spectators are notified the same way """
+        self._render_pending = True
+        if self._render_task is None or self._render_task.done():
+            self._render_task = asyncio.ensure_future(self._render_loop())
+        for watcher in self.watchers.values():
+            watcher.notify()
+
+
+    async def flush(self):
+        """ Waits until every scheduled render (and the result announcement) has been sent """
+        while self._render_task is not None and not self._render_task.done():
+            await self._render_task
+
+
+    async def _render_loop(self):
+        """ The render stage. Renders the latest state until no change is pending, then announces the result if the
+        game has ended """
+        while self._render_pending:
+            self._render_pending = False
+            status = self.status
+            try:
+                await self.render(status)
+                if status is not None and not self._announced:
+                    self._announced = True
+                    # The final board takes no more moves
+                    self.unindex(self.board_msgs)
+                    self.unindex(self.prev_msg)
+                    await self.announce_result(status)
+            except Exception as error:
+                print(f'Failed to render the game of {self.player1.user_id} and {self.player2.user_id}: {error!r}')
+
+
+    @tracing.traced('GameInstance.render')
+    async def render(self, status):
+        """ Sends the current board to both players: Edits the board messages in persistent mode. Otherwise deletes
+        the previous messages, sends the board and prompts for the next move
+
+        :param status: Status of the game. None if the game continues
+        """
+        if self.persistent_board:
+            await self.print_board(status)
         else:
-            await self.announce_result(status)
-            return True
+            await self.clear_prev_msg()
+            await self.print_board(status)
+            if status is None:
+                await self.prompt_input()
+
+
+    async def invalid_move(self):
+        """ Tells the player in turn that their move was invalid. In persistent mode, the notice is shown in the board
+        message of their channel instead of a new message """
+        notice = INVALID_MOVE.format(self.turn.user.name)
+        if not self.persistent_board:
+            await self.turn.channel.send(embed=util.create_embed(GAME_TITLE, notice))
+            return
+        # Already shown since the last invalid move
+        if self.notice == notice:
+            return
+        self.notice = notice
+        await util.edit_embed([m for m in self.board_msgs if m is not None and m.channel == self.turn.channel],
+                              self.board_embed(None))
 
 
     async def announce_result(self, status: int):
         """ Send messages to both players, announcing the winner (or ties) according to the argument status.
-        Also update the player's stats
+        Also update the player's stats, and run the result hooks before anything is sent
 
         :param status: The status of the game. Either 1, -1 or 0 representing P1 win, P2 win and tie
         """
+        for hook in self.result_hooks:
+            try:
+                hook(self, status)
+            except Exception as error:
+                print(f'Result hook {hook!r} failed: {error!r}')
+        hint = REPLAY_HINT.format(self.log_id) if self.log_id is not None else ''
+
+        embed = util.create_embed(GAME_TITLE, self.result_text(status) + hint)
+        await util.send_embed(self.player1.channel, self.player2.channel, embed)
         if status == 0:
-            embed = util.create_embed(GAME_TITLE,
-                                      TIE.format(self.player1.user.name, self.player2.user.name))
-            await util.send_embed(self.player1.channel, self.player2.channel, embed)
             self.player1.ties += 1
             self.player2.ties += 1
         elif status == 1:
-            embed = util.create_embed(GAME_TITLE,
-                                      WINNER_DETERMINED.format(self.player1.user.name, self.player2.user.name))
-            await util.send_embed(self.player1.channel, self.player2.channel, embed)
             self.player1.wins += 1
             self.player2.losses += 1
         elif status == -1:
-            embed = util.create_embed(GAME_TITLE,
-                                      WINNER_DETERMINED.format(self.player2.user.name, self.player1.user.name))
-            await util.send_embed(self.player1.channel, self.player2.channel, embed)
             self.player2.wins += 1
             self.player1.losses += 1
 
 
+    def result_text(self, status: int):
+        """ Returns the text announcing the winner (or tie) according to the argument status """
+        if status == 0:
+            return TIE.format(self.player1.user.name, self.player2.user.name)
+        winner, loser = (self.player1, self.player2) if status == 1 else (self.player2, self.player1)
+        return (WINNER_DETERMINED if self.forfeited is None else FORFEIT).format(winner.user.name, loser.user.name)
+
 
     def change_side(self):
         """ Changes the current turn of the game. P1 -> P2 and vice versa """
         self.turn = self.player1 if self.turn == self.player2 else self.player2
 
 
+    def board_embed(self, status):
+        """ Builds the embed showing the board. In persistent mode, the turn prompt and the notice are folded in
+
+        :param status: Status of the game. None if the game continues
+        :return: Embed instance
+        """
+        desc = BOARD_STATUS.format(self.player1.user.name, self.player2.user.name, self.turn.user.name, self.board)
+        if self.persistent_board and status is None:
+            desc += '\n' + self.prompt_text()
+            if self.notice is not None:
+                desc += '\n\n' + self.notice
+        return util.create_embed(GAME_TITLE, desc)
+
+
+    def watch_embed(self):
+        """ Builds the embed showing the board to the spectators, with the player in turn or the result. Built once
+        per state and shared by every spectator
+
+        :return: Embed instance
+        """
+        key = (self.board.moves, self.status)
+        if self._watch_embed is None or self._watch_embed[0] != key:
+            footer = WATCH_TURN.format(self.turn.user.name) if self.status is None else self.result_text(self.status)
+            desc = WATCH_STATUS.format(self.player1.user.name, self.player2.user.name, self.board, footer)
+            self._watch_embed = (key, util.create_embed(GAME_TITLE, desc))
+        return self._watch_embed[1]
+
+
     async def print_board(self, status):
-        """ Sends the board representation to both player's channel. Also appends the sent messages to the
-        self.prev_msg list
+        """ Sends the board representation to both player's channel. In persistent mode, the board messages are only
+        sent once, together with the emoji pad, and edited afterwards. Otherwise, the sent messages are appended to
+        the self.prev_msg list
 
         :param status: Status of the game. If 1, -1 or 0 (Game ended), no react (emoji) will be made by the bot
         """
-        embed = util.create_embed(GAME_TITLE,
-                                  BOARD_STATUS.format(self.player1.user.name, self.player2.user.name,
-                                                      self.turn.user.name,
-                                                      self.board))
-        msgs = await util.send_embed(self.player1.channel, self.player2.channel, embed,
-                                     ('0️⃣', '1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣') if status is None else None)
+        embed = self.board_embed(status)
+        make_view = self.view_factory(status)
+        if self.persistent_board and self.board_msgs:
+            await util.edit_embed(self.board_msgs, embed, make_view)
+            return
+        emojis = COLUMN_EMOJIS if status is None and not self.button_input else None
+        msgs = await util.send_embed(self.player1.channel, self.player2.channel, embed, emojis, make_view)
+        if self.persistent_board:
+            self.board_msgs = [m for m in msgs if m is not None]
+        else:
+            for m in msgs:
+                self.prev_msg.append(m)
+        if status is None:
+            for m in msgs:
+                if m is not None:
+                    self.message_index[m.id] = self
+
+
+    def unindex(self, msgs):
+        """ Removes the given messages from the message index """
         for m in msgs:
-            self.prev_msg.append(m)
+            if m is not None and self.message_index.get(m.id) is self:
+                del self.message_index[m.id]
+
+
+    def view_factory(self, status):
+        """ Returns the function creating the column buttons of a board message, or None in emoji pad mode.
+        Once the game has ended, the function returns None, which removes the buttons
+
+        :param status: Status of the game. None if the game continues
+        """
+        if not self.button_input:
+            return None
+        if status is not None:
+            return lambda: None
+        return lambda: column_pad.ColumnPad(self.board, self.on_press)
+
+
+    async def on_press(self, interaction, column: int):
+        """ Called when a column button is pressed. Acknowledges the interaction, then makes the move for whichever
+        player pressed it. Presses from anyone else are ignored
+
+        :param interaction: The Discord interaction of the button press
+        :param column: Column of the pressed button
+        """
+        await interaction.response.defer()
+        for player in (self.player1, self.player2):
+            if player.user_id == interaction.user.id:
+                await self.on_move(player, column)
+                return
+
+
+    def prompt_text(self):
+        """ Returns the text prompting the player in turn to make their move """
+        if self.turn.is_engine:
+            return ENGINE_THINKING.format(self.turn.user.name)
+        return (PROMPT_TURN_BUTTONS if self.button_input else PROMPT_TURN).format(self.turn.user.name)
 
 
     async def prompt_input(self):
-        """ Prompts whoever is in current turn to make their move. Sent message will be inserted into self.prev_msg """
-        embed = util.create_embed(GAME_TITLE,
-                                  PROMPT_TURN.format(self.turn.user.name))
+        """ Prompts whoever is in current turn to make their move. Sent message will be inserted into self.prev_msg
+        The computer opponent needs no prompt """
+        if self.turn.is_engine:
+            return
+        embed = util.create_embed(GAME_TITLE, self.prompt_text())
         self.prev_msg.append( await self.turn.channel.send(embed=embed) )
@@ -9,9 +9,11 @@ class MatchConfirmation:
         player2 - Player 2 of the match
         isP1Ready - Boolean value indicating whether player 1 is ready
         isP2Ready - Boolean value indicating whether player 2 is ready
+        timer - Timer of the confirmation timeout on the timer wheel. Cancelled once both players are ready
     """
     def __init__(self, player1: Player, player2: Player):
         self.player1 = player1
         self.player2 = player2
         self.isP1Ready = False
         self.isP2Ready = False
+        self.timer = None
@@ -1,15 +1,31 @@
 from collections import OrderedDict
 import asyncio
+import bisect
 
 import app.Utilities as util
+import app.Rating as rating
+import app.Tracing as tracing
 from app.Player import Player
 from app.MatchConfirmation import MatchConfirmation
+from app.TimerWheel import TimerWheel
+
+# Seconds both players have to confirm a match
+CONFIRMATION_SECONDS = 30
+
+# Largest rating difference a player accepts when joining, how many points it widens per second waited, and its cap.
+# Waiting players are matched again every MATCH_SWEEP_SECONDS with their widened window
+RATING_WINDOW = 100.0
+WINDOW_GROWTH = 10.0
+MAX_RATING_WINDOW = 1000.0
+MATCH_SWEEP_SECONDS = 5
 
 MATCHMAKING_TITLE = '⚔️ **Match Making** ⚔️'
 ALREADY_IN_QUEUE = '⏳ **{}**, you are already in queue! Currently waiting for an opponent... ⏳'
 ALREADY_IN_GAME = '🛑 **{}**, you are already in game! 🛑'
-MATCHMAKING_PROGRESS = '⏳ **{}**, Match Making in process... Please wait patiently for opponent to emerge... ⏳'
-MATCHED_MSG = "Opponent Matched! The war will begin shortly between **{}** and **{}**! Prepare to Fight! 🤺"
+MATCHMAKING_PROGRESS = '⏳ **{}**, Match Making in process... Please wait patiently for opponent to emerge... ⏳\n' \
+                       'Looking for opponents rated around **{:.0f}**'
+MATCHED_MSG = "Opponent Matched! The war will begin shortly between **{}** and **{}**! Prepare to Fight! 🤺\n" \
+              "Match quality: **{:.0%}**, found after **{:.0f}** seconds"
 PROMPT_CONFIRM = 'Both **{}** and **{}**, Please enter `() yes` command to confirm match! Expires in 30 seconds... ⏳'
 REMOVED_FROM_QUEUE = '**{}** successfully ran away from matchmaking queue 🏃💨'
 
@@ -21,59 +37,125 @@ FAILED_CONFIRM = 'We do not receive confirmation from both parties (**{}** vs **
 GAME_STARTING = '**{}** and **{}**, Both parties had confirmed! Let the game begin...⚔️'
 
 
+class QueueEntry:
+    """ A player waiting in the matchmaking queue
+
+    Attributes:
+        player - The waiting Player
+        key - Key of the player in MatchMaker.index. The rating at the time of joining, then the user id
+        joined - Event loop time at which the player joined the queue
+    """
+    __slots__ = ('player', 'key', 'joined')
+
+    def __init__(self, player: Player, joined: float):
+        self.player = player
+        self.key = (player.rating, player.user_id)
+        self.joined = joined
+
+
 class MatchMaker:
     """ A Match Making Manager. Handles match making so players could find their opponent. Also handles
     players confirmation once match is made, so that players don't get matched with AFK players
-    Internally, uses OrderedDict so to give random access in O(1) and still able to pop in FIFO order
+    Players are matched with the waiting player of the nearest rating, found by binary search on a sorted index.
+    The rating difference a waiting player accepts widens the longer they wait, so that nobody waits forever
 
     Attributes:
-        queue - The ordered dict for general matchmaking
+        queue - OrderedDict of user id -> QueueEntry, in the order the players joined
+        index - Sorted list of the keys of the queue entries, (rating, user id), for the nearest rating lookup
         confirmations - Dictionary for confirmations
-        event_loop - The event loop used for the callback function 30 seconds timeout for confirmations
+        timers - The timer wheel running the 30 seconds timeout for confirmations and the matching sweep
+        matches - Number of matches made
+        total_wait - Sum of the seconds the matched players waited in queue
+        total_quality - Sum of the quality of the matches made. See Rating.match_quality
     """
-    def __init__(self, event_loop):
+    def __init__(self, timers: TimerWheel):
         self.queue = OrderedDict()
+        self.index = []
         self.confirmations = dict()
-        self.event_loop = event_loop
+        self.timers = timers
+        self.matches = 0
+        self.total_wait = 0.0
+        self.total_quality = 0.0
+        self._sweep_timer = None
+
+
+    def window(self, entry: QueueEntry, now: float):
+        """ Returns the largest rating difference a waiting player accepts at event loop time now """
+        return min(MAX_RATING_WINDOW, RATING_WINDOW + WINDOW_GROWTH * (now - entry.joined))
+
+
+    def nearest(self, key):
+        """Returns the waiting player with the rating nearest to the key, other than the key's own player. O(log n)
+
+        :param key: Key (rating, user id) of the player looking for an opponent, whether queued or not
+        :return: The QueueEntry of the opponent, or None if nobody else is waiting
+        """
+        i = bisect.bisect_left(self.index, key)
+        best = None
+        # The key itself is at i if it is queued, so its neighbours are on either side of it
+        for j in (i - 1, i, i + 1):
+            if 0 <= j < len(self.index) and self.index[j][1] != key[1] and \
+                    (best is None or abs(self.index[j][0] - key[0]) < abs(best[0] - key[0])):
+                best = self.index[j]
+        return self.queue[best[1]] if best is not None else None
+
+
+    def _remove(self, entry: QueueEntry):
+        del self.queue[entry.player.user_id]
+        del self.index[bisect.bisect_left(self.index, entry.key)]
+
+
+    def stats(self):
+        """ Returns the matchmaking statistics: Players waiting, matches made, average seconds waited by a matched
+        player and average match quality """
+        return {
+            'waiting': len(self.queue),
+            'matches': self.matches,
+            'average_wait': self.total_wait / (2 * self.matches) if self.matches else 0.0,
+            'average_quality': self.total_quality / self.matches if self.matches else 0.0
+        }
 
 
     # A Player had send confirmation message. If both sides are confirmed, returns tuple size 2 of players, indicating
     # that a game could be started.
     async def confirmation_by_player(self, player: Player):
-        if player.user.id in self.confirmations:
-            confirmation_obj = self.confirmations[player.user.id]
+        if player.user_id in self.confirmations:
+            confirmation_obj = self.confirmations[player.user_id]
             confirmation_obj.isP1Ready = \
-                True if player.user.id == confirmation_obj.player1.user.id else confirmation_obj.isP1Ready
+                True if player.user_id == confirmation_obj.player1.user_id else confirmation_obj.isP1Ready
             confirmation_obj.isP2Ready = \
-                True if player.user.id == confirmation_obj.player2.user.id else confirmation_obj.isP2Ready
+                True if player.user_id == confirmation_obj.player2.user_id else confirmation_obj.isP2Ready
             await player.channel.send(embed=util.create_embed(MATCHMAKING_TITLE,
                                                               CONFIRMATION_RECEIVED.format(player.user.name)))
 
             if confirmation_obj.isP1Ready and confirmation_obj.isP2Ready:
                 player1, player2 = confirmation_obj.player1, confirmation_obj.player2
-                self.confirmations.pop(player1.user.id, None)
-                self.confirmations.pop(player2.user.id, None)
+                self.timers.cancel(confirmation_obj.timer)
+                self.confirmations.pop(player1.user_id, None)
+                self.confirmations.pop(player2.user_id, None)
                 embed = util.create_embed(MATCHMAKING_TITLE, GAME_STARTING.format(player1.user.name, player2.user.name))
 
                 await util.send_embed(player1.channel, player2.channel, embed)
                 return player1, player2
 
 
-    # Waits for 30 sec, then check whether both sides have confirmed or not.
-    # If players are absent in confirmation dict, that means the players are confirmed and already been popped out
-    # from the dict, so do nothing
+    # Runs from the timer wheel 30 sec after the match, then check whether both sides have confirmed or not.
+    # The timer is cancelled once both sides confirm, but if this confirmation is no longer in the confirmation dict
+    # anyway, that means the players are confirmed and already been popped out from the dict, or matched again since,
+    # so do nothing
     # Otherwise, send messages notifying that not all parties confirmed. Those who confirmed will be added back into
     # queue
-    async def confirmation_callback(self, player1: Player, player2: Player):
-        await asyncio.sleep(30)
-        if player1.user.id in self.confirmations:
-            isPlayerOneReady = self.confirmations.pop(player1.user.id, None).isP1Ready
-            isPlayerTwoReady = self.confirmations.pop(player2.user.id, None).isP2Ready
+    async def confirmation_callback(self, match_confirmation: MatchConfirmation):
+        player1, player2 = match_confirmation.player1, match_confirmation.player2
+        if self.confirmations.get(player1.user_id) is match_confirmation:
+            del self.confirmations[player1.user_id]
+            if self.confirmations.get(player2.user_id) is match_confirmation:
+                del self.confirmations[player2.user_id]
+            isPlayerOneReady = match_confirmation.isP1Ready
+            isPlayerTwoReady = match_confirmation.isP2Ready
             embed = util.create_embed(MATCHMAKING_TITLE, FAILED_CONFIRM.format(player1.user.name, player2.user.name))
 
-            await player1.channel.send(embed=embed)
-            if player1.channel != player2.channel:
-                await player2.channel.send(embed=embed)
+            await util.send_embed(player1.channel, player2.channel, embed)
 
             player1.status = Player.IDLE
             player2.status = Player.IDLE
@@ -86,13 +168,14 @@ class MatchMaker:
     # Removes a player from the waiting queue (Not From Confirmation Queue)
     async def remove_from_queue(self, player: Player):
         # Only remove if the player is indeed in the queue
-        if player.user.id in self.queue:
+        if player.user_id in self.queue:
             player.status = Player.IDLE
-            self.queue.pop(player.user.id)
+            self._remove(self.queue[player.user_id])
             await player.channel.send(embed=util.create_embed(MATCHMAKING_TITLE,
                                                               REMOVED_FROM_QUEUE.format(player.user.name)))
 
     # Requests for a player to join the queue
+    @tracing.traced('MatchMaker.request_to_join_queue')
     async def request_to_join_queue(self, player: Player):
         # Player is already in game or in queue
         if player.status == Player.IN_GAME:
@@ -101,28 +184,101 @@ class MatchMaker:
         elif player.status == Player.MATCH_MAKING:
             await player.channel.send(embed=util.create_embed(MATCHMAKING_TITLE,
                                                               ALREADY_IN_QUEUE.format(player.user.name)))
-        # Queue is empty. Push to queue
-        elif not len(self.queue):
-            self.queue[player.user.id] = player
-            player.status = Player.MATCH_MAKING
-            await player.channel.send(embed=util.create_embed(MATCHMAKING_TITLE,
-                                                              MATCHMAKING_PROGRESS.format(player.user.name)))
-        # Queue is not empty! Immediately match them together!
         else:
             player.status = Player.MATCH_MAKING
-            _, opponent = self.queue.popitem(last=False)
-            match_confirmation = MatchConfirmation(player, opponent)
-
-            self.confirmations[player.user.id] = match_confirmation
-            self.confirmations[opponent.user.id] = match_confirmation
-
-            # The two players are from the same channel
-            matched_embed = util.create_embed(MATCHMAKING_TITLE,
-                                              MATCHED_MSG.format(player.user.name, opponent.user.name) )
-            prompt_confirm_embed = util.create_embed(MATCHMAKING_TITLE,
-                                                     PROMPT_CONFIRM.format(player.user.name, opponent.user.name) )
-            await util.send_embed(player.channel, opponent.channel, matched_embed )
-            await util.send_embed(player.channel, opponent.channel, prompt_confirm_embed )
-
-            # Create 30 sec countdown if they don't confirm
-            self.event_loop.create_task(self.confirmation_callback(player, opponent))
+            now = asyncio.get_event_loop().time()
+            entry = QueueEntry(player, now)
+            opponent = self.nearest(entry.key)
+            # Someone close enough is waiting! Immediately match them together! The newcomer accepts RATING_WINDOW,
+            # and an opponent who has waited longer may accept more
+            if opponent is not None and \
+                    abs(opponent.key[0] - entry.key[0]) <= max(RATING_WINDOW, self.window(opponent, now)):
+                self._remove(opponent)
+                await self.start_confirmation(entry, opponent, now)
+            # Nobody close enough. Push to queue, the sweep matches the player once their window is wide enough
+            else:
+                self.queue[player.user_id] = entry
+                bisect.insort(self.index, entry.key)
+                self.schedule_sweep()
+                await player.channel.send(embed=util.create_embed(MATCHMAKING_TITLE,
+                                                                  MATCHMAKING_PROGRESS.format(player.user.name,
+                                                                                              player.rating)))
+
+
+    # Schedules the next matching sweep, unless one is already scheduled
+    def schedule_sweep(self):
+        if self._sweep_timer is None:
+            self._sweep_timer = self.timers.schedule(MATCH_SWEEP_SECONDS, self.sweep)
+
+
+    # Runs from the timer wheel every MATCH_SWEEP_SECONDS while players wait. Matches each waiting player, longest
+    # waiting first, with their nearest opponent if the widened window now reaches them
+    async def sweep(self):
+        self._sweep_timer = None
+        now = asyncio.get_event_loop().time()
+        pairs = []
+        for entry in list(self.queue.values()):
+            # Already matched earlier in this sweep
+            if entry.player.user_id not in self.queue:
+                continue
+            opponent = self.nearest(entry.key)
+            if opponent is not None and abs(opponent.key[0] - entry.key[0]) <= self.window(entry, now):
+                self._remove(entry)
+                self._remove(opponent)
+                pairs.append((entry, opponent))
+        if self.queue:
+            self.schedule_sweep()
+        await asyncio.gather(*(self.start_confirmation(entry, opponent, now) for entry, opponent in pairs))
+
+
+    # Puts a player back into the queue from a snapshot, keeping their place in line and the rating they joined with
+    def restore_entry(self, player: Player, player_rating: float, waited: float):
+        player.status = Player.MATCH_MAKING
+        entry = QueueEntry(player, asyncio.get_event_loop().time() - waited)
+        entry.key = (player_rating, player.user_id)
+        self.queue[player.user_id] = entry
+        bisect.insort(self.index, entry.key)
+        self.schedule_sweep()
+
+
+    # Resumes a match confirmation from a snapshot, timing out after the seconds it had left, or the full
+    # CONFIRMATION_SECONDS if its timeout was not set yet
+    def restore_confirmation(self, player1: Player, player2: Player, is_p1_ready: bool, is_p2_ready: bool,
+                             seconds_left: float = None):
+        match_confirmation = MatchConfirmation(player1, player2)
+        match_confirmation.isP1Ready = is_p1_ready
+        match_confirmation.isP2Ready = is_p2_ready
+        player1.status = Player.MATCH_MAKING
+        player2.status = Player.MATCH_MAKING
+        self.confirmations[player1.user_id] = match_confirmation
+        self.confirmations[player2.user_id] = match_confirmation
+        match_confirmation.timer = self.timers.schedule(CONFIRMATION_SECONDS if seconds_left is None else seconds_left,
+                                                        self.confirmation_callback, match_confirmation)
+
+
+    # Two players were matched. Report the match and ask both of them for confirmation
+    async def start_confirmation(self, entry: QueueEntry, opponent_entry: QueueEntry, now: float):
+        player, opponent = entry.player, opponent_entry.player
+        quality = rating.match_quality(entry.key[0], opponent_entry.key[0])
+        waited = now - min(entry.joined, opponent_entry.joined)
+        self.matches += 1
+        self.total_wait += (now - entry.joined) + (now - opponent_entry.joined)
+        self.total_quality += quality
+
+        match_confirmation = MatchConfirmation(player, opponent)
+
+        self.confirmations[player.user_id] = match_confirmation
+        self.confirmations[opponent.user_id] = match_confirmation
+
+        # Create 30 sec countdown if they don't confirm. Armed before sending, so that a confirmation answered while
+        # the messages are sent can cancel it
+        match_confirmation.timer = self.timers.schedule(CONFIRMATION_SECONDS, self.confirmation_callback,
+                                                        match_confirmation)
+
+        # The two players are from the same channel
+        matched_embed = util.create_embed(MATCHMAKING_TITLE,
+                                          MATCHED_MSG.format(player.user.name, opponent.user.name, quality, waited) )
+        prompt_confirm_embed = util.create_embed(MATCHMAKING_TITLE,
+                                                 PROMPT_CONFIRM.format(player.user.name, opponent.user.name) )
+        await util.send_embed(player.channel, opponent.channel, matched_embed )
+        await util.send_embed(player.channel, opponent.channel, prompt_confirm_embed )
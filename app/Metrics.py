@@ -0,0 +1,159 @@
+""" Health check and metrics endpoint, served on the bot's own event loop. It replaces the keep alive web server.
+
+    GET /         - 200 'OK', for uptime pingers
+    GET /health   - 200 when the bot is connected to Discord, 503 otherwise
+    GET /metrics  - The metrics in the Prometheus text format
+"""
+import asyncio
+import bisect
+
+DEFAULT_PORT = 8080
+
+# Upper bounds in seconds of the buckets of the command latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Longest request head read, and seconds a client has to send it
+MAX_REQUEST_BYTES = 8192
+REQUEST_TIMEOUT = 5.0
+
+
+class Histogram:
+    """ A Prometheus histogram. Counts are kept per bucket, and made cumulative when rendered
+
+    Attributes:
+        bounds - Upper bounds of the buckets, ascending. Values above the last bound go to the +Inf bucket
+        counts - Number of values observed per bucket, with the +Inf bucket last
+        total - Sum of the values observed
+        count - Number of values observed
+    """
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """ The metrics of the bot. Gauges and counters are read from the live objects when scraped, so keeping them
+    costs nothing between scrapes. Command latencies are observed as the commands run
+
+    Attributes:
+        gauges - List of (name, help, function returning the value)
+        counters - List of (name, help, function returning the value)
+        command_latency - Dictionary of command -> Histogram of the seconds it took to handle
+    """
+    def __init__(self):
+        self.gauges = []
+        self.counters = []
+        self.command_latency = dict()
+
+
+    def gauge(self, name: str, help_text: str, read):
+        self.gauges.append((name, help_text, read))
+
+
+    def counter(self, name: str, help_text: str, read):
+        self.counters.append((name, help_text, read))
+
+
+    def observe_command(self, command: str, seconds: float):
+        histogram = self.command_latency.get(command)
+        if histogram is None:
+            histogram = self.command_latency[command] = Histogram()
+        histogram.observe(seconds)
+
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text exposition format """
+        lines = []
+        for kind, metrics in (('gauge', self.gauges), ('counter', self.counters)):
+            for name, help_text, read in metrics:
+                try:
+                    value = read()
+                except Exception as error:
+                    print(f'Failed to read metric {name}: {error!r}')
+                    continue
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                lines.append(f'{name} {value}')
+
+        name = 'connect4_command_latency_seconds'
+        lines.append(f'# HELP {name} Seconds taken to handle a command')
+        lines.append(f'# TYPE {name} histogram')
+        for command, histogram in sorted(self.command_latency.items()):
+            label = command.replace('\\', '\\\\').replace('"', '\\"')
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{command="{label}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{command="{label}"}} {histogram.total}')
+            lines.append(f'{name}_count{{command="{label}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """ A minimal HTTP/1.0 server of the health check and the metrics, on the running event loop
+
+    Attributes:
+        metrics - The Metrics served
+        is_healthy - Function returning whether the bot is healthy
+        port - TCP port listened on
+    """
+    def __init__(self, metrics: Metrics, is_healthy, port: int = DEFAULT_PORT, host: str = '0.0.0.0'):
+        self.metrics = metrics
+        self.is_healthy = is_healthy
+        self.port = port
+        self.host = host
+        self._server = None
+
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, limit=MAX_REQUEST_BYTES)
+
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+            method, path = head.split(b' ', 2)[:2]
+            status, content_type, body = self.respond(method.decode('latin-1'), path.decode('latin-1'))
+            body = body.encode()
+            writer.write(f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    def respond(self, method: str, path: str):
+        """ Returns the (status, content type, body) of the response to a request """
+        if method != 'GET':
+            return '405 Method Not Allowed', 'text/plain', 'Method Not Allowed\n'
+        path = path.split('?', 1)[0]
+        if path == '/':
+            return '200 OK', 'text/plain', 'OK\n'
+        if path == '/health':
+            if self.is_healthy():
+                return '200 OK', 'text/plain', 'healthy\n'
+            return '503 Service Unavailable', 'text/plain', 'unhealthy\n'
+        if path == '/metrics':
+            return '200 OK', 'text/plain; version=0.0.4', self.metrics.render()
+        return '404 Not Found', 'text/plain', 'Not Found\n'
@@ -0,0 +1,362 @@
+""" Append-only log of every finished game, for replays, disputes and analysis.
+
+A game takes a fixed 24 byte record followed by its moves at 3 bits per column, so a full length game takes 40 bytes
+and a typical one about 32:
+
+    player1 id      u64     Discord user id. 0 for the computer opponent
+    player2 id      u64
+    started         u32     Unix time the game started
+    duration        u16     Seconds the game lasted, capped at 65535
+    result          u8      Status + 1 (0, 1 or 2 for P2 win, tie and P1 win), plus FORFEIT_FLAG
+    moves           u8      Number of moves
+    columns         ceil(3 * moves / 8) bytes, the first move in the lowest bits
+
+Records are appended to segments of SEGMENT_GAMES games each, named moves-000000.log, moves-000001.log, ... Each
+segment starts with MAGIC. A game's id is its sequence number in the log, so finding it only takes the segment and
+the record index within it. Segments are memory-mapped to read them, and the record offsets of a segment are found
+by hopping from one record length to the next.
+
+When sharded, every shard keeps its own log in shard<id> under the log directory, and the ids are interleaved:
+The game with sequence number n on shard s has id n * shard_count + s, so any shard can replay any game.
+"""
+from array import array
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import os
+import struct
+import time
+
+from app.Board import Board
+from app.TimerWheel import TimerWheel
+
+DEFAULT_DIRECTORY = 'moves'
+MAGIC = b'C4M1'
+RECORD = struct.Struct('<QQIHBB')
+FORFEIT_FLAG = 0x4
+MAX_DURATION = 0xFFFF
+
+SEGMENT_GAMES = 1 << 16
+# Seconds between writes of the buffered records. A crash loses at most this much of the log
+FLUSH_SECONDS = 5.0
+# Sealed segments whose record offsets are kept in memory
+CACHED_SEGMENTS = 8
+
+
+def pack_moves(columns):
+    """ Packs a sequence of columns (0 to 6) at 3 bits each, the first column in the lowest bits """
+    packed = 0
+    for i, column in enumerate(columns):
+        packed |= column << 3 * i
+    return packed.to_bytes((3 * len(columns) + 7) // 8, 'little')
+
+
+def unpack_moves(data, count: int):
+    """ Reverses pack_moves """
+    packed = int.from_bytes(data, 'little')
+    return [packed >> 3 * i & 7 for i in range(count)]
+
+
+def scan(data, start: int = len(MAGIC)):
+    """Finds the records of a segment
+
+    :param data: Contents of the segment, such as an mmap
+    :param start: Offset of the first record
+    :return: (array of the offsets of the complete records, offset past the last complete record)
+    """
+    offsets = array('I')
+    position, end, size = start, len(data), RECORD.size
+    while position + size <= end:
+        length = size + (3 * data[position + size - 1] + 7) // 8
+        if position + length > end:
+            break
+        offsets.append(position)
+        position += length
+    return offsets, position
+
+
+class GameRecord:
+    """ A game read back from the log
+
+    Attributes:
+        game_id - Id of the game in the log
+        player1 - User id of player 1, RED. 0 for the computer opponent
+        player2 - User id of player 2, YELLOW
+        started - Unix time the game started
+        duration - Seconds the game lasted
+        status - Result of the game. 1, -1 or 0 representing P1 win, P2 win and tie
+        forfeited - Whether the loser ran out of time
+        columns - Columns of the moves, in order
+    """
+    __slots__ = ('game_id', 'player1', 'player2', 'started', 'duration', 'status', 'forfeited', 'columns')
+
+    def __init__(self, game_id: int, data, offset: int):
+        self.game_id = game_id
+        self.player1, self.player2, self.started, self.duration, result, count = RECORD.unpack_from(data, offset)
+        self.status = (result & ~FORFEIT_FLAG) - 1
+        self.forfeited = bool(result & FORFEIT_FLAG)
+        start = offset + RECORD.size
+        self.columns = unpack_moves(data[start:start + (3 * count + 7) // 8], count)
+
+
+    def board(self, moves: int = None):
+        """ Rebuilds the board after the given number of moves, or after the last move """
+        board = Board()
+        token = 1
+        for column in self.columns[:moves]:
+            board.insert_token(token, column)
+            token = -token
+        return board
+
+
+class MoveLog:
+    """ The log of the games finished on this shard, and the reader of the logs of every shard
+
+    Records are buffered and appended every flush_seconds on a worker thread, so recording a game does no I/O, and
+    replays read the segments on a worker thread too. Writes go through a single thread, in the order the records were
+    made.
+
+    Attributes:
+        directory - Directory of the logs
+        shard_id - Id of this shard. 0 when not sharded
+        shard_count - Number of shards. 1 when not sharded
+        flush_seconds - Seconds between writes of the buffered records
+        segment - Number of the segment being appended to
+        offsets - Offsets of the records of that segment, including the buffered ones
+        buffer - Records of that segment not yet handed to the writer. A new segment starts with its MAGIC
+    """
+    def __init__(self, directory: str = DEFAULT_DIRECTORY, shard_id: int = 0, shard_count: int = 1,
+                 flush_seconds: float = FLUSH_SECONDS):
+        self.directory = directory
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.flush_seconds = flush_seconds
+        self.buffer = bytearray()
+        self._unwritten = []            # (path, bytes) handed to the writer and not written yet, in order
+        self._writing = None            # Future of the write in flight
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='move-log')
+        self._cache = OrderedDict()     # (shard id, segment) -> offsets, of sealed segments
+        self._timers = None
+        os.makedirs(self.shard_directory(shard_id), exist_ok=True)
+        self.segment, self.offsets, self._size = self._open_last_segment()
+
+
+    def shard_directory(self, shard_id: int):
+        if self.shard_count == 1:
+            return self.directory
+        return os.path.join(self.directory, f'shard{shard_id}')
+
+
+    def segment_path(self, shard_id: int, segment: int):
+        return os.path.join(self.shard_directory(shard_id), f'moves-{segment:06d}.log')
+
+
+    def _open_last_segment(self):
+        """ Finds where appending resumes. A record cut short by a crash is cut off """
+        names = sorted(n for n in os.listdir(self.shard_directory(self.shard_id))
+                       if n.startswith('moves-') and n.endswith('.log'))
+        segment = int(names[-1][6:-4]) if names else 0
+        path = self.segment_path(self.shard_id, segment)
+        if not os.path.exists(path) or os.path.getsize(path) < len(MAGIC):
+            with open(path, 'wb') as file:
+                file.write(MAGIC)
+            return segment, array('I'), len(MAGIC)
+        with open(path, 'r+b') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(MAGIC)] != MAGIC:
+                    raise ValueError(f'{path} is not a move log')
+                offsets, end = scan(data)
+            if end < os.path.getsize(path):
+                print(f'Move log: cutting off {os.path.getsize(path) - end} bytes of an incomplete record in {path}')
+                file.truncate(end)
+        return segment, offsets, end
+
+
+    # ==========================
+    # Writing
+    # ==========================
+    def start(self, timers: TimerWheel):
+        """ Starts writing the buffer every flush_seconds on the timer wheel """
+        self._timers = timers
+        timers.schedule(self.flush_seconds, self._flush_tick)
+
+
+    async def _flush_tick(self):
+        try:
+            await self.write()
+        finally:
+            self._timers.schedule(self.flush_seconds, self._flush_tick)
+
+
+    @property
+    def games(self):
+        """ Number of games in the log of this shard """
+        return self.segment * SEGMENT_GAMES + len(self.offsets)
+
+
+    def record(self, player1: int, player2: int, started: float, duration: float, status: int, forfeited: bool,
+               columns):
+        """Buffers the record of a finished game. No I/O
+
+        :return: Id of the game in the log
+        """
+        if len(self.offsets) == SEGMENT_GAMES:
+            self._seal()
+        sequence = self.games
+        self.offsets.append(self._size + len(self.buffer))
+        self.buffer += RECORD.pack(player1, player2, int(started), min(int(duration), MAX_DURATION),
+                                   status + 1 | (FORFEIT_FLAG if forfeited else 0), len(columns))
+        self.buffer += pack_moves(columns)
+        return sequence * self.shard_count + self.shard_id
+
+
+    def record_result(self, game, status: int):
+        """ Records a finished game, and gives it its id in the log. Meant to be a result hook of GameHub, see
+        GameInstance.announce_result """
+        game.log_id = self.record(game.player1.user_id, game.player2.user_id, game.started,
+                                  time.time() - game.started, status, game.forfeited is not None, game.history)
+
+
+    def _hand_over(self):
+        """ Moves the buffer to the records waiting for the writer """
+        if self.buffer:
+            self._unwritten.append((self.segment_path(self.shard_id, self.segment), self.buffer))
+            self._size += len(self.buffer)
+            self.buffer = bytearray()
+
+
+    async def write(self):
+        """ Appends the buffered records to their segments on the writer thread. Waits for a write in flight first,
+        so that records are written in order """
+        while self._writing is not None:
+            await asyncio.shield(self._writing)
+        self._hand_over()
+        if not self._unwritten:
+            return
+        chunks, self._unwritten = self._unwritten, []
+        self._writing = asyncio.get_running_loop().run_in_executor(self._executor, _append, chunks)
+        try:
+            written = await asyncio.shield(self._writing)
+        finally:
+            self._writing = None
+        self._requeue(chunks, written)
+
+
+    def flush(self):
+        """ Appends the buffered records to their segments, blocking. For shutting down, once the event loop has
+        stopped """
+        self._hand_over()
+        chunks, self._unwritten = self._unwritten, []
+        self._requeue(chunks, _append(chunks))
+
+
+    def _requeue(self, chunks, written: int):
+        """ Puts the chunks that failed to be written back in front of the records waiting for the writer """
+        if written < len(chunks):
+            self._unwritten[:0] = chunks[written:]
+
+
+    def _seal(self):
+        """ Closes the full segment and starts the next one. The new segment file is created by its first write """
+        self._hand_over()
+        self._cache_offsets((self.shard_id, self.segment), self.offsets)
+        self.segment += 1
+        self.offsets = array('I')
+        self._size = 0
+        self.buffer = bytearray(MAGIC)
+
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.flush()
+
+
+    # ==========================
+    # Reading
+    # ==========================
+    def _cache_offsets(self, key, offsets):
+        self._cache[key] = offsets
+        self._cache.move_to_end(key)
+        if len(self._cache) > CACHED_SEGMENTS:
+            self._cache.popitem(last=False)
+
+
+    async def read(self, game_id: int):
+        """Reads a game from the log of any shard, on a worker thread
+
+        :return: The GameRecord, or None if there is no such game
+        """
+        if game_id < 0:
+            return None
+        shard_id, sequence = game_id % self.shard_count, game_id // self.shard_count
+        segment, index = divmod(sequence, SEGMENT_GAMES)
+        own = shard_id == self.shard_id
+        if own and (segment > self.segment or segment == self.segment and index >= len(self.offsets)):
+            return None
+        # The record may still be buffered
+        if own and segment >= self.segment - 1:
+            await self.write()
+        if own and segment == self.segment:
+            offset = self.offsets[index]
+        else:
+            offsets = self._cache.get((shard_id, segment))
+            offset = offsets[index] if offsets is not None and index < len(offsets) else None
+        record, offsets = await asyncio.get_running_loop().run_in_executor(
+            None, _read_record, self.segment_path(shard_id, segment), game_id, index, offset)
+        # Segments of other shards may still be growing, so only full segments are kept
+        if offsets is not None and len(offsets) == SEGMENT_GAMES:
+            self._cache_offsets((shard_id, segment), offsets)
+        return record
+
+
+    def __iter__(self):
+        """ Iterates over the games of this shard's log, oldest first. Blocking, for offline analysis """
+        self.flush()
+        for segment in range(self.segment + 1):
+            with open(self.segment_path(self.shard_id, segment), 'rb') as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    first = segment * SEGMENT_GAMES
+                    for index, offset in enumerate(scan(data)[0]):
+                        yield GameRecord((first + index) * self.shard_count + self.shard_id, data, offset)
+
+
+def _append(chunks):
+    """Appends each (path, bytes) chunk to its file, in order. Runs on the writer thread
+
+    :return: Number of chunks written. The rest failed
+    """
+    for i, (path, data) in enumerate(chunks):
+        try:
+            with open(path, 'ab') as file:
+                file.write(data)
+        except OSError as error:
+            print(f'Failed to write {sum(len(d) for _, d in chunks[i:])} bytes of the move log: {error!r}')
+            return i
+    return len(chunks)
+
+
+def _read_record(path: str, game_id: int, index: int, offset):
+    """Reads a record from a segment. Runs on a worker thread
+
+    :param offset: Offset of the record if known. Otherwise the segment is scanned for it
+    :return: Tuple of (the GameRecord or None, the offsets found by scanning or None)
+    """
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return None, None
+    with file:
+        if os.fstat(file.fileno()).st_size <= len(MAGIC):
+            return None, None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets = None
+            if offset is None:
+                offsets = scan(data)[0]
+                if index >= len(offsets):
+                    return None, offsets
+                offset = offsets[index]
+            # Not written yet, such as after a failed write
+            elif offset + RECORD.size > len(data):
+                return None, None
+            return GameRecord(game_id, data, offset), offsets
@@ -0,0 +1,175 @@
+"""Precomputed opening book for the computer opponent.
+
+The book is a sorted binary file of fixed-size records, one per position up to a given ply, keyed by Board.key().
+The bot memory-maps the file and binary-searches it, so a lookup costs a few microseconds, nothing is parsed at
+startup, and every process mapping the same file shares its pages through the OS page cache.
+
+File layout (little endian):
+    Header - magic b'C4OB', version (u16), ply (u16), number of records (u32)
+    Record - key (u64), best column (u8), score for the player to move (i16)
+
+Generate a book from the repository root with:
+    python -m app.OpeningBook --ply 6 --depth 10 --output opening_book.bin
+"""
+import argparse
+import mmap
+import os
+import struct
+import time
+
+from app.Board import Board, WIDTH
+import app.Engine as engine
+
+MAGIC = b'C4OB'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')
+RECORD = struct.Struct('<QBh')
+KEY = struct.Struct('<Q')
+
+DEFAULT_PATH = 'opening_book.bin'
+
+# The book loaded by load(). None if there is no book
+book = None
+
+
+class OpeningBook:
+    """ A memory-mapped, read-only opening book
+
+    Attributes:
+        ply - Positions with up to this many tokens are in the book
+        size - Number of positions in the book
+    """
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.ply, self.size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f'{path} is not an opening book of version {VERSION}')
+        if len(self._map) != HEADER.size + self.size * RECORD.size:
+            self._map.close()
+            raise ValueError(f'{path} is truncated')
+
+
+    def lookup(self, key: int):
+        """Binary searches the book for a position
+
+        :param key (int): Key of the position, from Board.key()
+        :return (Tuple|None): (Best column, score for the player to move), or None if the position is not in the book
+        """
+        data, lo, hi = self._map, 0, self.size
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if KEY.unpack_from(data, HEADER.size + mid * RECORD.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size:
+            found, column, score = RECORD.unpack_from(data, HEADER.size + lo * RECORD.size)
+            if found == key:
+                return column, score
+        return None
+
+
+    def probe(self, board: Board):
+        """Looks up the position of a board. Cheap enough to try before every search
+
+        :param board: Board of the game, played alternately with RED first
+        :return (Tuple|None): (Best column, score for the player to move), or None if the position is not in the book
+        """
+        if board.moves > self.ply:
+            return None
+        return self.lookup(board.key())
+
+
+    def close(self):
+        self._map.close()
+
+
+def load(path: str = DEFAULT_PATH):
+    """Memory-maps the opening book at path as the book used by the computer opponent. Does nothing if the file
+    does not exist
+
+    :param path (str): Path of the book file
+    :return (OpeningBook|None): The loaded book
+    """
+    global book
+    if os.path.exists(path):
+        book = OpeningBook(path)
+    return book
+
+
+# ==========================
+# Offline generation
+# ==========================
+def positions(ply: int):
+    """Enumerates every distinct position with up to ply tokens that is still in play, RED moving first
+
+    :param ply (int): Maximum number of tokens on the board
+    :return (Dict): Key of the position -> (RED bitboard, YELLOW bitboard, token to move)
+    """
+    found = dict()
+    frontier = [Board()]
+    for moves in range(ply + 1):
+        token = 1 if moves % 2 == 0 else -1
+        next_frontier = []
+        for board in frontier:
+            key = board.key()
+            if key in found:
+                continue
+            found[key] = (*board.boards, token)
+            if moves == ply:
+                continue
+            for col in range(WIDTH):
+                child = board.copy()
+                if child.insert_token(token, col) and child.check_win() is None:
+                    next_frontier.append(child)
+        frontier = next_frontier
+    return found
+
+
+def _solve(args):
+    key, red, yellow, token, depth = args
+    column, score = engine.analyse(red, yellow, token, max_depth=depth)
+    return key, column, score
+
+
+def build(path: str, ply: int, depth: int, workers: int = None):
+    """Solves every position up to ply with the engine and writes the book to path
+
+    :param path (str): Output file
+    :param ply (int): Maximum number of tokens of the positions in the book
+    :param depth (int): Search depth used for every position
+    :param workers (int): Number of worker processes. Defaults to the number of CPUs
+    :return (int): Number of positions written
+    """
+    from multiprocessing import Pool
+
+    jobs = [(key, red, yellow, token, depth) for key, (red, yellow, token) in positions(ply).items()]
+    with Pool(workers) as pool:
+        records = sorted(pool.imap_unordered(_solve, jobs, chunksize=16))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, ply, len(records)))
+        for key, column, score in records:
+            f.write(RECORD.pack(key, column, score))
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generates the opening book of the computer opponent')
+    parser.add_argument('--ply', type=int, default=4, help='Solve every position with up to this many tokens')
+    parser.add_argument('--depth', type=int, default=10, help='Search depth used for every position')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes. Defaults to the CPU count')
+    parser.add_argument('--output', default=DEFAULT_PATH)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    count = build(args.output, args.ply, args.depth, args.workers)
+    print(f'Wrote {count} positions to {args.output} in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
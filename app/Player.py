@@ -1,40 +1,98 @@
+import time
 import discord
 import app.Utilities as util
+from app.Rating import INITIAL_RATING
 
 PROFILE_TXT = "Name: **{}**\n" \
               "Wins: **{}**\n" \
               "Losses: **{}**\n" \
               "Ties: **{}**\n" \
+              "Rating: **{:.0f}**\n" \
               "Status: **{}**\n"
 
 
+class UserRef:
+    """ Stands in for the Discord user of a player when the user is not in the client cache. Carries what the game
+    reads from a user
+
+    Attributes:
+        id - Id of the user
+        name - Name of the user, as last seen
+    """
+    __slots__ = ('id', 'name')
+
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+
 class Player:
-    """ A class representing a player.
+    """ A class representing a player. Only ids are kept, the Discord user and channel are resolved through the
+    client when needed, so that an idle player costs a few hundred bytes. See app.PlayerRegistry
 
     Class Constants:
         IDLE - One of the statuses. Player is not in game nor in matchmaking process
         MATCH_MAKING - One of the statuses. Player is in matchmaking process
         IN_GAME - One of the statuses. Player is currently in game with another player
+        is_engine - Whether the player is the computer opponent. See app.EnginePlayer
+        is_remote - Whether the player is from another shard. See app.Shard
+        client - The Discord client used to resolve users and channels. Set once at startup
 
     Attributes:
-        user - Discord User object of the player
-        channel - Discord channel where the last activity of the player was in
+        user_id - Id of the Discord user of the player
+        channel_id - Id of the Discord channel where the last activity of the player was in
+        name - Name of the player, as last seen
         wins - Number of times the player had won against another
         losses - Number of times the player had lost against another
         ties - Number of times the player ended in a tie with another
+        rating - Elo rating of the player. See app.Rating
         status - Status of the player.
+        last_seen - Value of time.monotonic() at the last activity of the player
     """
+    __slots__ = ('user_id', 'channel_id', 'name', 'wins', 'losses', 'ties', 'rating', 'status',
+                 'last_seen')
+
     IDLE = 'Idle'
     MATCH_MAKING = 'Match Making'
     IN_GAME = 'In Game'
+    is_engine = False
+    is_remote = False
+    client = None
 
     def __init__(self, user: discord.Member, channel: discord.abc.Messageable):
-        self.user = user
-        self.channel = channel
+        self.user_id = user.id
+        self.channel_id = channel.id
+        self.name = user.name
         self.wins = 0
         self.losses = 0
         self.ties = 0
+        self.rating = INITIAL_RATING
         self.status = Player.IDLE
+        self.last_seen = time.monotonic()
+
+
+    @property
+    def user(self):
+        """ Discord User object of the player, or a UserRef if the user is not cached """
+        user = Player.client.get_user(self.user_id) if Player.client is not None else None
+        return user if user is not None else UserRef(self.user_id, self.name)
+
+
+    @property
+    def channel(self):
+        """ Discord channel where the last activity of the player was in. None if it cannot be resolved """
+        if Player.client is None:
+            return None
+        channel = Player.client.get_channel(self.channel_id)
+        # discord.py 2.0 can send to a channel that is not cached, by its id alone
+        if channel is None and hasattr(Player.client, 'get_partial_messageable'):
+            channel = Player.client.get_partial_messageable(self.channel_id)
+        return channel
 
 
     def update_channel(self, channel: discord.abc.Messageable):
@@ -42,7 +100,7 @@ class Player:
 
         :param channel: The channel to be set
         """
-        self.channel = channel
+        self.channel_id = channel.id
 
 
     def profile_embed(self):
@@ -51,8 +109,9 @@ class Player:
 
         :return: Embed object with details of the Player
         """
-        return util.create_embed('💳\tProfile\t💳', PROFILE_TXT.format(self.user.name,
+        return util.create_embed('💳\tProfile\t💳', PROFILE_TXT.format(self.name,
                                                                        self.wins,
                                                                        self.losses,
                                                                        self.ties,
+                                                                       self.rating,
                                                                        self.status))
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import time
+
+import discord
+
+from app.Player import Player
+
+# Most players kept in memory, and seconds of inactivity after which an idle player is dropped. A Player only
+# keeps ids and counters, so the default budget stays in the order of 10 MB
+MAX_PLAYERS = 50000
+IDLE_TTL = 6 * 60 * 60
+# Least recently active players looked at per eviction for an idle one. When none of them is idle, the registry stays
+# over its budget until a later insertion finds one, instead of scanning every player on every insertion
+EVICTION_SCAN = 64
+
+
+class PlayerRegistry:
+    """ Registry of the players who used the bot, by Discord user id. Bounded by a budget of players: When full, the
+    least recently active idle player is evicted, and idle players are also dropped after IDLE_TTL seconds without
+    activity. Lookups are O(1), and insertions look at no more than EVICTION_SCAN players to evict. While too many
+    players are busy for that, the registry stays over its budget until idle ones come up.
+
+    Players who are not idle are never evicted, since the matchmaking queue, the confirmations, the games and the
+    rematches hold on to their Player object: A player is in MatchMaker.queue or MatchMaker.confirmations while
+    MATCH_MAKING, and in GameHub.gamehub or GameHub.rematches while IN_GAME.
+
+    Attributes:
+        players - OrderedDict of user id -> Player, from least to most recently active
+        max_players - Budget of players kept in memory
+        idle_ttl - Seconds of inactivity after which an idle player is dropped
+        eviction_scan - Players looked at per eviction for an idle one
+        evictions - Number of players evicted so far
+    """
+    def __init__(self, max_players: int = MAX_PLAYERS, idle_ttl: float = IDLE_TTL, eviction_scan: int = EVICTION_SCAN):
+        self.players = OrderedDict()
+        self.max_players = max_players
+        self.idle_ttl = idle_ttl
+        self.eviction_scan = eviction_scan
+        self.evictions = 0
+
+
+    def __len__(self):
+        return len(self.players)
+
+
+    def __contains__(self, user_id):
+        return user_id in self.players
+
+
+    def get(self, user: discord.Member, channel: discord.abc.Messageable):
+        """Returns the player of the user, registering them if new. Marks the player as active in the channel
+
+        :param user: Discord user who issued a command
+        :param channel: Channel where the command was issued
+        :return: The Player
+        """
+        player = self.players.get(user.id)
+        if player is None:
+            player = Player(user, channel)
+            self.players[user.id] = player
+            if len(self.players) > self.max_players:
+                self._evict()
+        else:
+            self.players.move_to_end(user.id)
+            player.update_channel(channel)
+            player.name = user.name
+        player.last_seen = time.monotonic()
+        return player
+
+
+    def add(self, player: Player):
+        """ Registers a player built elsewhere, such as restored from a snapshot """
+        self.players[player.user_id] = player
+        self.players.move_to_end(player.user_id)
+        if len(self.players) > self.max_players:
+            self._evict()
+
+
+    def lookup(self, user_id: int):
+        """Returns the player of a user id without registering anyone, such as for reactions
+
+        :param user_id: Discord user id
+        :return: The Player, or None if the user is not registered
+        """
+        player = self.players.get(user_id)
+        if player is not None:
+            self.players.move_to_end(user_id)
+            player.last_seen = time.monotonic()
+        return player
+
+
+    def _evict(self):
+        """ Evicts the least recently active idle players until the registry is back within its budget, looking at
+        no more than eviction_scan players. Players who are not idle are moved to the recent end as they are passed,
+        so that the next eviction looks further """
+        for _ in range(min(self.eviction_scan, len(self.players))):
+            if len(self.players) <= self.max_players:
+                return
+            user_id, player = next(iter(self.players.items()))
+            if player.status == Player.IDLE:
+                del self.players[user_id]
+                self.evictions += 1
+            else:
+                self.players.move_to_end(user_id)
+
+
+    def evict_idle(self):
+        """Drops the idle players that have been inactive for longer than idle_ttl. Meant to run periodically
+
+        :return (int): Number of players dropped
+        """
+        deadline = time.monotonic() - self.idle_ttl
+        dropped = 0
+        for _ in range(len(self.players)):
+            user_id, player = next(iter(self.players.items()))
+            if player.last_seen > deadline:
+                break
+            if player.status == Player.IDLE:
+                del self.players[user_id]
+                dropped += 1
+            else:
+                # Still in queue or game. Counts as active until idle again
+                player.last_seen = time.monotonic()
+                self.players.move_to_end(user_id)
+        self.evictions += dropped
+        return dropped
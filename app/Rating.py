@@ -0,0 +1,31 @@
+""" Elo ratings of the players. A rating only changes through games between two human players """
+
+INITIAL_RATING = 1500.0
+
+# Most points a rating moves after one game
+K_FACTOR = 32.0
+
+
+def expected(rating: float, opponent: float):
+    """Returns the expected score of a player against an opponent, between 0 (sure loss) and 1 (sure win)
+
+    :param rating: Rating of the player
+    :param opponent: Rating of the opponent
+    """
+    return 1.0 / (1.0 + 10.0 ** ((opponent - rating) / 400.0))
+
+
+def rating_change(rating: float, opponent: float, score: float):
+    """Returns how many points the player gains from a game. The opponent loses the same amount
+
+    :param rating: Rating of the player
+    :param opponent: Rating of the opponent
+    :param score: Score of the player in the game. 1 for a win, 0.5 for a tie and 0 for a loss
+    """
+    return K_FACTOR * (score - expected(rating, opponent))
+
+
+def match_quality(rating: float, opponent: float):
+    """ Returns the quality of a match between 0 and 1. 1 is an even match, and it falls towards 0 as one side becomes
+    a sure winner """
+    return 1.0 - abs(2.0 * expected(rating, opponent) - 1.0)
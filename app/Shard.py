@@ -0,0 +1,268 @@
+""" Sharded deployment. Several shard processes each run the bot for a slice of the guilds (Discord sends the events
+of a guild to one shard), and talk through the local broker of app.Broker.
+
+State stays local to one shard at a time:
+    - The lobby shard runs the matchmaking queue and the confirmations for every shard. Other shards forward the
+      `() play`, `() leave` and `() yes` of their idle players to it.
+    - Each game, with its rematch, is hosted by the shard of its first player, where its GameHub state lives. The
+      lobby hands the confirmed players over to the host.
+    - A shard holding a player from another shard keeps a RemotePlayer for them, and claims a route to itself on the
+      player's own shard while the player is not idle. That shard forwards every command of the player along the
+      route, including the moves made with reactions.
+
+Messages are sent to the channels of remote players directly, since any shard can reach any channel through the
+Discord REST API. This needs discord.py 2.0 for channels that are not in the client cache, see Player.channel.
+Column buttons are only used in games without remote players, since button presses reach the shard of the channel.
+"""
+import asyncio
+import json
+
+import discord
+
+from app.Player import Player, UserRef
+from app.PlayerRegistry import PlayerRegistry
+
+LOBBY_SHARD = 0
+
+# Commands handled by the lobby, unless the player is already engaged on some shard
+LOBBY_COMMANDS = frozenset(('() play', '() leave', '() yes'))
+# Commands always handled by the player's own shard
+LOCAL_COMMANDS = frozenset(('() help', '() profile', '() trace', '() trace on', '() trace off', '() replay',
+                            '() watch', '() unwatch', '() tournament open', '() tournament start',
+                            '() tournament cancel', '() tournament join', '() tournament leave',
+                            '() tournament standings'))
+
+# The slot holding the status of a Player, shadowed by the status property of RemotePlayer
+_STATUS = Player.status
+
+
+class RemotePlayer(Player):
+    """ A player from another shard, held by the lobby while they match make or by the host of their game. Changes of
+    their status claim or release the route to this shard on the player's own shard
+
+    Class Constants:
+        link - The ShardLink of this shard. Set once at startup
+
+    Attributes:
+        shard - Id of the shard of the player's channel
+    """
+    __slots__ = ('shard',)
+    is_remote = True
+    link = None
+
+    def __init__(self, user_id: int, name: str, shard: int, channel_id: int):
+        self.shard = shard
+        super().__init__(UserRef(user_id, name), discord.Object(id=channel_id))
+
+
+    @property
+    def status(self):
+        return _STATUS.__get__(self)
+
+
+    @status.setter
+    def status(self, value):
+        was_engaged = hasattr(self, 'status') and self.status != Player.IDLE
+        _STATUS.__set__(self, value)
+        engaged = value != Player.IDLE
+        if engaged != was_engaged and RemotePlayer.link is not None:
+            RemotePlayer.link.set_route(self, engaged)
+
+
+class ShardLink:
+    """ Connection of a shard to the broker, with the routing of players between the shards
+
+    Attributes:
+        shard_id - Id of this shard
+        socket_path - Path of the Unix socket of the broker
+        players - The PlayerRegistry of this shard. None for a process without players, such as the stub gateway
+        lobby - Id of the shard running the matchmaking
+        routes - Dictionary of user id -> id of the shard their commands are forwarded to, for local players
+        remote_players - Dictionary of user id -> RemotePlayer held by this shard
+        handlers - Dictionary of op -> function(message) handling the messages received. May return a coroutine
+        forwarded - Number of commands forwarded to other shards
+    """
+    def __init__(self, shard_id, socket_path: str, players: PlayerRegistry = None, lobby: int = LOBBY_SHARD):
+        self.shard_id = shard_id
+        self.socket_path = socket_path
+        self.players = players
+        self.lobby = lobby
+        self.routes = dict()
+        self.remote_players = dict()
+        self.handlers = {'route': self.on_route}
+        self.forwarded = 0
+        self._writer = None
+        self._reader_task = None
+
+
+    @property
+    def is_lobby(self):
+        return self.shard_id == self.lobby
+
+
+    async def connect(self, attempts: int = 50, delay: float = 0.1):
+        """ Connects to the broker, retrying while it starts up, and starts handling the messages received """
+        for attempt in range(attempts):
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+                break
+            except (FileNotFoundError, ConnectionError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(delay)
+        self._writer.write(json.dumps({'op': 'hello', 'shard': self.shard_id}).encode() + b'\n')
+        self._reader_task = asyncio.ensure_future(self._read(reader))
+
+
+    async def close(self):
+        """ Disconnects from the broker """
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+    def send(self, to, op: str, **fields):
+        """ Sends a message to another shard through the broker. Does not wait """
+        self._writer.write(json.dumps({'op': op, 'to': to, **fields}).encode() + b'\n')
+
+
+    async def _read(self, reader: asyncio.StreamReader):
+        async for line in reader:
+            message = json.loads(line)
+            handler = self.handlers.get(message['op'])
+            if handler is None:
+                print(f"Shard {self.shard_id}: no handler for {message['op']!r}")
+                continue
+            try:
+                result = handler(message)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(_report_errors(result, message['op']))
+            except Exception as error:
+                print(f"Shard {self.shard_id}: handling {message['op']!r} failed: {error!r}")
+        print(f'Shard {self.shard_id}: disconnected from the broker')
+
+
+    # ==========================
+    # Routing
+    # ==========================
+    def target(self, player: Player, command: str):
+        """Returns the shard that handles a command of a local player
+
+        :param player: Player who issued the command on this shard
+        :param command: The command
+        :return: Id of the shard to forward the command to, or None to handle it on this shard
+        """
+        if command in LOCAL_COMMANDS:
+            return None
+        shard = self.routes.get(player.user_id)
+        if shard is not None:
+            return shard
+        if command in LOBBY_COMMANDS and not self.is_lobby and player.status == Player.IDLE:
+            return self.lobby
+        return None
+
+
+    def forward(self, shard, player: Player, command: str, message_id: int = None):
+        """Forwards a command of a local player to the shard handling it
+
+        :param message_id: For a move made with a reaction, the id of the message reacted to. The host of the game
+                           drops the move unless it is the live board of the player's game
+        """
+        self.forwarded += 1
+        self.send(shard, 'command', user=player.user_id, name=player.name, channel=player.channel_id,
+                  rating=player.rating, command=command, message=message_id)
+
+
+    def remote_player(self, message):
+        """Returns the RemotePlayer who sent a forwarded command, creating it if this shard does not hold them yet
+
+        :param message: The 'command' message
+        :return: The RemotePlayer, with its name and channel updated
+        """
+        player = self.remote_players.get(message['user'])
+        if player is None:
+            player = RemotePlayer(message['user'], message['name'], message['from'], message['channel'])
+            player.rating = message['rating']
+            self.remote_players[player.user_id] = player
+        else:
+            player.name = message['name']
+            player.shard = message['from']
+            player.channel_id = message['channel']
+        return player
+
+
+    def release_if_idle(self, player: Player):
+        """ Forgets a RemotePlayer that is idle after their command, such as after being refused from the queue """
+        if player.is_remote and player.status == Player.IDLE:
+            self.remote_players.pop(player.user_id, None)
+
+
+    def set_route(self, player: RemotePlayer, engaged: bool):
+        """ Claims the route of a remote player to this shard on their own shard, or releases it once idle """
+        if not engaged:
+            self.remote_players.pop(player.user_id, None)
+        self.send(player.shard, 'route', user=player.user_id, claimed=engaged)
+
+
+    def on_route(self, message):
+        if message['claimed']:
+            self.routes[message['user']] = message['from']
+        # A release only undoes the claim of the same shard. Another shard may have claimed the player since
+        elif self.routes.get(message['user']) == message['from']:
+            del self.routes[message['user']]
+
+
+    # ==========================
+    # Handing games over
+    # ==========================
+    def host_of(self, player1: Player, player2: Player):
+        """ Returns the id of the shard hosting a game. Games are hosted by the shard of their first player """
+        return player1.shard if player1.is_remote else self.shard_id
+
+
+    def hand_off(self, player1: Player, player2: Player, host):
+        """ Hands two confirmed players over to the host of their game. This shard lets go of them without releasing
+        their routes, since the host claims them """
+        players = []
+        for player in (player1, player2):
+            players.append({'user': player.user_id, 'name': player.name, 'channel': player.channel_id,
+                            'rating': player.rating,
+                            'shard': player.shard if player.is_remote else self.shard_id})
+            if player.is_remote:
+                _STATUS.__set__(player, Player.IDLE)
+                self.remote_players.pop(player.user_id, None)
+            else:
+                player.status = Player.IDLE
+        self.send(host, 'start_game', players=players)
+
+
+    def take_over(self, message):
+        """Returns the two players of a game handed over to this shard, as local players or RemotePlayer
+
+        :param message: The 'start_game' message
+        :return: Tuple of the two players
+        """
+        players = []
+        for entry in message['players']:
+            if entry['shard'] == self.shard_id:
+                self.routes.pop(entry['user'], None)
+                player = self.players.get(UserRef(entry['user'], entry['name']), discord.Object(id=entry['channel']))
+            else:
+                player = self.remote_players.get(entry['user'])
+                if player is None:
+                    player = RemotePlayer(entry['user'], entry['name'], entry['shard'], entry['channel'])
+                    self.remote_players[player.user_id] = player
+            player.rating = entry['rating']
+            players.append(player)
+        return tuple(players)
+
+
+async def _report_errors(coro, op: str):
+    try:
+        await coro
+    except Exception as error:
+        print(f'Handling {op!r} failed: {error!r}')
@@ -0,0 +1,324 @@
+""" Snapshots of the live state of the bot, so that a restart resumes the games instead of wiping them: the games in
+progress, rematch offers, match confirmations and the matchmaking queue, with the players they involve.
+
+A snapshot is a binary file, written to a temporary file and renamed over the previous snapshot:
+
+    header          MAGIC, the time the snapshot was taken, then the number of players, games, rematches,
+                    confirmations and queue entries (u32 each)
+    players         user id, channel id, rating, wins, losses, ties, name length (u8), then the name in UTF-8
+    games           player1 id, player2 id, started, deadline of the move clock (-1 for none), number of moves, then
+                    the moves packed at 3 bits each as in app.MoveLog
+    rematches       player1 id, player2 id, ready flags (1 for player 1, 2 for player 2), deadline of the timeout (-1
+                    if it was not set yet)
+    confirmations   Same as rematches
+    queue           user id, rating the player joined with, time the player joined. In queue order
+
+Times are on the event loop clock of the bot that took the snapshot, and only their difference with the time of the
+snapshot is used: Timeouts keep the seconds they had left when the snapshot was taken, so the time the bot was down is
+not held against the players. Since a record holds no time relative to the snapshot, it stays the same until its entry
+changes, such as with a move, and is encoded again only then.
+
+The computer opponent is stored as user id 0. The board and the turn of a game follow from its moves. Players from
+other shards are left out, since their state belongs to their own shard.
+"""
+import asyncio
+import itertools
+import os
+import struct
+import time
+
+import discord
+
+from app.Player import Player, UserRef
+from app.EnginePlayer import EnginePlayer
+from app.MoveLog import pack_moves, unpack_moves
+from app.TimerWheel import TimerWheel
+
+DEFAULT_PATH = 'snapshot.bin'
+MAGIC = b'C4S2'
+# Seconds between snapshots. A crash loses at most the moves made since the last one
+SNAPSHOT_SECONDS = 10.0
+# Entries encoded, or games restored, between yields to the event loop
+CHUNK = 1000
+# Restored games whose board is sent afresh per second, after the restore. Each takes one message per player, and
+# Discord allows a bot about 50 requests per second
+RESTORED_RENDERS_PER_SECOND = 20
+
+HEADER = struct.Struct('<4sdIIIII')
+PLAYER = struct.Struct('<QQdIIIB')
+GAME = struct.Struct('<QQddB')
+PAIR = struct.Struct('<QQBd')
+ENTRY = struct.Struct('<Qdd')
+MAX_NAME_BYTES = 255
+NO_TIMER = -1.0
+
+
+class Snapshots:
+    """ Takes periodic snapshots of the state of the players list, matchmaking and game hub, and restores them
+
+    Taking a snapshot collects the state in one pass without I/O, encodes it a chunk of entries at a time, yielding to
+    the event loop in between, and writes the file on a worker thread. The encoded record of every player, game, offer
+    and queue entry is kept along with the version of the entry it was encoded from, such as the number of moves and
+    the deadline of the move clock of a game, so a snapshot only encodes the entries that changed since the previous
+    one and copies the others as they are.
+
+    Attributes:
+        path - Path of the snapshot file
+        interval - Seconds between snapshots
+        players_list - The PlayerRegistry
+        match_maker - The MatchMaker
+        game_hub - The GameHub
+        taken - Number of snapshots taken
+    """
+    def __init__(self, path: str, players_list, match_maker, game_hub, interval: float = SNAPSHOT_SECONDS):
+        self.path = path
+        self.interval = interval
+        self.players_list = players_list
+        self.match_maker = match_maker
+        self.game_hub = game_hub
+        self.taken = 0
+        self._records = dict()      # Player, GameInstance, MatchConfirmation or QueueEntry -> (version, record)
+        self._timers = None
+        self._writing = False
+
+
+    def start(self, timers: TimerWheel):
+        """ Starts taking a snapshot every interval seconds on the timer wheel """
+        self._timers = timers
+        timers.schedule(self.interval, self._snapshot_tick)
+
+
+    async def _snapshot_tick(self):
+        try:
+            await self.take()
+        finally:
+            self._timers.schedule(self.interval, self._snapshot_tick)
+
+
+    # ==========================
+    # Taking
+    # ==========================
+    def _collect(self):
+        """ Gathers references to the state to snapshot, skipping anything involving a player of another shard """
+        def local(*players):
+            return not any(p.is_remote for p in players)
+
+        games = [g for g in dict.fromkeys(self.game_hub.gamehub.values()) if local(g.player1, g.player2)]
+        rematches = [r for r in dict.fromkeys(self.game_hub.rematches.values()) if local(r.player1, r.player2)]
+        confirmations = [c for c in dict.fromkeys(self.match_maker.confirmations.values())
+                         if local(c.player1, c.player2)]
+        queue = [e for e in self.match_maker.queue.values() if local(e.player)]
+        return games, rematches, confirmations, queue
+
+
+    def _encode(self, now: float, parts: list):
+        """Appends the encoded snapshot to parts. A generator, yielding after every CHUNK entries so that the caller
+        can let the event loop run in between
+
+        :param now: Time of the snapshot, on the event loop clock (time.monotonic)
+        :param parts: List of bytes the snapshot is appended to
+        """
+        games, rematches, confirmations, queue = self._collect()
+        players = dict()
+        records = dict()
+        steps = itertools.count(1)
+
+        def record(entry, version, encode):
+            cached = self._records.get(entry)
+            if cached is None or cached[0] != version:
+                cached = (version, encode(entry))
+            records[entry] = cached
+            return cached[1]
+
+        def add(*members):
+            for player in members:
+                if not player.is_engine:
+                    players[player.user_id] = player
+
+        body = []
+        game_count = 0
+        for game in games:
+            if next(steps) % CHUNK == 0:
+                yield
+            # Ended while the snapshot was being taken
+            if game.status is not None:
+                continue
+            add(game.player1, game.player2)
+            body.append(record(game, (len(game.history), deadline_of(game.turn_timer)), encode_game))
+            game_count += 1
+
+        for pairs in (rematches, confirmations):
+            for pair in pairs:
+                if next(steps) % CHUNK == 0:
+                    yield
+                add(pair.player1, pair.player2)
+                body.append(record(pair, (pair.isP1Ready, pair.isP2Ready, deadline_of(pair.timer)), encode_pair))
+        for entry in queue:
+            if next(steps) % CHUNK == 0:
+                yield
+            add(entry.player)
+            body.append(record(entry, entry.joined, encode_entry))
+
+        parts.append(HEADER.pack(MAGIC, now, len(players), game_count, len(rematches), len(confirmations), len(queue)))
+        for player in players.values():
+            if next(steps) % CHUNK == 0:
+                yield
+            parts.append(record(player, (player.channel_id, player.name, player.rating, player.wins, player.losses,
+                                         player.ties), encode_player))
+        parts += body
+        self._records = records
+
+
+    async def take(self):
+        """ Takes a snapshot and writes it. Skipped while the previous snapshot is still being written """
+        if self._writing:
+            return
+        self._writing = True
+        try:
+            parts = []
+            for _ in self._encode(time.monotonic(), parts):
+                await asyncio.sleep(0)
+            await asyncio.get_event_loop().run_in_executor(None, self._write, b''.join(parts))
+            self.taken += 1
+        except Exception as error:
+            print(f'Failed to take a snapshot: {error!r}')
+        finally:
+            self._writing = False
+
+
+    def save(self):
+        """ Takes a snapshot and writes it, blocking. For shutting down, once the event loop has stopped """
+        parts = []
+        for _ in self._encode(time.monotonic(), parts):
+            pass
+        self._write(b''.join(parts))
+
+
+    def _write(self, data: bytes):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+
+    # ==========================
+    # Restoring
+    # ==========================
+    async def restore(self):
+        """ Resumes the state of the snapshot, if there is one. Must be called with the event loop running, before
+        any command is handled
+
+        :return: Tuple of the numbers of (games, rematches, confirmations, queue entries) restored
+        """
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(None, _read, self.path)
+        except FileNotFoundError:
+            return 0, 0, 0, 0
+        start = time.perf_counter()
+        magic, taken, player_count, game_count, rematch_count, confirmation_count, queue_count = \
+            HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a snapshot')
+        offset = HEADER.size
+
+        def seconds_left(deadline):
+            return None if deadline == NO_TIMER else max(0.0, deadline - taken)
+
+        players = dict()
+        for _ in range(player_count):
+            user_id, channel_id, rating, wins, losses, ties, length = PLAYER.unpack_from(data, offset)
+            offset += PLAYER.size
+            name = data[offset:offset + length].decode(errors='ignore')
+            offset += length
+            player = self.players_list.lookup(user_id)
+            if player is None:
+                player = Player(UserRef(user_id, name), discord.Object(channel_id))
+                self.players_list.add(player)
+            player.rating, player.wins, player.losses, player.ties = rating, wins, losses, ties
+            players[user_id] = player
+
+        def pair_of(user_id1, user_id2):
+            # The computer opponent plays in the channel of its human opponent
+            if user_id1 == 0:
+                return EnginePlayer(players[user_id2].channel), players[user_id2]
+            if user_id2 == 0:
+                return players[user_id1], EnginePlayer(players[user_id1].channel)
+            return players[user_id1], players[user_id2]
+
+        games = []
+        for i in range(game_count):
+            if i and i % CHUNK == 0:
+                await asyncio.sleep(0)
+            user_id1, user_id2, started, deadline, moves = GAME.unpack_from(data, offset)
+            offset += GAME.size
+            length = (3 * moves + 7) // 8
+            columns = unpack_moves(data[offset:offset + length], moves)
+            offset += length
+            game = self.game_hub.restore_game(*pair_of(user_id1, user_id2), columns, started, seconds_left(deadline))
+            games.append(game)
+
+        for restore, count in ((self.game_hub.restore_rematch, rematch_count),
+                               (self.match_maker.restore_confirmation, confirmation_count)):
+            for _ in range(count):
+                user_id1, user_id2, ready, deadline = PAIR.unpack_from(data, offset)
+                offset += PAIR.size
+                restore(*pair_of(user_id1, user_id2), bool(ready & 1), bool(ready & 2), seconds_left(deadline))
+
+        for _ in range(queue_count):
+            user_id, rating, joined = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            self.match_maker.restore_entry(players[user_id], rating, taken - joined)
+
+        print(f'Restored {game_count} games, {rematch_count} rematch offers, {confirmation_count} confirmations and '
+              f'{queue_count} queued players from {self.path} in {time.perf_counter() - start:.2f}s')
+        asyncio.ensure_future(self._resume(games))
+        return game_count, rematch_count, confirmation_count, queue_count
+
+
+    async def _resume(self, games):
+        """ Sends the boards of the restored games afresh, paced to stay within the rate limits of Discord, and lets
+        the computer opponent move where it is in turn. Games that moved or ended meanwhile have been sent already """
+        for game in games:
+            if game.turn.is_engine:
+                asyncio.ensure_future(self.game_hub.engine_turn(game))
+        moves = [(game, game.board.moves) for game in games]
+        for i, (game, restored_moves) in enumerate(moves):
+            if i and i % RESTORED_RENDERS_PER_SECOND == 0:
+                await asyncio.sleep(1.0)
+            if game.status is None and game.board.moves == restored_moves and \
+                    self.game_hub.gamehub.get(game.player1) is game:
+                game.schedule_render()
+
+
+# ==========================
+# Records
+# ==========================
+def deadline_of(timer):
+    return NO_TIMER if timer is None else timer.deadline
+
+
+def encode_player(player: Player):
+    name = player.name.encode()[:MAX_NAME_BYTES]
+    return PLAYER.pack(player.user_id, player.channel_id, player.rating, player.wins, player.losses, player.ties,
+                       len(name)) + name
+
+
+def encode_game(game):
+    return GAME.pack(game.player1.user_id, game.player2.user_id, game.started, deadline_of(game.turn_timer),
+                     len(game.history)) + pack_moves(game.history)
+
+
+def encode_pair(pair):
+    return PAIR.pack(pair.player1.user_id, pair.player2.user_id, int(pair.isP1Ready) | int(pair.isP2Ready) << 1,
+                     deadline_of(pair.timer))
+
+
+def encode_entry(entry):
+    return ENTRY.pack(entry.player.user_id, entry.key[0], entry.joined)
+
+
+def _read(path: str):
+    with open(path, 'rb') as file:
+        return file.read()
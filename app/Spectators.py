@@ -0,0 +1,208 @@
+""" Spectators of live games. Any channel can watch a game in progress with `() watch @player`, and gets one board
+message of its own, edited to the latest state of the game after every move until the game ends.
+
+The board is rendered once per move, see GameInstance.watch_embed, and the same embed goes to every watching
+channel. Updates are sent apart from the render task of the players, so watchers never hold up the moves of the
+players. A channel that falls behind skips the intermediate states and is sent only the latest one, the same way the
+render pipeline of the players coalesces moves.
+
+All watchers together are paced by one token bucket, so that they cannot spend the Discord rate limit the players'
+moves need. A single scheduler hands the tokens out round-robin between the games with watchers due an update, one
+watcher at a time, so a popular game with dozens of watching channels gets the same share as any other game.
+"""
+from collections import OrderedDict, deque
+import asyncio
+import time
+
+import app.Utilities as util
+from app.Throttle import TokenBuckets
+
+SPECTATE_TITLE = '👀 Spectating 👀'
+WATCH_STARTED = 'This channel is now watching **{}** VS **{}**. Type `() unwatch` to stop'
+WATCH_STOPPED = 'This channel stopped watching **{}** VS **{}**'
+NOT_WATCHING = 'This channel is not watching any game'
+NO_GAME = 'Mention a player in a game to watch it, as in `() watch @player`. **{}** is not in a game'
+BAD_MENTION = 'Mention a player in a game to watch it, as in `() watch @player`'
+OWN_GAME = 'This channel already shows the game of **{}** VS **{}**'
+GAME_FULL = 'The game of **{}** VS **{}** already has {} channels watching. Try again later!'
+
+# Channels that may watch one game at once
+MAX_WATCHERS = 50
+# Board updates per second sent to all watching channels together, and how many may go in a burst. Discord allows a
+# bot about 50 requests per second, which the players' moves need first
+WATCH_RATE = 10.0
+WATCH_BURST = 20
+# Failed updates in a row after which a channel stops watching, such as when the bot lost access to it
+MAX_FAILURES = 3
+
+
+class Watcher:
+    """ A channel watching a game
+
+    Attributes:
+        spectators - The Spectators the watcher belongs to
+        channel - The watching channel
+        game - The GameInstance watched
+        message - The board message in the channel. Sent with the first update and edited afterwards
+        pending - Whether the game changed since the last update sent
+        sending - Whether an update is in flight
+        failures - Failed updates in a row
+    """
+    __slots__ = ('spectators', 'channel', 'game', 'message', 'pending', 'sending', 'failures')
+
+    def __init__(self, spectators, channel, game):
+        self.spectators = spectators
+        self.channel = channel
+        self.game = game
+        self.message = None
+        self.pending = False
+        self.sending = False
+        self.failures = 0
+
+
+    def notify(self):
+        """ Marks the game as changed, and queues the watcher for an update unless one is already due. Never waits """
+        if not self.pending:
+            self.pending = True
+            if not self.sending:
+                self.spectators.queue(self)
+
+
+class Spectators:
+    """ The channels watching live games
+
+    Attributes:
+        game_hub - The GameHub of the games watched
+        watching - A Dictionary containing channel id -> Watcher. A channel watches one game at a time
+        budget - Token bucket pacing the updates of all watchers together
+        due - OrderedDict of GameInstance -> deque of its watchers due an update, in the round-robin order of the
+              games
+        updates - Number of board updates sent to watching channels
+    """
+    def __init__(self, game_hub, rate: float = WATCH_RATE, burst: int = WATCH_BURST):
+        self.game_hub = game_hub
+        self.watching = dict()
+        self.budget = TokenBuckets(rate, burst)
+        self.due = OrderedDict()
+        self.updates = 0
+        self._wakeup = None             # Set when a watcher is queued, for the scheduler waiting on an empty queue
+        self._scheduler = None
+
+
+    def queue(self, watcher: Watcher):
+        """ Queues a watcher for an update, behind the other watchers of its game """
+        watchers = self.due.get(watcher.game)
+        if watchers is None:
+            watchers = self.due[watcher.game] = deque()
+        watchers.append(watcher)
+        if self._scheduler is None or self._scheduler.done():
+            self._wakeup = asyncio.Event()
+            self._scheduler = asyncio.ensure_future(self._schedule())
+        self._wakeup.set()
+
+
+    def _next(self):
+        """ Takes the next watcher due an update, from the game first in turn, which then goes to the back of the
+        turn. None if no watcher is due """
+        while self.due:
+            game, watchers = self.due.popitem(last=False)
+            watcher = watchers.popleft()
+            if watchers:
+                self.due[game] = watchers
+            # Stopped watching since it was queued
+            if self.watching.get(watcher.channel.id) is watcher and watcher.pending:
+                return watcher
+        return None
+
+
+    async def _schedule(self):
+        """ The scheduler. Waits for a token of the budget, then starts the update of the next watcher due """
+        while True:
+            watcher = self._next()
+            if watcher is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            while not self.budget.take(None, time.monotonic()):
+                await asyncio.sleep(self.budget.interval)
+            if self.watching.get(watcher.channel.id) is watcher:
+                asyncio.ensure_future(self._update(watcher))
+
+
+    async def _update(self, watcher: Watcher):
+        """ Sends the latest state to a watcher. Queues it again if the game changed meanwhile, and stops watching once
+        the final board is out """
+        watcher.pending = False
+        watcher.sending = True
+        status = watcher.game.status
+        embed = watcher.game.watch_embed()
+        try:
+            if watcher.message is None:
+                watcher.message = await watcher.channel.send(embed=embed)
+            else:
+                await watcher.message.edit(embed=embed)
+        except Exception as error:
+            util.report_failure(watcher.channel, 'update the spectated board', error)
+            watcher.failures += 1
+            if watcher.failures >= MAX_FAILURES:
+                self.remove(watcher)
+            else:
+                watcher.pending = True
+        else:
+            watcher.failures = 0
+            self.updates += 1
+            if status is not None:
+                self.remove(watcher)
+        finally:
+            watcher.sending = False
+        if watcher.pending:
+            self.queue(watcher)
+
+
+    # Subscribes the player's channel to the game of the target player. Watching another game replaces the previous one
+    async def watch(self, player, target):
+        game = self.game_hub.gamehub.get(target) if target is not None else None
+        if game is None or game.status is not None:
+            text = NO_GAME.format(target.name) if target is not None else BAD_MENTION
+            await player.channel.send(embed=util.create_embed(SPECTATE_TITLE, text))
+            return
+        names = (game.player1.user.name, game.player2.user.name)
+        channel = player.channel
+        if channel.id in (game.player1.channel_id, game.player2.channel_id):
+            await channel.send(embed=util.create_embed(SPECTATE_TITLE, OWN_GAME.format(*names)))
+            return
+        current = self.watching.get(channel.id)
+        if current is not None and current.game is game:
+            return
+        if len(game.watchers) >= MAX_WATCHERS:
+            await channel.send(embed=util.create_embed(SPECTATE_TITLE, GAME_FULL.format(*names, MAX_WATCHERS)))
+            return
+        if current is not None:
+            self.remove(current)
+
+        watcher = Watcher(self, channel, game)
+        self.watching[channel.id] = watcher
+        game.watchers[channel.id] = watcher
+        await channel.send(embed=util.create_embed(SPECTATE_TITLE, WATCH_STARTED.format(*names)))
+        watcher.notify()
+
+
+    # Stops the player's channel from watching its game
+    async def unwatch(self, player):
+        channel = player.channel
+        watcher = self.watching.get(channel.id)
+        if watcher is None:
+            await channel.send(embed=util.create_embed(SPECTATE_TITLE, NOT_WATCHING))
+            return
+        self.remove(watcher)
+        await channel.send(embed=util.create_embed(
+            SPECTATE_TITLE, WATCH_STOPPED.format(watcher.game.player1.user.name, watcher.game.player2.user.name)))
+
+
+    def remove(self, watcher: Watcher):
+        """ Unsubscribes a watcher. An update in flight is let through, and no other follows """
+        if self.watching.get(watcher.channel.id) is watcher:
+            del self.watching[watcher.channel.id]
+        if watcher.game.watchers.get(watcher.channel.id) is watcher:
+            del watcher.game.watchers[watcher.channel.id]
+        watcher.pending = False
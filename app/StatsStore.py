@@ -0,0 +1,205 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+from app.TimerWheel import TimerWheel
+import app.Rating as rating
+
+DEFAULT_PATH = 'stats.db'
+
+# Seconds between flushes of the buffered stat changes, and the SQLite synchronous setting of the database.
+# Together they decide durability: A crash loses at most FLUSH_SECONDS of results, and with 'NORMAL' in WAL mode a
+# power loss may also roll back the last flushes. 'FULL' syncs every flush to disk, 'OFF' leaves it to the OS
+FLUSH_SECONDS = 5.0
+SYNCHRONOUS = 'NORMAL'
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Most stat totals kept in the read cache
+CACHE_LIMIT = 10000
+
+CREATE_TABLE = 'CREATE TABLE IF NOT EXISTS stats (' \
+               'user_id INTEGER PRIMARY KEY, ' \
+               'wins INTEGER NOT NULL DEFAULT 0, ' \
+               'losses INTEGER NOT NULL DEFAULT 0, ' \
+               'ties INTEGER NOT NULL DEFAULT 0, ' \
+               f'rating REAL NOT NULL DEFAULT {rating.INITIAL_RATING})'
+# Databases from before ratings were kept lack the rating column
+ADD_RATING = f'ALTER TABLE stats ADD COLUMN rating REAL NOT NULL DEFAULT {rating.INITIAL_RATING}'
+# Every column is written as a change, added to the stored value. A new player's rating starts at INITIAL_RATING
+UPSERT = 'INSERT INTO stats (user_id, wins, losses, ties, rating) VALUES (?, ?, ?, ?, ? + ?) ' \
+         'ON CONFLICT(user_id) DO UPDATE SET wins = wins + excluded.wins, losses = losses + excluded.losses, ' \
+         'ties = ties + excluded.ties, rating = excluded.rating - ? + rating'
+SELECT = 'SELECT wins, losses, ties, rating FROM stats WHERE user_id = ?'
+
+
+class StatsStore:
+    """ Persistent store of the players' wins, losses, ties and ratings, in a local SQLite database in WAL mode.
+
+    Writes are write-behind: record() only adds the change to an in-memory buffer, and the buffer is written in one
+    transaction every flush_seconds. Reads go through a cache of totals. The database is only ever touched by one
+    worker thread, which runs reads and writes in the order they were submitted, so nothing blocks the event loop.
+
+    Attributes:
+        path - Path of the database file
+        flush_seconds - Seconds between flushes of the buffer
+        synchronous - SQLite synchronous setting. One of SYNCHRONOUS_MODES
+        pending - Buffer of changes not yet submitted for writing. Dictionary of user id ->
+                  [wins, losses, ties, rating change]
+        cache_limit - Most totals kept in the cache. 0 to always read the database
+        cache - Totals of recently read players. OrderedDict of user id -> [wins, losses, ties, rating], in LRU
+                order
+    """
+    def __init__(self, path: str = DEFAULT_PATH, flush_seconds: float = FLUSH_SECONDS,
+                 synchronous: str = SYNCHRONOUS, cache_limit: int = CACHE_LIMIT):
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f'synchronous must be one of {SYNCHRONOUS_MODES}, not {synchronous!r}')
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.synchronous = synchronous
+        self.cache_limit = cache_limit
+        self.pending = dict()
+        self.cache = OrderedDict()
+        self._loads = dict()            # user id -> Task of a read in flight
+        self._recorded_in_load = dict()  # user id -> Changes recorded while a read is in flight
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stats-store')
+        self._conn = None
+        self._timers = None
+
+
+    # ==========================
+    # Event loop side
+    # ==========================
+    def start(self, timers: TimerWheel):
+        """ Starts flushing the buffer every flush_seconds on the timer wheel. Must be called with the loop running """
+        self._timers = timers
+        timers.schedule(self.flush_seconds, self._flush_tick)
+
+
+    async def _flush_tick(self):
+        await self.flush()
+        self._timers.schedule(self.flush_seconds, self._flush_tick)
+
+
+    def record(self, user_id: int, wins: int = 0, losses: int = 0, ties: int = 0, rating_change: float = 0.0):
+        """ Buffers a change of a player's stats. O(1), no I/O """
+        for totals in (self.pending.setdefault(user_id, [0, 0, 0, 0.0]), self.cache.get(user_id),
+                       self._recorded_in_load.get(user_id)):
+            if totals is not None:
+                totals[0] += wins
+                totals[1] += losses
+                totals[2] += ties
+                totals[3] += rating_change
+
+
+    def record_result(self, game, status: int):
+        """ Records the result of a game for both players, and rates the game if both are human. Meant to be a
+        result hook of GameHub, see GameInstance.announce_result. The computer opponent has no stats
+
+        :param game: The GameInstance that ended
+        :param status: Result of the game. 1, -1 or 0 representing P1 win, P2 win and tie
+        """
+        player1, player2 = game.player1, game.player2
+        change = 0.0
+        if not (player1.is_engine or player2.is_engine):
+            change = rating.rating_change(player1.rating, player2.rating, (status + 1) / 2)
+            player1.rating += change
+            player2.rating -= change
+        for player, score, player_change in ((player1, status, change), (player2, -status, -change)):
+            if not player.is_engine:
+                self.record(player.user_id, wins=int(score == 1), losses=int(score == -1), ties=int(score == 0),
+                            rating_change=player_change)
+
+
+    async def get(self, user_id: int):
+        """Returns the stats of a player, from the cache or read from the database
+
+        :param user_id: Discord user id of the player
+        :return: Tuple of (wins, losses, ties, rating), including the changes not flushed yet
+        """
+        totals = self.cache.get(user_id)
+        if totals is not None:
+            self.cache.move_to_end(user_id)
+            return tuple(totals)
+        load = self._loads.get(user_id)
+        if load is None:
+            load = self._loads[user_id] = asyncio.ensure_future(self._load(user_id))
+        return tuple(await asyncio.shield(load))
+
+
+    async def _load(self, user_id: int):
+        # Changes not yet submitted are missing from the database read, and so are changes recorded during the read.
+        # Everything submitted before is written first, since the worker thread runs in submission order
+        unsent = list(self.pending.get(user_id, (0, 0, 0, 0.0)))
+        self._recorded_in_load[user_id] = [0, 0, 0, 0.0]
+        try:
+            row = await asyncio.get_event_loop().run_in_executor(self._executor, self._read, user_id)
+        finally:
+            recorded = self._recorded_in_load.pop(user_id)
+            self._loads.pop(user_id, None)
+        totals = [stored + a + b for stored, a, b in zip(row, unsent, recorded)]
+        self.cache[user_id] = totals
+        if len(self.cache) > self.cache_limit:
+            self.cache.popitem(last=False)
+        return totals
+
+
+    async def flush(self):
+        """ Writes the buffered changes in one transaction on the worker thread. On failure, the changes are put back
+        into the buffer for the next flush """
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, dict()
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._write, batch)
+        except Exception as error:
+            print(f'Failed to flush {len(batch)} player stats: {error!r}')
+            for user_id, changes in batch.items():
+                totals = self.pending.setdefault(user_id, [0, 0, 0, 0.0])
+                for i, change in enumerate(changes):
+                    totals[i] += change
+
+
+    def close(self):
+        """ Writes what is left in the buffer and closes the database. Blocks, so only call it once the event loop
+        has stopped """
+        batch, self.pending = self.pending, dict()
+        if batch:
+            self._executor.submit(self._write, batch).result()
+        self._executor.submit(self._close).result()
+        self._executor.shutdown()
+
+
+    # ==========================
+    # Worker thread side
+    # ==========================
+    def _connection(self):
+        if self._conn is None:
+            # Imported on the worker thread on first use, off the startup of the bot
+            import sqlite3
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            self._conn.execute(CREATE_TABLE)
+            if 'rating' not in (column[1] for column in self._conn.execute('PRAGMA table_info(stats)')):
+                self._conn.execute(ADD_RATING)
+            self._conn.commit()
+        return self._conn
+
+
+    def _write(self, batch):
+        conn = self._connection()
+        with conn:
+            conn.executemany(UPSERT, [(user_id, *changes, rating.INITIAL_RATING, rating.INITIAL_RATING)
+                                      for user_id, changes in batch.items()])
+
+
+    def _read(self, user_id):
+        row = self._connection().execute(SELECT, (user_id,)).fetchone()
+        return row if row is not None else (0, 0, 0, rating.INITIAL_RATING)
+
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
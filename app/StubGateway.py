@@ -0,0 +1,233 @@
+""" Runs the sharded deployment on one machine without Discord. Starts the broker and the shard processes, then
+stands in for the Discord gateway: Scripted users in the guilds of different shards join the queue, confirm and play,
+while the shards report every message they send.
+
+Each shard runs the real bot of app.main, with a stub client that turns channel sends into reports to the gateway.
+Users are paired with a partner on the next shard, so every game has players from two shards.
+
+Run with `python -m app.StubGateway --shards 3 --pairs 6` from the repository root. It needs discord.py installed,
+but no token or network.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from app.Broker import Broker
+from app.Shard import ShardLink
+
+GATEWAY = 'gateway'
+# Seconds between the scripted events, leaving the shards time to forward them
+EVENT_GAP = 0.05
+READY_TIMEOUT = 30.0
+
+
+# ==========================
+# Shard process side
+# ==========================
+class StubMessage:
+    """ Stands in for a Discord message, sent by a user or by the bot """
+    def __init__(self, channel, author=None, content=None, embed=None):
+        self.id = id(self)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embed = embed
+
+
+    async def edit(self, embed=None, **kwargs):
+        self.embed = embed
+        self.channel.report('edit', embed)
+
+
+    async def delete(self):
+        pass
+
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class StubChannel:
+    """ Stands in for a Discord channel. Sends and edits are reported to the gateway """
+    def __init__(self, channel_id: int, link: ShardLink):
+        self.id = channel_id
+        self.link = link
+
+
+    def __eq__(self, other):
+        return isinstance(other, StubChannel) and other.id == self.id
+
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+    def report(self, op: str, embed):
+        self.link.send(GATEWAY, op, channel=self.id, text=embed.description if embed is not None else '')
+
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.report('sent', embed)
+        return StubMessage(self, embed=embed)
+
+
+class StubClient:
+    """ Stands in for the discord.Client. Every channel can be reached, like through the REST API """
+    def __init__(self, link: ShardLink):
+        self.link = link
+        self.user = None
+
+
+    def get_user(self, user_id):
+        return None
+
+
+    def get_channel(self, channel_id):
+        return StubChannel(channel_id, self.link)
+
+
+    get_partial_messageable = get_channel
+
+
+class StubUser:
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.mention = f'<@{user_id}>'
+
+
+def run_shard(shard_id: int, shard_count: int, socket_path: str, stats_db: str):
+    """ Entry point of a shard process """
+    os.environ.update(SHARD_COUNT=str(shard_count), SHARD_ID=str(shard_id), BROKER_SOCKET=socket_path,
+                      STATS_DB=stats_db, STATS_FLUSH_SECONDS='0.5',
+                      MOVE_LOG=os.path.join(os.path.dirname(stats_db), 'moves'))
+    import app.main as bot
+    from app.Player import Player
+    asyncio.run(_serve_shard(bot, Player))
+
+
+async def _serve_shard(bot, Player):
+    link = bot.link
+    client = StubClient(link)
+    Player.client = client
+    stopped = asyncio.Event()
+
+    def on_event(message):
+        msg = StubMessage(client.get_channel(message['channel']), StubUser(message['user'], message['name']),
+                          message['content'])
+        return bot.on_message(msg)
+
+    link.handlers['event'] = on_event
+    link.handlers['stop'] = lambda message: stopped.set()
+    await link.connect()
+    bot.stats_store.start(bot.timers)
+    bot.move_log.start(bot.timers)
+    link.send(GATEWAY, 'ready')
+    await stopped.wait()
+    await bot.stats_store.flush()
+    bot.move_log.close()
+    await link.close()
+
+
+# ==========================
+# Gateway side
+# ==========================
+class ScriptedUser:
+    def __init__(self, user_id: int, name: str, shard: int, channel: int, column: int):
+        self.id = user_id
+        self.name = name
+        self.shard = shard
+        self.channel = channel
+        self.column = column
+
+
+async def run(shard_count: int, pairs: int, socket_path: str):
+    stats_db = os.path.join(tempfile.mkdtemp(), 'stats.db')
+    broker = Broker(socket_path)
+    await broker.start()
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_shard, args=(shard, shard_count, socket_path, stats_db))
+                 for shard in range(shard_count)]
+    for process in processes:
+        process.start()
+
+    ready = set()
+    all_ready = asyncio.Event()
+    hosts = dict()      # Names of the players of a game -> id of the shard that announced its result
+    sent = [0] * shard_count
+    users = []
+    for i in range(pairs):
+        users.append((ScriptedUser(1000 + 2 * i, f'alice{i}', i % shard_count, 100 + 2 * i, 3),
+                      ScriptedUser(1001 + 2 * i, f'bob{i}', (i + 1) % shard_count, 101 + 2 * i, 4)))
+
+    def on_ready(message):
+        ready.add(message['from'])
+        if len(ready) == shard_count:
+            all_ready.set()
+
+    def on_sent(message):
+        sent[message['from']] += 1
+        if 'victorious' in message['text']:
+            for alice, bob in users:
+                if f'**{alice.name}**' in message['text'] and f'**{bob.name}**' in message['text']:
+                    hosts[(alice.name, bob.name)] = message['from']
+
+    link = ShardLink(GATEWAY, socket_path)
+    link.handlers.update({'ready': on_ready, 'sent': on_sent, 'edit': on_sent})
+    await link.connect()
+    try:
+        await asyncio.wait_for(all_ready.wait(), READY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise SystemExit(f'Only shards {sorted(ready)} of {shard_count} came up')
+
+    async def event(user: ScriptedUser, content: str):
+        link.send(user.shard, 'event', user=user.id, name=user.name, channel=user.channel, content=content)
+        await asyncio.sleep(EVENT_GAP)
+
+    start = time.perf_counter()
+    # Pairs join one after the other, so that each user is matched with their partner
+    for alice, bob in users:
+        await event(alice, '() play')
+        await event(bob, '() play')
+        await event(alice, '() yes')
+        await event(bob, '() yes')
+    # Each user keeps playing their own column. Moves out of turn are ignored, so one of them connects four
+    for _ in range(20):
+        if len(hosts) == pairs:
+            break
+        for alice, bob in users:
+            await event(alice, f'() {alice.column}')
+            await event(bob, f'() {bob.column}')
+    elapsed = time.perf_counter() - start
+
+    for (alice, bob), host in sorted(hosts.items()):
+        print(f'{alice} vs {bob}: finished on shard {host}')
+    print(f'{len(hosts)}/{pairs} games finished in {elapsed:.1f}s. Messages sent per shard: {sent}. '
+          f'Broker relayed {broker.relayed}, dropped {broker.dropped}')
+
+    for shard in range(shard_count):
+        link.send(shard, 'stop')
+    for process in processes:
+        await asyncio.get_event_loop().run_in_executor(None, process.join, 10)
+    await link.close()
+    await broker.close()
+    return len(hosts) == pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the sharded bot against a stub gateway')
+    parser.add_argument('--shards', type=int, default=2, help='Number of shard processes')
+    parser.add_argument('--pairs', type=int, default=2, help='Number of pairs of scripted users')
+    parser.add_argument('--socket', default=os.path.join(tempfile.gettempdir(), 'connect4-stub.sock'),
+                        help='Path of the Unix socket of the broker')
+    args = parser.parse_args()
+    if not asyncio.run(run(args.shards, args.pairs, args.socket)):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
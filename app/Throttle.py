@@ -0,0 +1,134 @@
+import time
+
+# Commands per second a user may sustain, and how many they may send in a burst
+USER_RATE = 1.0
+USER_BURST = 5
+# Commands per second a channel may sustain from all of its users together, and its burst
+CHANNEL_RATE = 5.0
+CHANNEL_BURST = 20
+# Number of buckets kept per key space before the idle ones are pruned
+MAX_BUCKETS = 100000
+
+# Results of Throttle.check
+ALLOW = 0
+ACK = 1
+DROP = 2
+
+
+class TokenBuckets:
+    """ Token buckets by key. Each bucket is kept as a single time, the time at which it is full again, which is
+    equivalent to counting tokens but needs no refill: Taking a token pushes that time 1 / rate seconds later, and
+    the bucket is empty once the time is more than burst / rate seconds away. A key without a bucket has a full one,
+    so the buckets that have refilled are dropped by prune() without changing anything
+
+    Attributes:
+        interval - Seconds for one token to refill. 1 / rate
+        limit - Seconds for an empty bucket to refill. burst / rate
+        max_buckets - Number of buckets kept before pruning
+        buckets - Dictionary of key -> time.monotonic() at which the bucket is full again
+    """
+    def __init__(self, rate: float, burst: int, max_buckets: int = MAX_BUCKETS):
+        self.interval = 1.0 / rate
+        self.limit = burst / rate
+        self.max_buckets = max_buckets
+        self.buckets = dict()
+
+
+    def take(self, key, now: float):
+        """Takes a token from the bucket of the key
+
+        :param key: Key of the bucket
+        :param now: Current time.monotonic()
+        :return: Whether a token was taken. False if the bucket is empty
+        """
+        full_at = self.buckets.get(key, now)
+        if full_at < now:
+            full_at = now
+        full_at += self.interval
+        if full_at - now > self.limit:
+            return False
+        if len(self.buckets) >= self.max_buckets and key not in self.buckets:
+            self.prune(now)
+        self.buckets[key] = full_at
+        return True
+
+
+    def give_back(self, key):
+        """ Returns the token last taken from the bucket of the key """
+        self.buckets[key] -= self.interval
+
+
+    def prune(self, now: float):
+        """ Drops the buckets that have refilled """
+        for key in [key for key, full_at in self.buckets.items() if full_at <= now]:
+            del self.buckets[key]
+
+
+class Throttle:
+    """ Rate limits the commands in front of their dispatch, with a token bucket per user and one per channel, so
+    that nobody can spend the bot's shared Discord rate limit by spamming commands or reactions. Over-limit requests
+    are dropped without any API call, except for one acknowledgement per user each time they get throttled.
+
+    Attributes:
+        users - Token buckets by user id
+        channels - Token buckets by channel id
+        allowed - Number of requests allowed
+        acked - Number of requests refused with an acknowledgement
+        dropped - Number of requests dropped silently
+        acked_users - Ids of the users acknowledged since they were last allowed
+    """
+    def __init__(self, user_rate: float = USER_RATE, user_burst: int = USER_BURST,
+                 channel_rate: float = CHANNEL_RATE, channel_burst: int = CHANNEL_BURST):
+        self.users = TokenBuckets(user_rate, user_burst)
+        self.channels = TokenBuckets(channel_rate, channel_burst)
+        self.allowed = 0
+        self.acked = 0
+        self.dropped = 0
+        self.acked_users = set()
+
+
+    def check(self, user_id: int, channel_id: int, ack: bool = True):
+        """Takes a token from the buckets of the user and of the channel
+
+        :param user_id: Id of the user making the request
+        :param channel_id: Id of the channel the request comes from
+        :param ack: Whether the user may be acknowledged when throttled. False for reactions
+        :return: ALLOW if the request goes through. Otherwise ACK for the first request refused since the user was
+                 last allowed, when the caller should tell the user once, and DROP after that
+        """
+        now = time.monotonic()
+        if self.users.take(user_id, now):
+            if self.channels.take(channel_id, now):
+                if self.acked_users:
+                    self.acked_users.discard(user_id)
+                self.allowed += 1
+                return ALLOW
+            # The channel is flooded. Give the token back, and never add messages to the channel
+            self.users.give_back(user_id)
+            self.dropped += 1
+            return DROP
+        if ack and user_id not in self.acked_users:
+            self.acked_users.add(user_id)
+            self.acked += 1
+            return ACK
+        self.dropped += 1
+        return DROP
+
+
+    def prune(self):
+        """ Drops the buckets that have refilled. Meant to run periodically """
+        now = time.monotonic()
+        self.users.prune(now)
+        self.channels.prune(now)
+        self.acked_users.intersection_update(self.users.buckets)
+
+
+    def stats(self):
+        """ Returns the counters of the throttle, and the number of buckets kept """
+        return {
+            'allowed': self.allowed,
+            'acked': self.acked,
+            'dropped': self.dropped,
+            'user_buckets': len(self.users.buckets),
+            'channel_buckets': len(self.channels.buckets)
+        }
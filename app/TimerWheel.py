@@ -0,0 +1,118 @@
+import asyncio
+import math
+
+# Length of a tick in seconds, and number of slots of the wheel. Timers fire on the first tick after they are due
+TICK = 1.0
+SLOTS = 64
+
+
+class Timer:
+    """ A timer scheduled on a TimerWheel. Returned by TimerWheel.schedule, and used to cancel the timer
+
+    Attributes:
+        callback - Function called with args once the timer fires. If it returns a coroutine, that is run as a task
+        args - Arguments of the callback
+        deadline - Event loop time at which the timer is due
+        slot - Index of the slot of the wheel holding the timer
+        rounds - Number of full turns of the wheel left before the timer fires
+    """
+    __slots__ = ('callback', 'args', 'deadline', 'slot', 'rounds')
+
+    def __init__(self, callback, args, deadline, slot, rounds):
+        self.callback = callback
+        self.args = args
+        self.deadline = deadline
+        self.slot = slot
+        self.rounds = rounds
+
+
+class TimerWheel:
+    """ A hashed timer wheel owning every timeout of the bot. Timers are hashed into slots by their due tick, so
+    scheduling and cancelling are O(1), and a single task ticks the wheel instead of one sleeping task per timeout.
+    The ticking task only runs while there are timers scheduled.
+
+    Attributes:
+        tick - Length of a tick in seconds
+        slots - The slots of the wheel. Each one is a dict used as an insertion-ordered set of Timer
+        cursor - Index of the slot of the current tick
+        count - Number of timers scheduled
+    """
+    def __init__(self, tick: float = TICK, slots: int = SLOTS):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.cursor = 0
+        self.count = 0
+        self._task = None
+        self._next_tick = None   # Event loop time of the next tick, while the ticking task runs
+
+
+    def schedule(self, delay: float, callback, *args):
+        """Schedules callback(*args) to be called after delay seconds. Must be called with the event loop running
+
+        :param delay (float): Seconds until the timer fires. Rounded up to whole ticks
+        :param callback: Function to call. If it returns a coroutine, the coroutine is run as a task
+        :return (Timer): The timer, for cancel()
+        """
+        now = asyncio.get_event_loop().time()
+        if self._task is None:
+            self._next_tick = now + self.tick
+            self._task = asyncio.ensure_future(self._run())
+        deadline = now + delay
+        # Number of ticks until the first tick at or after the deadline
+        ticks = 1 + max(0, math.ceil((deadline - self._next_tick) / self.tick))
+        slot = (self.cursor + ticks) % len(self.slots)
+        timer = Timer(callback, args, deadline, slot, (ticks - 1) // len(self.slots))
+        self.slots[slot][timer] = None
+        self.count += 1
+        return timer
+
+
+    def cancel(self, timer: Timer):
+        """Cancels a timer. Does nothing if the timer is None, has already fired or was already cancelled
+
+        :param timer (Timer): Timer returned by schedule()
+        """
+        if timer is not None and timer in self.slots[timer.slot]:
+            del self.slots[timer.slot][timer]
+            self.count -= 1
+
+
+    def remaining(self, timer: Timer):
+        """ Returns the seconds left until the timer is due, never negative """
+        return max(0.0, timer.deadline - asyncio.get_event_loop().time())
+
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self.count:
+                await asyncio.sleep(max(0.0, self._next_tick - loop.time()))
+                self._next_tick += self.tick
+                self._advance()
+        finally:
+            self._task = None
+
+
+    def _advance(self):
+        """ Moves the wheel by one tick and fires the timers of the new slot that are due in this round """
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        bucket = self.slots[self.cursor]
+        for timer in list(bucket):
+            if timer.rounds:
+                timer.rounds -= 1
+                continue
+            del bucket[timer]
+            self.count -= 1
+            try:
+                result = timer.callback(*timer.args)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(_report_errors(result))
+            except Exception as error:
+                print(f'Timer callback {timer.callback!r} failed: {error!r}')
+
+
+async def _report_errors(coro):
+    try:
+        await coro
+    except Exception as error:
+        print(f'Timer callback failed: {error!r}')
@@ -0,0 +1,416 @@
+""" Swiss tournaments for community events. An admin opens the registration, players join, and once the admin starts
+the tournament it plays ceil(log2(entrants)) rounds. Every round pairs the entrants by score, starts all of its games
+at once as a staggered batch in the GameHub, and collects the results through a result hook of the GameHub. The next
+round starts ROUND_BREAK_SECONDS after the last game of the round ended.
+
+A win scores 1 point, a tie half a point. With an odd number of entrants, the lowest ranked entrant without a bye yet
+sits the round out and scores 1 point. An entrant who is busy when their game should start, such as in another game,
+loses it. Standings are ranked by score, then by the sum of the scores of the opponents met (Buchholz), then rating.
+"""
+import asyncio
+import math
+
+from app.Player import Player
+import app.Utilities as util
+from app.TimerWheel import TimerWheel
+
+TOURNAMENT_TITLE = '🏆 Tournament 🏆'
+REGISTRATION_OPEN = 'A tournament is open for registration! Type `() tournament join` to take part'
+REGISTRATION_CLOSED = '**{}**, there is no tournament open for registration'
+ALREADY_OPEN = 'A tournament is already running'
+JOINED = '**{}**, you are registered for the tournament! {} players so far'
+ALREADY_JOINED = '**{}**, you are already registered for the tournament'
+LEFT = '**{}**, you left the tournament'
+TOO_FEW = 'A tournament needs at least {} players, {} registered so far'
+NO_TOURNAMENT = 'There is no tournament running'
+ROUND_START = 'Round **{}** of **{}** is starting: {} games. Type `() tournament standings` for the standings'
+ROUND_BYE = '**{}**, you sit out round **{}** of the tournament and score a point'
+ROUND_ABSENT = '**{}**, you were busy when your game of round **{}** started, and lost it'
+ROUND_END = 'Round **{}** of **{}** is over. The next round starts in {} seconds'
+TOURNAMENT_END = 'The tournament is over! Congratulations **{}** 🥇'
+TOURNAMENT_EMPTY = 'The tournament is over, with every player gone'
+CANCELLED = 'The tournament was cancelled'
+STANDINGS_LINE = '{}. **{}** {:g} points ({:g})'
+STANDINGS_OWN = '\n\nYou are **#{}** with {:g} points'
+
+# Players needed to start a tournament
+MIN_ENTRANTS = 2
+# Seconds between the end of a round and the start of the next
+ROUND_BREAK_SECONDS = 30
+# Entrants shown in the standings
+STANDINGS_SHOWN = 10
+
+# Colours of the entrants in a game. Player 1 plays RED and moves first
+RED = 1
+YELLOW = -1
+
+
+class Entrant:
+    """ A player taking part in the tournament
+
+    Attributes:
+        player - The Player. Looked up again in the players list at the start of each round, see Tournament.refresh
+        seed - Registration order, the last tie-break
+        score - Points scored so far
+        opponents - User ids of the opponents met so far
+        balance - Games played as RED minus games played as YELLOW
+        last_colour - Colour of the last game. None before the first
+        had_bye - Whether the entrant already sat out a round
+    """
+    __slots__ = ('player', 'seed', 'score', 'opponents', 'balance', 'last_colour', 'had_bye')
+
+    def __init__(self, player: Player, seed: int):
+        self.player = player
+        self.seed = seed
+        self.score = 0.0
+        self.opponents = []
+        self.balance = 0
+        self.last_colour = None
+        self.had_bye = False
+
+
+    @property
+    def user_id(self):
+        return self.player.user_id
+
+
+def order_of(entrant: Entrant):
+    """ Sort key of the pairing order: by score, then rating, then registration """
+    return -entrant.score, -entrant.player.rating, entrant.seed
+
+
+def colours(first: Entrant, second: Entrant):
+    """Gives RED to the entrant who played it less, or alternates the colour of the higher ranked one
+
+    :param first: The higher ranked entrant
+    :param second: The lower ranked entrant
+    :return: Tuple of the (RED, YELLOW) entrants
+    """
+    if first.balance != second.balance:
+        return (first, second) if first.balance < second.balance else (second, first)
+    return (second, first) if first.last_colour == RED else (first, second)
+
+
+def swiss_pairs(entrants):
+    """Pairs the entrants for a round. Down the standings, each unpaired entrant is paired with the highest ranked one
+    they have not met yet, so that entrants meet others of the same score. If everyone left has been met, the next
+    one is taken anyway rather than backtracking, which keeps pairing O(n^2) at worst and about O(n log n) in practice
+
+    :param entrants: The entrants
+    :return: Tuple of the (list of (RED, YELLOW) pairs, the entrant sitting out or None)
+    """
+    order = sorted(entrants, key=order_of)
+    bye = None
+    if len(order) % 2:
+        bye = next((e for e in reversed(order) if not e.had_bye), order[-1])
+        order.remove(bye)
+
+    pairs = []
+    # Index of the first unpaired entrant, and the flags of the paired ones
+    start, paired = 0, [False] * len(order)
+    while start < len(order):
+        first = order[start]
+        paired[start] = True
+        met = set(first.opponents)
+        candidate = None
+        for i in range(start + 1, len(order)):
+            if paired[i]:
+                continue
+            if candidate is None:
+                candidate = i
+            if order[i].user_id not in met:
+                candidate = i
+                break
+        paired[candidate] = True
+        pairs.append(colours(first, order[candidate]))
+        while start < len(order) and paired[start]:
+            start += 1
+    return pairs, bye
+
+
+class Tournament:
+    """ A Swiss tournament. There should be only one created, running one tournament at a time
+
+    Attributes:
+        game_hub - The GameHub running the games
+        players_list - The PlayerRegistry, to find the entrants again at the start of each round
+        timers - Timer wheel starting the next round after the break
+        load_stats - Coroutine function (player) reading the stats and rating of a player from the stats store
+        channel - Channel where the tournament was opened. Gets the announcements. None while no tournament runs
+        registering - Whether the registration is open
+        entrants - A Dictionary containing user id -> Entrant
+        rounds - Number of rounds of the tournament. 0 before it starts
+        round - Number of the round being played. 0 before the first
+        games - A Dictionary containing user id -> (RED, YELLOW) entrants, of the games of the round still going.
+                Both players of a game are keys
+        starting - Whether the games of the round are still being started
+    """
+    def __init__(self, game_hub, players_list, timers: TimerWheel, load_stats):
+        self.game_hub = game_hub
+        self.players_list = players_list
+        self.timers = timers
+        self.load_stats = load_stats
+        self.channel = None
+        self.registering = False
+        self.entrants = dict()
+        self.rounds = 0
+        self.round = 0
+        self.games = dict()
+        self.starting = False
+        self._break_timer = None
+
+
+    @property
+    def running(self):
+        return self.channel is not None
+
+
+    async def announce(self, text: str):
+        try:
+            await self.channel.send(embed=util.create_embed(TOURNAMENT_TITLE, text))
+        except Exception as error:
+            util.report_failure(self.channel, 'send', error)
+
+
+    # ==========================
+    # Registration
+    # ==========================
+    # Admin only. Opens the registration of a new tournament, announced in the admin's channel
+    async def open(self, player: Player):
+        if self.running:
+            await player.channel.send(embed=util.create_embed(TOURNAMENT_TITLE, ALREADY_OPEN))
+            return
+        self.channel = player.channel
+        self.registering = True
+        self.entrants = dict()
+        self.rounds = 0
+        self.round = 0
+        self.games = dict()
+        await self.announce(REGISTRATION_OPEN)
+
+
+    async def join(self, player: Player):
+        if not self.registering:
+            text = REGISTRATION_CLOSED.format(player.user.name)
+        elif player.user_id in self.entrants:
+            text = ALREADY_JOINED.format(player.user.name)
+        else:
+            # Seeding goes by rating, so it is loaded before registering
+            await self.load_stats(player)
+            self.entrants[player.user_id] = Entrant(player, len(self.entrants))
+            text = JOINED.format(player.user.name, len(self.entrants))
+        await player.channel.send(embed=util.create_embed(TOURNAMENT_TITLE, text))
+
+
+    # Leaving once the tournament started loses the game of the round, and forfeits the remaining rounds
+    async def leave(self, player: Player):
+        if self.entrants.pop(player.user_id, None) is None:
+            return
+        pair = self.games.get(player.user_id)
+        if pair is not None:
+            red, yellow = pair
+            game = self.game_hub.gamehub.get(player)
+            if game is not None and not game.rematch and game.player1.user_id == red.user_id and \
+                    game.player2.user_id == yellow.user_id:
+                # The result hook settles the pair
+                if await game.forfeit(player):
+                    await self.game_hub.end_game(game)
+            else:
+                # The game has not started yet, and start_games skips it
+                red.player.status = Player.IDLE
+                yellow.player.status = Player.IDLE
+                self.settle(pair, *((0, 1) if red.user_id == player.user_id else (1, 0)))
+        await player.channel.send(embed=util.create_embed(TOURNAMENT_TITLE, LEFT.format(player.user.name)))
+
+
+    # Admin only. Closes the registration and starts the first round
+    async def start(self, player: Player):
+        if not self.registering:
+            await player.channel.send(embed=util.create_embed(TOURNAMENT_TITLE, NO_TOURNAMENT))
+            return
+        if len(self.entrants) < MIN_ENTRANTS:
+            await player.channel.send(embed=util.create_embed(TOURNAMENT_TITLE,
+                                                              TOO_FEW.format(MIN_ENTRANTS, len(self.entrants))))
+            return
+        self.registering = False
+        self.rounds = math.ceil(math.log2(len(self.entrants)))
+        await self.start_round()
+
+
+    # Admin only. Stops the tournament. Games in progress are played out without counting
+    async def cancel(self, player: Player):
+        if not self.running:
+            await player.channel.send(embed=util.create_embed(TOURNAMENT_TITLE, NO_TOURNAMENT))
+            return
+        self.timers.cancel(self._break_timer)
+        self._break_timer = None
+        await self.announce(CANCELLED)
+        self.finish()
+
+
+    # Ends the tournament. Players held for a game of the round that has not started yet are released, since
+    # start_games skips their game from now on. A new games dictionary tells a round still being started that its
+    # tournament is over
+    def finish(self):
+        for pair in self.games.values():
+            for entrant in pair:
+                if entrant.player not in self.game_hub.gamehub:
+                    entrant.player.status = Player.IDLE
+        self.channel = None
+        self.registering = False
+        self.games = dict()
+        self.starting = False
+
+
+    # ==========================
+    # Rounds
+    # ==========================
+    async def refresh(self, entrant: Entrant):
+        """ Finds the entrant's player again, since the players list may have replaced or evicted it since, and
+        reloads their rating, which the pairing, the standings and the rating changes of their games go by """
+        player = self.players_list.lookup(entrant.user_id)
+        if player is None:
+            player = entrant.player
+            self.players_list.add(player)
+        entrant.player = player
+        try:
+            await self.load_stats(player)
+        except Exception as error:
+            print(f'Failed to load the stats of tournament entrant {entrant.user_id}: {error!r}')
+
+
+    @staticmethod
+    def present(entrant: Entrant):
+        """ Returns the entrant's player, or None if they are busy and cannot play now """
+        return entrant.player if entrant.player.status == Player.IDLE else None
+
+
+    # Pairs the entrants and starts the games of the round, a batch at a time. Absent players lose their game
+    async def start_round(self):
+        self._break_timer = None
+        self.round += 1
+        round_number = self.round
+        await asyncio.gather(*(self.refresh(entrant) for entrant in self.entrants.values()))
+        pairs, bye = swiss_pairs(self.entrants.values())
+
+        if bye is not None:
+            bye.score += 1
+            bye.had_bye = True
+            await self._tell(bye.player, ROUND_BYE.format(bye.player.user.name, round_number))
+
+        games = []
+        for red, yellow in pairs:
+            for entrant, colour in ((red, RED), (yellow, YELLOW)):
+                entrant.opponents.append((yellow if entrant is red else red).user_id)
+                entrant.balance += colour
+                entrant.last_colour = colour
+            player1, player2 = self.present(red), self.present(yellow)
+            if player1 is None or player2 is None:
+                for entrant, player, opponent in ((red, player1, player2), (yellow, player2, player1)):
+                    if player is None:
+                        await self._tell(entrant.player, ROUND_ABSENT.format(entrant.player.user.name, round_number))
+                    elif opponent is None:
+                        entrant.score += 1
+                continue
+            # Held for the tournament until their game starts, so that they cannot join anything else meanwhile
+            player1.status = Player.IN_GAME
+            player2.status = Player.IN_GAME
+            self.games[red.user_id] = self.games[yellow.user_id] = (red, yellow)
+            games.append((player1, player2))
+
+        await self.announce(ROUND_START.format(round_number, self.rounds, len(games)))
+        held = self.games
+        self.starting = True
+        try:
+            failed = await self.game_hub.start_games(
+                games, rematch=False, ready=lambda player1, player2: self.games is held and player1.user_id in held)
+        finally:
+            if self.games is held:
+                self.starting = False
+        # Cancelled while the games were being started. A new tournament may be running by now
+        if self.games is not held:
+            return
+        # Nobody is to blame for a game that failed to start, so it counts as a tie
+        for player1, player2 in failed:
+            pair = self.games.get(player1.user_id)
+            if pair is not None:
+                self.settle(pair, 0.5, 0.5)
+        # Every game of the round may have ended before the last ones started
+        if self.round == round_number:
+            await self.check_round()
+
+
+    async def _tell(self, player: Player, text: str):
+        try:
+            await player.channel.send(embed=util.create_embed(TOURNAMENT_TITLE, text))
+        except Exception as error:
+            util.report_failure(player.channel, 'send', error)
+
+
+    def record_result(self, game, status: int):
+        """ Scores a game of the round. Meant to be a result hook of GameHub, see GameInstance.announce_result """
+        pair = self.games.get(game.player1.user_id)
+        if pair is None or game.rematch or pair[0].user_id != game.player1.user_id or \
+                pair[1].user_id != game.player2.user_id:
+            return
+        self.settle(pair, *{1: (1, 0), -1: (0, 1)}.get(status, (0.5, 0.5)))
+
+
+    def settle(self, pair, red_points: float, yellow_points: float):
+        """ Scores a game of the round and removes it from the games still going. The round is checked once the
+        last one is settled """
+        red, yellow = pair
+        self.games.pop(red.user_id, None)
+        self.games.pop(yellow.user_id, None)
+        red.score += red_points
+        yellow.score += yellow_points
+        if not self.games and not self.starting and self.running:
+            self._break_timer = self.timers.schedule(0, self.check_round)
+
+
+    # Ends the round once all of its games have ended, then starts the next round after a break or ends the tournament
+    async def check_round(self):
+        if self.games or self.starting or not self.running:
+            return
+        self._break_timer = None
+        if self.round >= self.rounds or not self.entrants:
+            standings = self.standings()
+            text = TOURNAMENT_END.format(standings[0].player.user.name) if standings else TOURNAMENT_EMPTY
+            await self.announce(text + '\n\n' + self.standings_text())
+            self.finish()
+            return
+        await self.announce(ROUND_END.format(self.round, self.rounds, ROUND_BREAK_SECONDS) + '\n\n' +
+                            self.standings_text())
+        self._break_timer = self.timers.schedule(ROUND_BREAK_SECONDS, self.start_round)
+
+
+    # ==========================
+    # Standings
+    # ==========================
+    def standings(self):
+        """ Returns the entrants, best first """
+        scores = {e.user_id: e.score for e in self.entrants.values()}
+
+        def key(entrant):
+            buchholz = sum(scores.get(user_id, 0.0) for user_id in entrant.opponents)
+            return -entrant.score, -buchholz, -entrant.player.rating, entrant.seed
+        return sorted(self.entrants.values(), key=key)
+
+
+    def standings_text(self, user_id: int = None):
+        """ Returns the top of the standings as text, plus the rank of the given user """
+        standings = self.standings()
+        scores = {e.user_id: e.score for e in standings}
+        lines = [STANDINGS_LINE.format(rank, e.player.user.name, e.score,
+                                       sum(scores.get(o, 0.0) for o in e.opponents))
+                 for rank, e in enumerate(standings[:STANDINGS_SHOWN], 1)]
+        text = '\n'.join(lines)
+        for rank, entrant in enumerate(standings, 1):
+            if entrant.user_id == user_id:
+                text += STANDINGS_OWN.format(rank, entrant.score)
+        return text
+
+
+    async def show_standings(self, player: Player):
+        text = self.standings_text(player.user_id) if self.entrants and self.rounds else NO_TOURNAMENT
+        await player.channel.send(embed=util.create_embed(TOURNAMENT_TITLE, text))
@@ -0,0 +1,175 @@
+""" Runtime-switchable tracing of the hot paths. Records the time spent in the traced spans, and counts the Discord
+API calls made per command and per game, to tell whether a move spends its time on CPU or on Discord.
+
+Tracing is off by default. When off, a traced span costs one check of a module flag, and the Discord HTTP client is
+left untouched. When on, every request of the HTTP client is counted against the command that caused it, which is
+carried through the tasks it starts by a context variable, and against the game it was for.
+"""
+from collections import OrderedDict, deque
+import contextvars
+import functools
+import time
+
+# Durations kept per span for the percentiles, most recent first out
+SAMPLES = 2048
+# Games kept in the per game accounting
+MAX_GAMES = 1000
+# Command label of the API calls made outside of any command, such as from timers
+BACKGROUND = '(background)'
+MOVE_COMMANDS = frozenset(f'() {column}' for column in range(7))
+
+enabled = False
+spans = dict()              # Span name -> deque of durations in seconds
+commands = dict()           # Command -> [times run, API calls]
+games = OrderedDict()       # id of the GameInstance -> [label, commands, API calls], least recently active first
+
+_trace = contextvars.ContextVar('trace', default=None)
+_http = None                # The patched Discord HTTP client while tracing
+
+
+class Trace:
+    """ The command being handled, as seen by everything it runs and every task it starts
+
+    Attributes:
+        command - The command
+        game - id of the GameInstance the command was for, once known
+    """
+    __slots__ = ('command', 'game')
+
+    def __init__(self, command: str):
+        self.command = command
+        self.game = None
+
+
+def enable(http=None):
+    """Turns tracing on, clearing what was recorded before
+
+    :param http: The HTTP client of the Discord client, whose requests are counted. None to count nothing
+    """
+    global enabled, _http
+    spans.clear()
+    commands.clear()
+    games.clear()
+    if http is not None and _http is None:
+        original = http.request
+
+        @functools.wraps(original)
+        def request(*args, **kwargs):
+            count_api_call()
+            return original(*args, **kwargs)
+
+        http.request = request
+        _http = http
+    enabled = True
+
+
+def disable():
+    """ Turns tracing off and restores the HTTP client. What was recorded stays until tracing is enabled again """
+    global enabled, _http
+    enabled = False
+    if _http is not None:
+        del _http.request
+        _http = None
+
+
+def record_span(name: str, seconds: float):
+    samples = spans.get(name)
+    if samples is None:
+        samples = spans[name] = deque(maxlen=SAMPLES)
+    samples.append(seconds)
+
+
+def traced(name: str):
+    """ Decorates a coroutine function as a span """
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if not enabled:
+                return await function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                record_span(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def begin(command: str):
+    """Starts the trace of a command. Everything the command runs, and the tasks it starts, are attributed to it
+
+    :return: The token to give to end(), or None when tracing is off
+    """
+    if not enabled:
+        return None
+    stats = commands.get(command)
+    if stats is None:
+        stats = commands[command] = [0, 0]
+    stats[0] += 1
+    trace = Trace(command)
+    return _trace.set(trace), trace, time.perf_counter()
+
+
+def end(token):
+    """ Ends the trace of a command, recording its duration as the span 'command <command>' """
+    if token is None:
+        return
+    var_token, trace, start = token
+    record_span(f'command {trace.command}', time.perf_counter() - start)
+    _trace.reset(var_token)
+
+
+def tag_game(game):
+    """ Attributes the command being traced, and its API calls from now on, to a game """
+    if not enabled:
+        return
+    trace = _trace.get()
+    if trace is None or trace.game is not None:
+        return
+    trace.game = id(game)
+    stats = games.get(trace.game)
+    if stats is None:
+        stats = games[trace.game] = [f'{game.player1.name} vs {game.player2.name}', 0, 0]
+        if len(games) > MAX_GAMES:
+            games.popitem(last=False)
+    else:
+        games.move_to_end(trace.game)
+    stats[1] += 1
+
+
+def count_api_call():
+    trace = _trace.get()
+    command = trace.command if trace is not None else BACKGROUND
+    stats = commands.get(command)
+    if stats is None:
+        stats = commands[command] = [0, 0]
+    stats[1] += 1
+    if trace is not None and trace.game is not None:
+        game = games.get(trace.game)
+        if game is not None:
+            game[2] += 1
+
+
+def percentile(samples, fraction: float):
+    """ Returns the value below which the given fraction of the samples fall, by nearest rank """
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summary():
+    """ Returns the summary of what was recorded, as text for an embed """
+    lines = [f"Tracing is **{'on' if enabled else 'off'}**", '', '**Spans** (p50 / p99 ms, count)']
+    for name, samples in sorted(spans.items()):
+        lines.append(f'`{name}`: {percentile(samples, 0.5) * 1000:.2f} / {percentile(samples, 0.99) * 1000:.2f}, '
+                     f'{len(samples)}')
+    lines += ['', '**API calls** (per command, count)']
+    for command, (count, calls) in sorted(commands.items()):
+        lines.append(f'`{command}`: {calls / count if count else calls:.1f}, {count}')
+    moves = sum(commands[c][0] for c in MOVE_COMMANDS if c in commands)
+    move_calls = sum(commands[c][1] for c in MOVE_COMMANDS if c in commands)
+    lines.append(f'Calls per move: **{move_calls / moves if moves else 0.0:.2f}** over {moves} moves')
+    if games:
+        label, count, calls = max(games.values(), key=lambda stats: stats[2])
+        lines.append(f'Games: {len(games)}, {sum(g[2] for g in games.values()) / len(games):.1f} calls per game. '
+                     f'Most: {label} with {calls} calls over {count} commands')
+    return '\n'.join(lines)
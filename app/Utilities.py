@@ -1,5 +1,8 @@
+import asyncio
 import discord
 
+import app.Tracing as tracing
+
 
 def create_embed(title: str, desc: str, color=0xe74c3c):
     """Creates a discord embed instance to be sent to channels.
@@ -14,25 +17,82 @@ def create_embed(title: str, desc: str, color=0xe74c3c):
                          color=color)
 
 
-async def send_embed(channel1, channel2, embed, emojis=None):
-	"""Given two player's channel, send the embed to them. If both channels are same, then send only once
-	If a list of emojis are provided, the bot will also react to the sent message
-
-	:param channel1: Channel of player 1
-	:param channel2: Channel of player 2
-	:param embed: Embed to send to the channels
-	:param emojis: List of emojis for the bot to react on the sent embed
-	:return: Tuple of two messages that were sent to the two channels. If both channels are same, then returns
-						(message, None)
-	"""
-	msg = await channel1.send(embed=embed)
-	msg2 = None
-	if channel1 != channel2:
-			msg2 = await channel2.send(embed=embed)
-
-	if emojis is not None:
-			for e in emojis:
-					await msg.add_reaction(e)
-					if msg2 is not None:
-						await msg2.add_reaction(e)
-	return msg, msg2
+def report_failure(channel, action: str, error: Exception):
+    """Reports a Discord call that failed for one channel, without interrupting the other channels
+
+    :param channel: Channel the call was made for
+    :param action (str): What was being done, such as 'send' or 'react'
+    :param error (Exception): The error raised by the call
+    """
+    print(f"Failed to {action} in channel {getattr(channel, 'id', channel)}: {error!r}")
+
+
+async def _send_with_reactions(channel, embed, emojis, make_view):
+    """Sends the embed to one channel, then reacts to the sent message. Reactions are added one after another,
+    since Discord shows them in the order they were added. A failed reaction is reported and stops the rest,
+    but the message is still returned
+
+    :return: The sent message
+    """
+    if make_view is None:
+        msg = await channel.send(embed=embed)
+    else:
+        msg = await channel.send(embed=embed, view=make_view())
+    if emojis is not None:
+        for e in emojis:
+            try:
+                await msg.add_reaction(e)
+            except Exception as error:
+                report_failure(channel, 'react', error)
+                break
+    return msg
+
+
+@tracing.traced('Utilities.send_embed')
+async def send_embed(channel1, channel2, embed, emojis=None, make_view=None):
+    """Given two player's channel, send the embed to them. If both channels are same, then send only once
+    If a list of emojis are provided, the bot will also react to the sent message
+    If make_view is provided, each message is sent with its own view (message components) from make_view()
+
+    Both channels are served concurrently, each sending its message and then adding its reactions. A failure in one
+    channel is reported through report_failure and does not stop the other channel
+
+    :param channel1: Channel of player 1
+    :param channel2: Channel of player 2
+    :param embed: Embed to send to the channels
+    :param emojis: List of emojis for the bot to react on the sent embed
+    :param make_view: Function returning a new view to attach to each sent message
+    :return: Tuple of two messages that were sent to the two channels. If both channels are same, then returns
+             (message, None). The message of a channel where sending failed is None
+    """
+    channels = (channel1,) if channel1 == channel2 else (channel1, channel2)
+    results = await asyncio.gather(*(_send_with_reactions(c, embed, emojis, make_view) for c in channels),
+                                   return_exceptions=True)
+    msgs = [None, None]
+    for i, (channel, result) in enumerate(zip(channels, results)):
+        if isinstance(result, BaseException):
+            report_failure(channel, 'send', result)
+        else:
+            msgs[i] = result
+    return msgs[0], msgs[1]
+
+
+@tracing.traced('Utilities.edit_embed')
+async def edit_embed(msgs, embed, make_view=None):
+    """Replaces the embed of every given message, concurrently. A failed edit is reported through report_failure
+    and does not stop the others
+
+    :param msgs: List of messages to edit. None entries are skipped
+    :param embed: The new embed
+    :param make_view: If provided, each message also gets its view replaced by make_view(). A None view removes
+                      the message components
+    """
+    msgs = [m for m in msgs if m is not None]
+    if make_view is None:
+        edits = [m.edit(embed=embed) for m in msgs]
+    else:
+        edits = [m.edit(embed=embed, view=make_view()) for m in msgs]
+    results = await asyncio.gather(*edits, return_exceptions=True)
+    for msg, result in zip(msgs, results):
+        if isinstance(result, BaseException):
+            report_failure(msg.channel, 'edit', result)
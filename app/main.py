@@ -1,55 +1,238 @@
+import asyncio
 import os
+import re
+import time
+
+# Start of the bot, for the startup timings. Everything below is on the critical path of a restart
+BOOT = time.perf_counter()
+
 import discord
 import app.Utilities as util
 from app.MatchMaker import MatchMaker
 from app.GameHub import GameHub
 from app.Player import Player
+from app.TimerWheel import TimerWheel
+from app.PlayerRegistry import PlayerRegistry
+from app.StatsStore import StatsStore, CACHE_LIMIT as stats_cache_limit
+from app.MoveLog import MoveLog, DEFAULT_DIRECTORY as move_log_directory
+from app.Snapshot import Snapshots, DEFAULT_PATH as snapshot_path
+from app.Spectators import Spectators
+from app.Tournament import Tournament
+from app.EnginePlayer import ENGINE_NAME
+import app.Throttle as throttle
+import app.Tracing as tracing
+import app.OpeningBook as opening_book
+from app.Metrics import Metrics, MetricsServer, DEFAULT_PORT as metrics_port
 
 TOKEN = os.getenv('TOKEN')
 
-from app.keepAlive import keep_alive
-
 TITLE = '🔴 \t** Simple Connect Four **\t 🟡'
 HELP = '**A Simple Connect 4 Games with cross-channel, multiplayer support**\n' \
        '1. Type `() play` to join the matchmaking queue to be matched against an opponent!\n' \
        '2. Once you are matched with someone, type `() yes` for confirmation!\n' \
        '3. Once both parties had confirmed, the game of connect 4 will initiate!\n' \
-       '4. Use `() [0-6]` or click emoji to decide which column to place your tokens once it is your turn\n' \
+       '4. Use `() [0-6]` or click emoji/buttons to decide which column to place your tokens once it is your turn\n' \
+       '   You have 2 minutes for each move, or you forfeit the game!\n' \
        '5. Once the game ended, you may request for rematch via `() rematch`, or `() quit` to quit\n' \
        '\n\n' \
        '**Other Commands:**\n' \
+       '`() play bot` - Plays against the computer instead of waiting for an opponent\n' \
        '`() profile` - Shows your own profile\n' \
-       '`() leave` - Leaves the matchmaking queue\n'
+       '`() leave` - Leaves the matchmaking queue\n' \
+       '`() replay [id]` - Replays a finished game, by the id given when it ended\n' \
+       '`() watch @player` - Watches the game of a player live in this channel\n' \
+       '`() unwatch` - Stops watching\n' \
+       '`() tournament join` - Registers for the tournament open for registration\n' \
+       '`() tournament leave` - Leaves the tournament\n' \
+       '`() tournament standings` - Shows the standings of the tournament\n'
 help_embed = util.create_embed(TITLE, HELP)
+THROTTLED = '🐢 **{}**, slow down! Your commands are ignored for a few seconds'
+TRACING_TITLE = '🔬 Tracing 🔬'
+REPLAY_TITLE = '🎞️ Replay 🎞️'
+REPLAY = 'Game **#{}**: {} 🔴 VS {} 🟡, played <t:{}:f> for {} seconds.\nResult: **{}**\nMoves: {}\n\n{}'
+REPLAY_RESULTS = {1: 'RED wins', -1: 'YELLOW wins', 0: 'Tie'}
+REPLAY_NOT_FOUND = 'No game **#{}** was found. Game ids are given when a game ends'
+# A mention is either <@id>, or <@!id> when made through the nickname
+MENTION = re.compile(r'<@!?([0-9]+)>')
+# Ids of the move log. ASCII digits only, since str.isdigit() also takes digits that int() refuses, such as '²'
+GAME_ID = re.compile(r'[0-9]+')
+
+# Discord user ids allowed to use the admin commands, comma separated
+ADMIN_IDS = frozenset(int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip())
+
+# Memory-maps the opening book of the computer opponent, if one was generated
+opening_book.load(os.getenv('OPENING_BOOK', opening_book.DEFAULT_PATH))
+
+# discord.py 2.0 requires the intents to be given, and reading the commands needs the message content intent
+intents = discord.Intents.default()
+if hasattr(intents, 'message_content'):
+    intents.message_content = True
 
-my_bot = discord.Client()
+# ==========================
+# Sharding
+# ==========================
+# With SHARD_COUNT set, this process is shard SHARD_ID of a sharded deployment, linked to the other shards by the
+# broker listening at BROKER_SOCKET. See app.Shard
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+SHARD_ID = int(os.getenv('SHARD_ID', '0'))
+if SHARD_COUNT:
+    my_bot = discord.Client(intents=intents, shard_id=SHARD_ID, shard_count=SHARD_COUNT)
+else:
+    my_bot = discord.Client(intents=intents)
 
 # ==========================
 # Players List
 # ==========================
-# Note that if player list is not cleaned, it may bloat up in size when increasing usage
-players_list = dict()
+# Bounded by a budget of players, evicting idle players. Players resolve their user and channel through the client
+Player.client = my_bot
+players_list = PlayerRegistry()
+PLAYER_SWEEP_SECONDS = 10 * 60
+
+link = None
+if SHARD_COUNT:
+    import app.Broker as broker
+    from app.Shard import ShardLink, RemotePlayer
+    link = ShardLink(SHARD_ID, os.getenv('BROKER_SOCKET', broker.DEFAULT_SOCKET), players_list)
+    RemotePlayer.link = link
+
+# ==========================
+# Throttling
+# ==========================
+# Token buckets per user and per channel in front of the command dispatch
+command_throttle = throttle.Throttle()
+
+# ==========================
+# Timeouts
+# ==========================
+# One timer wheel runs every timeout: match confirmations, rematch offers and the move clock
+timers = TimerWheel()
+
+# ==========================
+# Player Stats
+# ==========================
+# Write-behind store of the wins, losses and ties. Results are buffered and flushed every STATS_FLUSH_SECONDS.
+# Shards share the database, and read it without a cache since games of their players are hosted anywhere
+stats_store = StatsStore(os.getenv('STATS_DB', 'stats.db'),
+                         flush_seconds=float(os.getenv('STATS_FLUSH_SECONDS', '5')),
+                         synchronous=os.getenv('STATS_SYNCHRONOUS', 'NORMAL'),
+                         cache_limit=0 if SHARD_COUNT else stats_cache_limit)
 
 # ==========================
 # Game's Matchmaking Lobby
 # ==========================
-match_maker = MatchMaker(my_bot.loop)
+match_maker = MatchMaker(timers)
 
 # ===========================
 # Game Instances
 # ===========================
-game_hub = GameHub(my_bot.loop)
+game_hub = GameHub(timers)
+game_hub.result_hooks.append(stats_store.record_result)
+
+# ===========================
+# Spectators
+# ===========================
+# Channels watching live games. Only games hosted by this shard can be watched
+spectators = Spectators(game_hub)
+
+# ===========================
+# Tournaments
+# ===========================
+# Swiss tournaments run by the admins. Only players of this shard can take part
+# Entrants' ratings are read through load_stats, defined with the commands below
+tournament = Tournament(game_hub, players_list, timers, lambda player: load_stats(player))
+game_hub.result_hooks.append(tournament.record_result)
+
+# ===========================
+# Move Log
+# ===========================
+# Every finished game is appended to the segmented log in MOVE_LOG, and can be replayed by its id
+move_log = MoveLog(os.getenv('MOVE_LOG', move_log_directory), shard_id=SHARD_ID, shard_count=SHARD_COUNT or 1)
+game_hub.result_hooks.append(move_log.record_result)
+
+# ===========================
+# Snapshots
+# ===========================
+# Games, rematch offers, confirmations and the queue are saved every SNAPSHOT_SECONDS to SNAPSHOT, and resumed from it
+# on restart. Each shard keeps its own snapshot
+snapshots = Snapshots(os.getenv('SNAPSHOT', snapshot_path) + (f'.{SHARD_ID}' if SHARD_COUNT else ''),
+                      players_list, match_maker, game_hub, interval=float(os.getenv('SNAPSHOT_SECONDS', '10')))
+
+
+# ===========================
+# Health and Metrics
+# ===========================
+# Served on the event loop at METRICS_PORT, plus the shard id when sharded, so that shards on one machine do not clash
+metrics = Metrics()
+metrics.gauge('connect4_queue_depth', 'Players waiting in the matchmaking queue', lambda: len(match_maker.queue))
+metrics.gauge('connect4_active_games', 'Games in progress', lambda: len(set(map(id, game_hub.gamehub.values()))))
+metrics.gauge('connect4_pending_confirmations', 'Matches waiting for confirmation',
+              lambda: len(set(map(id, match_maker.confirmations.values()))))
+metrics.gauge('connect4_pending_rematches', 'Rematch offers waiting for an answer',
+              lambda: len(set(map(id, game_hub.rematches.values()))))
+metrics.gauge('connect4_players', 'Players in the players list', lambda: len(players_list))
+metrics.gauge('connect4_watching_channels', 'Channels watching a game', lambda: len(spectators.watching))
+metrics.gauge('connect4_tournament_entrants', 'Players registered for the tournament',
+              lambda: len(tournament.entrants) if tournament.running else 0)
+metrics.gauge('connect4_timers', 'Timers scheduled on the timer wheel', lambda: timers.count)
+metrics.gauge('connect4_stats_pending', 'Players with stat changes not yet flushed', lambda: len(stats_store.pending))
+metrics.counter('connect4_player_evictions_total', 'Players evicted from the players list',
+                lambda: players_list.evictions)
+metrics.counter('connect4_games_logged_total', 'Games recorded in the move log of this shard',
+                lambda: move_log.games)
+metrics.counter('connect4_spectator_updates_total', 'Board updates sent to watching channels',
+                lambda: spectators.updates)
+metrics.counter('connect4_matches_total', 'Matches made by the matchmaking', lambda: match_maker.matches)
+metrics.counter('connect4_match_wait_seconds_total', 'Seconds waited in queue by matched players',
+                lambda: match_maker.total_wait)
+metrics.counter('connect4_throttle_allowed_total', 'Commands let through the throttle',
+                lambda: command_throttle.allowed)
+metrics.counter('connect4_throttle_acked_total', 'Throttled commands answered with a slow down message',
+                lambda: command_throttle.acked)
+metrics.counter('connect4_throttle_dropped_total', 'Throttled commands dropped', lambda: command_throttle.dropped)
+if link is not None:
+    metrics.counter('connect4_forwarded_commands_total', 'Commands forwarded to other shards',
+                    lambda: link.forwarded)
+metrics_server = MetricsServer(metrics, lambda: my_bot.is_ready() and not my_bot.is_closed(),
+                               port=int(os.getenv('METRICS_PORT', str(metrics_port))) + SHARD_ID)
 
 
 # ========================
 # Discord bot Logics
 # ========================
+# Periodically drops the players who have been idle for too long, and the throttle buckets that have refilled
+def sweep_players():
+    players_list.evict_idle()
+    command_throttle.prune()
+    timers.schedule(PLAYER_SWEEP_SECONDS, sweep_players)
+
+
+# Reads the player's stats and rating through the store's cache
+async def load_stats(player: Player):
+    player.wins, player.losses, player.ties, player.rating = await stats_store.get(player.user_id)
+
+
+# Players are matched by rating, so it is loaded before joining the queue
+async def join_queue(player: Player):
+    await load_stats(player)
+    await match_maker.request_to_join_queue(player)
+
+
 async def confirm(player: Player):
     ready_players = await match_maker.confirmation_by_player(player)
     if ready_players is None:
         return
 
-    await game_hub.init_game(*ready_players)
+    await start_game(*ready_players)
+
+
+# Starts a confirmed game. When sharded, the lobby hands it over to the shard hosting it
+async def start_game(player1: Player, player2: Player):
+    if link is not None:
+        host = link.host_of(player1, player2)
+        if host != link.shard_id:
+            link.hand_off(player1, player2, host)
+            return
+    await game_hub.init_game(player1, player2)
 
 
 async def make_move(player: Player, column: int):
@@ -57,6 +240,7 @@ async def make_move(player: Player, column: int):
 
 
 async def get_profile(player: Player):
+    await load_stats(player)
     await player.channel.send(embed=player.profile_embed())
 
 
@@ -64,14 +248,65 @@ async def help(player: Player):
     await player.channel.send(embed=help_embed)
 
 
+# Admin only. Turns tracing on or off, or shows what it recorded
+async def trace(player: Player, switch: bool = None):
+    if player.user_id not in ADMIN_IDS:
+        return
+    if switch is True:
+        tracing.enable(getattr(my_bot, 'http', None))
+    elif switch is False:
+        tracing.disable()
+    await player.channel.send(embed=util.create_embed(TRACING_TITLE, tracing.summary()))
+
+
+# Admin only. Runs a step of the tournament: opening the registration, starting it or cancelling it
+async def run_tournament(player: Player, step):
+    if player.user_id not in ADMIN_IDS:
+        return
+    await step(player)
+
+
+def player_label(user_id: int):
+    return ENGINE_NAME if user_id == 0 else f'<@{user_id}>'
+
+
+# Rebuilds a finished game from the move log and shows its final board
+async def replay(player: Player, game_id: str):
+    record = await move_log.read(int(game_id)) if GAME_ID.fullmatch(game_id) else None
+    if record is None:
+        await player.channel.send(embed=util.create_embed(REPLAY_TITLE, REPLAY_NOT_FOUND.format(game_id)))
+        return
+    result = REPLAY_RESULTS[record.status] + (' by forfeit' if record.forfeited else '')
+    text = REPLAY.format(record.game_id, player_label(record.player1), player_label(record.player2), record.started,
+                         record.duration, result, ' '.join(map(str, record.columns)) or '-', record.board())
+    await player.channel.send(embed=util.create_embed(REPLAY_TITLE, text))
+
+
+# Subscribes the player's channel to the game of the mentioned player
+async def watch(player: Player, mention: str):
+    match = MENTION.fullmatch(mention)
+    await spectators.watch(player, players_list.lookup(int(match.group(1))) if match is not None else None)
+
+
 bot_commands = {
-    '() play': match_maker.request_to_join_queue,
+    '() play': join_queue,
+    '() play bot': game_hub.play_bot,
     '() leave': match_maker.remove_from_queue,
     '() yes': confirm,
     '() profile': get_profile,
     '() rematch': game_hub.accept_rematch,
     '() quit': game_hub.reject_rematch,
     '() help': help,
+    '() unwatch': spectators.unwatch,
+    '() tournament open': lambda p: run_tournament(p, tournament.open),
+    '() tournament start': lambda p: run_tournament(p, tournament.start),
+    '() tournament cancel': lambda p: run_tournament(p, tournament.cancel),
+    '() tournament join': tournament.join,
+    '() tournament leave': tournament.leave,
+    '() tournament standings': tournament.show_standings,
+    '() trace': trace,
+    '() trace on': lambda p: trace(p, True),
+    '() trace off': lambda p: trace(p, False),
     '() 0': lambda p: make_move(p, 0),
     '() 1': lambda p: make_move(p, 1),
     '() 2': lambda p: make_move(p, 2),
@@ -81,59 +316,153 @@ bot_commands = {
     '() 6': lambda p: make_move(p, 6)
 }
 
-#####################################################################
-main_server = None
-admijw = None
-ethan = None
-uten = None
-admijw_mention = ''
-ethan_mention = ''
-uten_mention = ''
+# Commands followed by an argument, as in `() replay 42`. Handlers take the player and the argument
+argument_commands = {
+    '() replay': replay,
+    '() watch': watch
+}
 
 
-@my_bot.event
-async def on_ready():
-    global admijw, ethan, main_server
-    global admijw_mention, ethan_mention, uten_mention
+def parse_command(content: str):
+    """ Returns the (command, argument) of a message, with None as the argument of plain commands. (None, None) if
+    the message is not a command """
+    if content in bot_commands:
+        return content, None
+    command, _, argument = content.rpartition(' ')
+    if command in argument_commands:
+        return command, argument
+    return None, None
+
 
+# Runs a command forwarded by the shard of a remote player. A move made with a reaction only counts if it was on the
+# live board of the player's game
+async def run_forwarded_command(message):
+    player = link.remote_player(message)
+    board = message.get('message')
+    game = game_hub.board_messages.get(board) if board is not None else None
+    if board is None or game is not None and game_hub.gamehub.get(player) is game:
+        await bot_commands[message['command']](player)
+    link.release_if_idle(player)
+
+
+# Hosts a game handed over by the lobby
+async def take_over_game(message):
+    await game_hub.init_game(*link.take_over(message))
+
+
+if link is not None:
+    link.handlers['command'] = run_forwarded_command
+    link.handlers['start_game'] = take_over_game
+
+#####################################################################
+# Mentions are built from the user ids, so they need no member fetch and hold from the first message on.
+# A mention is either <@id>, or <@!id> when made through the nickname
+ADMIJW_ID = 184288368803184640
+ETHAN_ID = 667077271273865217
+UTEN_ID = 809046102996287528
+ADMIJW_MENTIONS = frozenset((f'<@{ADMIJW_ID}>', f'<@!{ADMIJW_ID}>'))
+ADMIJW_BUSY = f'AdmiJW is a veri busy purson. Pls find <@{ETHAN_ID}> or <@!{UTEN_ID}> instead 😉'
+
+# Seconds from the start of the bot within which it should serve commands. Startup steps still running by then go on
+# in the background, and commands are served without waiting for them
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', '5'))
+IMPORTED = time.perf_counter()
+
+startup = None      # Task of the startup steps that commands wait for
+
+
+# Restores the state of the last run and links up with the other shards. Commands wait for both, so that they see the
+# restored games and can be forwarded. Bounded by what is left of the startup budget
+async def start_up():
+    steps = [snapshots.restore()]
+    if link is not None:
+        steps.append(link.connect())
+    steps = asyncio.gather(*steps)
+    try:
+        await asyncio.wait_for(asyncio.shield(steps), max(0.0, STARTUP_BUDGET - (time.perf_counter() - BOOT)))
+    except asyncio.TimeoutError:
+        print(f'Startup is over its budget of {STARTUP_BUDGET}s. Serving commands while it finishes')
+    except Exception as error:
+        print(f'Startup failed: {error!r}. Serving commands without it')
+    snapshots.start(timers)
+    ready = time.perf_counter()
+    print(f'Serving commands {ready - BOOT:.2f}s after start: imports {IMPORTED - BOOT:.2f}s, '
+          f'gateway {ready - IMPORTED:.2f}s')
+
+
+async def serve_metrics():
+    try:
+        await metrics_server.start()
+    except OSError as error:
+        print(f'Failed to serve the metrics on port {metrics_server.port}: {error!r}')
+
+
+async def set_presence():
     await my_bot.change_presence(status=discord.Status.online,
                                  activity=discord.Activity(name='"() help" to get started',
                                                            type=discord.ActivityType.listening))
 
+
+@my_bot.event
+async def on_ready():
+    global startup
+
     print(f"AdmiBot logged in as {my_bot.user}")
 
-    main_server = discord.utils.get(my_bot.guilds, name='ZMK你要驾姐姐的车?')
-    admijw = await main_server.fetch_member(184288368803184640)
-    ethan = await main_server.fetch_member(667077271273865217)
-    uten = await main_server.fetch_member(809046102996287528)
+    # Off the critical path: Nothing waits for the presence nor the metrics server
+    asyncio.ensure_future(set_presence())
 
-    admijw_mention = admijw.mention[:2] + '!' + admijw.mention[2:]
-    ethan_mention = ethan.mention
-    uten_mention = uten.mention[:2] + '!' + uten.mention[2:]
+    # on_ready runs again after reconnecting. Only start up once
+    if startup is None:
+        timers.schedule(PLAYER_SWEEP_SECONDS, sweep_players)
+        stats_store.start(timers)
+        move_log.start(timers)
+        startup = asyncio.ensure_future(start_up())
+        asyncio.ensure_future(serve_metrics())
+        await startup
 
 
 @my_bot.event
 async def on_message(msg):
-    if admijw.mention == msg.content or admijw_mention == msg.content:
-        await msg.channel.send(
-            "AdmiJW is a veri busy purson. Pls find " + ethan_mention + " or " + uten_mention + " instead 😉")
+    if msg.content in ADMIJW_MENTIONS:
+        await msg.channel.send(ADMIJW_BUSY)
         return
 
     # Not a command or it is own bot message. Simply return
-    if msg.author == my_bot.user or msg.content not in bot_commands:
+    command, argument = parse_command(msg.content)
+    if msg.author == my_bot.user or command is None:
         return
 
-    user = msg.author
-    channel = msg.channel
+    if startup is not None and not startup.done():
+        await asyncio.shield(startup)
+
+    # Over the rate limit. Tell the user once, then drop their commands without any API call
+    verdict = command_throttle.check(msg.author.id, msg.channel.id)
+    if verdict != throttle.ALLOW:
+        if verdict == throttle.ACK:
+            await msg.channel.send(embed=util.create_embed(TITLE, THROTTLED.format(msg.author.name)))
+        return
 
-    # New user! Put into the player's list
-    if user.id not in players_list:
-        players_list[user.id] = Player(user, channel)
-    # In any way, update the channel
-    players_list[user.id].update_channel(channel)
+    # New user is put into the player's list. In any way, update the channel
+    player = players_list.get(msg.author, msg.channel)
+
+    # When sharded, the command may belong to the lobby or to the shard hosting the player's game
+    shard = link.target(player, command) if link is not None else None
+    if shard is not None:
+        link.forward(shard, player, command)
+        return
 
     # Execute the command
-    await bot_commands[msg.content](players_list[user.id])
+    start = time.perf_counter()
+    token = tracing.begin(command)
+    try:
+        if argument is None:
+            await bot_commands[command](player)
+        else:
+            await argument_commands[command](player, argument)
+    finally:
+        tracing.end(token)
+    metrics.observe_command(command, time.perf_counter() - start)
 
 
 EMOJI_MAP = {
@@ -147,14 +476,43 @@ EMOJI_MAP = {
 }
 
 
+# Raw reaction events arrive whether or not the message is cached. Only reactions of the players on the live board of
+# their game are moves: Anything else is dropped by one lookup in the index of board messages, without any API call.
+# When sharded, the board of a player hosted elsewhere is only indexed by the host, which checks it again
 @my_bot.event
-async def on_reaction_add(reaction, user):
-    if user.id not in players_list or reaction.emoji not in EMOJI_MAP:
+async def on_raw_reaction_add(payload):
+    column = EMOJI_MAP.get(str(payload.emoji))
+    if column is None:
+        return
+    if startup is not None and not startup.done():
+        await asyncio.shield(startup)
+    game = game_hub.board_messages.get(payload.message_id)
+    if game is None:
+        if link is None or payload.user_id not in link.routes:
+            return
+    elif payload.user_id != game.player1.user_id and payload.user_id != game.player2.user_id:
+        return
+    player = players_list.lookup(payload.user_id)
+    if player is None or command_throttle.check(payload.user_id, payload.channel_id, ack=False) != throttle.ALLOW:
         return
 
-    player = players_list[user.id]
-    await game_hub.action(player, EMOJI_MAP[reaction.emoji])
-
+    shard = link.target(player, f'() {column}') if link is not None else None
+    if shard is not None:
+        link.forward(shard, player, f'() {column}', payload.message_id)
+        return
 
-keep_alive()
-my_bot.run(TOKEN)
\ No newline at end of file
+    start = time.perf_counter()
+    token = tracing.begin(f'() {column}')
+    try:
+        await game_hub.action(player, column)
+    finally:
+        tracing.end(token)
+    metrics.observe_command(f'() {column}', time.perf_counter() - start)
+
+if __name__ == '__main__':
+    if SHARD_COUNT and not hasattr(my_bot, 'get_partial_messageable'):
+        raise SystemExit('Sharding needs discord.py 2.0 to reach the channels of other shards')
+    my_bot.run(TOKEN)
+    snapshots.save()
+    stats_store.close()
+    move_log.close()
\ No newline at end of file
@@ -0,0 +1,318 @@
+"""Offline benchmark and regression suite for the Board hot path.
+
+Replays deterministic sets of full games through a board engine (``app.Board.Board`` by default) and reports
+ns/op and peak bytes allocated per op for ``insert_token``, ``check_win`` and ``__str__``, the three calls that
+``GameInstance.action`` makes on every move. Every ``check_win`` result is also compared against an independent
+reference, so a faster engine that returns wrong results fails the run as well.
+
+Usage (from the repository root):
+    python -m benchmarks.board_bench                      Compare against benchmarks/baseline.json
+    python -m benchmarks.board_bench --update             Record a new baseline
+    python -m benchmarks.board_bench --engine pkg.mod:Cls Benchmark another engine with the same API
+
+Exits with status 1 when a result is wrong, or when an op is slower than the baseline by more than --tolerance.
+"""
+import argparse
+import gc
+import importlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+OPS = ('insert_token', 'check_win', '__str__')
+
+
+# ==========================
+# Reference rules
+# ==========================
+def _line_through(grid, row, col, token):
+    """Returns the direction name if the token at (row, col) is part of a line of 4, otherwise None.
+    Row 0 is the topmost row, the same as the grid of Board"""
+    for name, dr, dc in (('horizontal', 0, 1), ('vertical', 1, 0), ('diagonal', 1, 1), ('diagonal', 1, -1)):
+        count = 1
+        for sign in (1, -1):
+            r, c = row + dr * sign, col + dc * sign
+            while 0 <= r < 6 and 0 <= c < 7 and grid[r][c] == token:
+                count += 1
+                r, c = r + dr * sign, c + dc * sign
+        if count >= 4:
+            return name
+    return None
+
+
+def play_out(moves):
+    """Plays the columns in order (RED first) with the reference rules.
+
+    :param moves (List): Column of every move. Full columns are rejected like in Board, and are kept in the game
+    :return (Tuple): (List of expected (insert_token, check_win) results per move, Direction of the win or None)
+    """
+    grid = [[0] * 7 for _ in range(6)]
+    expected, token, filled = [], 1, 0
+    for col in moves:
+        row = next((r for r in range(5, -1, -1) if not grid[r][col]), None)
+        if row is None:
+            expected.append((False, None))
+            continue
+        grid[row][col] = token
+        filled += 1
+        direction = _line_through(grid, row, col, token)
+        if direction is not None:
+            expected.append((True, token))
+            return expected, direction
+        expected.append((True, 0 if filled == 42 else None))
+        token = -token
+    return expected, None
+
+
+# ==========================
+# Game sets
+# ==========================
+def _random_playout(rnd, allow_full):
+    """Plays uniformly random columns with the reference rules until the game ends
+
+    :param allow_full (bool): Whether to keep attempts on full columns in the game
+    :return (Tuple): (List of columns, Result of the game, Direction of the win or None)
+    """
+    grid = [[0] * 7 for _ in range(6)]
+    heights = [0] * 7
+    moves, token = [], 1
+    while True:
+        col = rnd.randrange(7)
+        if heights[col] == 6:
+            if allow_full:
+                moves.append(col)
+            continue
+        moves.append(col)
+        heights[col] += 1
+        row = 6 - heights[col]
+        grid[row][col] = token
+        direction = _line_through(grid, row, col, token)
+        if direction is not None:
+            return moves, token, direction
+        if sum(heights) == 42:
+            return moves, 0, None
+        token = -token
+
+
+def random_game(rnd):
+    """A game of uniformly random columns, including some attempts on full columns"""
+    return _random_playout(rnd, True)[0]
+
+
+def early_win_game(rnd):
+    """RED stacks one column (or builds a bottom row) while YELLOW plays elsewhere, so the game ends within 7 moves"""
+    moves = []
+    if rnd.random() < 0.5:
+        col = rnd.randrange(7)
+        others = [c for c in range(7) if c != col]
+        for _ in range(4):
+            moves += [col, rnd.choice(others)]
+    else:
+        start = rnd.randrange(4)
+        for col in range(start, start + 4):
+            moves += [col, col]
+    # The last YELLOW move would come after RED has already won
+    return moves[:-1]
+
+
+def _sample(rnd, count, predicate, limit=1000000):
+    """Samples random games until `count` of them satisfy predicate(result, direction)"""
+    games = []
+    for _ in range(limit):
+        if len(games) == count:
+            break
+        moves, result, direction = _random_playout(rnd, False)
+        if predicate(result, direction):
+            games.append(moves)
+    return games
+
+
+def build_game_sets(count, seed):
+    """Builds the deterministic game sets that are replayed through the engine
+
+    :param count (int): Number of games in each set
+    :param seed (int): Seed of the random generator
+    :return (Dict): Name of set -> List of games (Each a list of columns)
+    """
+    rnd = random.Random(seed)
+    return {
+        'random': [random_game(rnd) for _ in range(count)],
+        'early_win': [early_win_game(rnd) for _ in range(count)],
+        'full_board_tie': _sample(rnd, count, lambda result, _: result == 0),
+        'diagonal': _sample(rnd, count, lambda _, direction: direction == 'diagonal'),
+    }
+
+
+# ==========================
+# Measurement
+# ==========================
+def _timer_overhead(samples=20000):
+    clock = time.perf_counter_ns
+    best = None
+    for _ in range(samples):
+        start = clock()
+        elapsed = clock() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+
+def replay(engine, games, overhead):
+    """Replays the games once, timing every call individually
+
+    :return (Tuple): (Dict op -> [total ns, calls], Number of wrong results)
+    """
+    clock = time.perf_counter_ns
+    totals = {op: [0, 0] for op in OPS}
+    errors = 0
+    for moves in games:
+        expected, _ = play_out(moves)
+        board = engine()
+        token = 1
+        for col, (inserted, result) in zip(moves, expected):
+            start = clock()
+            ok = board.insert_token(token, col)
+            end = clock()
+            totals['insert_token'][0] += end - start - overhead
+            totals['insert_token'][1] += 1
+            if ok != inserted:
+                errors += 1
+            if not ok:
+                continue
+
+            start = clock()
+            status = board.check_win()
+            end = clock()
+            totals['check_win'][0] += end - start - overhead
+            totals['check_win'][1] += 1
+            if status != result:
+                errors += 1
+
+            start = clock()
+            str(board)
+            end = clock()
+            totals['__str__'][0] += end - start - overhead
+            totals['__str__'][1] += 1
+            token = -token
+    return totals, errors
+
+
+def peak_allocations(engine, games):
+    """Replays the games under tracemalloc and returns the mean peak of bytes allocated by a single call, per op"""
+    totals = {op: [0, 0] for op in OPS}
+    tracemalloc.start()
+    try:
+        for moves in games:
+            board = engine()
+            token = 1
+            for col in moves:
+                for op, call in (('insert_token', lambda: board.insert_token(token, col)),
+                                 ('check_win', board.check_win),
+                                 ('__str__', board.__str__)):
+                    tracemalloc.reset_peak()
+                    base = tracemalloc.get_traced_memory()[0]
+                    ret = call()
+                    totals[op][0] += tracemalloc.get_traced_memory()[1] - base
+                    totals[op][1] += 1
+                    if op == 'insert_token' and not ret:
+                        break
+                else:
+                    token = -token
+    finally:
+        tracemalloc.stop()
+    return {op: total / calls for op, (total, calls) in totals.items() if calls}
+
+
+def run(engine, game_sets, repeat):
+    """Benchmarks the engine on every game set
+
+    :return (Tuple): (Dict set -> op -> {'ns_per_op', 'bytes_per_op'}, Number of wrong results)
+    """
+    overhead = _timer_overhead()
+    results, errors = {}, 0
+    for name, games in game_sets.items():
+        best = {}
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                totals, wrong = replay(engine, games, overhead)
+                errors += wrong
+                for op, (total, calls) in totals.items():
+                    if calls:
+                        best[op] = min(best.get(op, float('inf')), max(total, 0) / calls)
+        finally:
+            gc.enable()
+        allocations = peak_allocations(engine, games)
+        results[name] = {op: {'ns_per_op': round(best[op], 1), 'bytes_per_op': round(allocations[op], 1)}
+                         for op in best}
+    return results, errors
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of (set, op, baseline ns, current ns) for every op slower than baseline * (1 + tolerance)"""
+    regressions = []
+    for name, ops in results.items():
+        for op, stats in ops.items():
+            reference = baseline.get(name, {}).get(op)
+            if reference and stats['ns_per_op'] > reference['ns_per_op'] * (1 + tolerance):
+                regressions.append((name, op, reference['ns_per_op'], stats['ns_per_op']))
+    return regressions
+
+
+def load_engine(spec):
+    module, _, attr = spec.partition(':')
+    return getattr(importlib.import_module(module), attr or 'Board')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark and regression suite for the Board hot path')
+    parser.add_argument('--engine', default='app.Board:Board', help='Engine to benchmark, as module:Class')
+    parser.add_argument('--games', type=int, default=500, help='Number of games in each game set')
+    parser.add_argument('--seed', type=int, default=2021)
+    parser.add_argument('--repeat', type=int, default=3, help='Replays per game set. The fastest one is kept')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown against the baseline before failing, as a fraction')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update', action='store_true', help='Write the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    engine = load_engine(args.engine)
+    game_sets = build_game_sets(args.games, args.seed)
+    results, errors = run(engine, game_sets, args.repeat)
+
+    print(f'Engine: {args.engine}')
+    print(f'{"game set":<16}{"op":<14}{"ns/op":>10}{"bytes/op":>10}')
+    for name, ops in results.items():
+        for op, stats in ops.items():
+            print(f'{name:<16}{op:<14}{stats["ns_per_op"]:>10.1f}{stats["bytes_per_op"]:>10.1f}')
+
+    if errors:
+        print(f'FAIL: {errors} results differ from the reference rules')
+        return 1
+
+    if args.update:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline found. Run with --update to record one')
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for name, op, before, after in regressions:
+        print(f'REGRESSION: {name} {op} {before:.1f} -> {after:.1f} ns/op')
+    if regressions:
+        return 1
+    print('OK: No regression against the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
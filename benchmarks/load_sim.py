@@ -0,0 +1,298 @@
+"""Offline load simulator of the bot.
+
+Drives a scripted population of users through the real command handling of ``app.main`` (throttle, players list,
+matchmaking, confirmations, games and rematches), with in-memory stand-ins for the Discord users, channels and
+messages. Every send, edit, delete and reaction is recorded and takes a simulated latency. Nothing touches the
+network.
+
+Each user arrives at --rate users per second, types ``() play``, confirms with ``() yes``, plays random legal moves
+after --think seconds, and answers the rematch offer with ``() rematch`` (with probability --rematch) or ``() quit``,
+until they have played --games games.
+
+Usage (from the repository root):
+    python -m benchmarks.load_sim --users 5000 --rate 250 --games 2 --latency 0.05
+
+Reports throughput, event loop lag, Discord API calls per game, and memory growth.
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Seconds between the samples of the event loop lag
+LAG_INTERVAL = 0.01
+# Seconds a user waits for a message before checking their state anyway
+IDLE_WAKEUP = 5.0
+
+_ids = itertools.count(10 ** 6)
+
+
+# ==========================
+# Discord stand-ins
+# ==========================
+class ApiCalls:
+    """ Counts of the simulated Discord API calls, by kind """
+    def __init__(self):
+        self.send = 0
+        self.edit = 0
+        self.delete = 0
+        self.react = 0
+
+
+    @property
+    def total(self):
+        return self.send + self.edit + self.delete + self.react
+
+
+class FakeUser:
+    def __init__(self, name: str):
+        self.id = next(_ids)
+        self.name = name
+        self.mention = f'<@{self.id}>'
+
+
+class FakeMessage:
+    def __init__(self, channel, author=None, content=None, embed=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embed = embed
+
+
+    async def edit(self, embed=None, **kwargs):
+        await self.channel.call('edit')
+        self.embed = embed
+        self.channel.deliver()
+
+
+    async def delete(self):
+        await self.channel.call('delete')
+
+
+    async def add_reaction(self, emoji):
+        await self.channel.call('react')
+
+
+class FakeChannel:
+    """ A text channel of one user. Wakes its user up on every message the bot sends or edits in it """
+    def __init__(self, sim):
+        self.id = next(_ids)
+        self.sim = sim
+        self.wake = asyncio.Event()
+
+
+    async def call(self, kind: str):
+        calls = self.sim.calls
+        setattr(calls, kind, getattr(calls, kind) + 1)
+        await asyncio.sleep(self.sim.latency * random.uniform(0.5, 1.5))
+
+
+    def deliver(self):
+        self.wake.set()
+
+
+    async def send(self, content=None, embed=None, **kwargs):
+        await self.call('send')
+        self.deliver()
+        return FakeMessage(self, content=content, embed=embed)
+
+
+class FakeClient:
+    """ Stands in for the discord.Client when resolving the users and channels of the players """
+    def __init__(self):
+        self.users = dict()
+        self.channels = dict()
+        self.user = None
+
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+    get_partial_messageable = get_channel
+
+
+# ==========================
+# Population
+# ==========================
+class Simulation:
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.latency = args.latency
+        self.think = args.think
+        self.games_per_user = args.games
+        self.rematch = args.rematch
+        self.calls = ApiCalls()
+        self.client = FakeClient()
+        self.commands = 0
+        self.moves = 0
+        self.games = 0
+        self.finished_users = 0
+        self.played = dict()    # User id -> games finished
+
+
+    async def command(self, user: FakeUser, channel: FakeChannel, content: str):
+        self.commands += 1
+        await self.bot.on_message(FakeMessage(channel, author=user, content=content))
+
+
+    async def run_user(self, name: str):
+        bot = self.bot
+        user = FakeUser(name)
+        channel = FakeChannel(self)
+        self.client.users[user.id] = user
+        self.client.channels[channel.id] = channel
+        answered = None     # The confirmation or rematch offer answered last
+
+        await self.command(user, channel, '() play')
+        while True:
+            try:
+                await asyncio.wait_for(channel.wake.wait(), IDLE_WAKEUP)
+            except asyncio.TimeoutError:
+                pass
+            channel.wake.clear()
+            player = bot.players_list.lookup(user.id)
+            if player is None:
+                break
+            played = self.played.get(user.id, 0)
+            confirmation = bot.match_maker.confirmations.get(user.id)
+            game = bot.game_hub.gamehub.get(player)
+            rematch = bot.game_hub.rematches.get(player)
+            if confirmation is not None and confirmation is not answered:
+                answered = confirmation
+                await self.command(user, channel, '() yes')
+            elif game is not None:
+                if game.turn is player and game.status is None:
+                    await asyncio.sleep(self.think * random.uniform(0.5, 1.5))
+                    columns = [c for c in range(7) if not game.board.is_column_full(c)]
+                    if game.turn is player and game.status is None and columns:
+                        self.moves += 1
+                        await self.command(user, channel, f'() {random.choice(columns)}')
+                    # The board message of the opponent's move may have come while thinking
+                    channel.wake.set()
+            elif rematch is not None:
+                if rematch is not answered:
+                    answered = rematch
+                    accept = played < self.games_per_user and random.random() < self.rematch
+                    await self.command(user, channel, '() rematch' if accept else '() quit')
+            elif played >= self.games_per_user:
+                break
+            elif player.status == player.IDLE:
+                await self.command(user, channel, '() play')
+        self.finished_users += 1
+
+
+    def record_game(self, game, status):
+        self.games += 1
+        for player in (game.player1, game.player2):
+            self.played[player.user_id] = self.played.get(player.user_id, 0) + 1
+
+
+async def measure_lag(samples, stop: asyncio.Event):
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(loop.time() - start - LAG_INTERVAL)
+
+
+def percentile(samples, fraction: float):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def simulate(args):
+    directory = tempfile.mkdtemp()
+    os.environ.setdefault('STATS_DB', os.path.join(directory, 'stats.db'))
+    os.environ.setdefault('MOVE_LOG', os.path.join(directory, 'moves'))
+    import app.main as bot
+    from app.Player import Player
+
+    sim = Simulation(bot, args)
+    Player.client = sim.client
+    bot.game_hub.result_hooks.append(sim.record_game)
+    bot.timers.schedule(bot.PLAYER_SWEEP_SECONDS, bot.sweep_players)
+    bot.stats_store.start(bot.timers)
+    bot.move_log.start(bot.timers)
+
+    stop = asyncio.Event()
+    lag = []
+    lag_task = asyncio.ensure_future(measure_lag(lag, stop))
+    gc.collect()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    traced_before = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+
+    start = time.perf_counter()
+    users = []
+    for i in range(args.users):
+        users.append(asyncio.ensure_future(sim.run_user(f'user{i}')))
+        await asyncio.sleep(1.0 / args.rate)
+    done, pending = await asyncio.wait(users, timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    for task in pending:
+        task.cancel()
+    for task in done:
+        if task.exception() is not None:
+            print(f'A user failed: {task.exception()!r}')
+    stop.set()
+    await lag_task
+    await bot.stats_store.flush()
+
+    gc.collect()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    calls = sim.calls
+    mm = bot.match_maker.stats()
+    print(f'Users: {args.users} arriving at {args.rate}/s, {sim.finished_users} finished, {len(pending)} timed out')
+    print(f'Elapsed: {elapsed:.1f}s')
+    print(f'Throughput: {sim.games / elapsed:.1f} games/s, {sim.moves / elapsed:.1f} moves/s, '
+          f'{sim.commands / elapsed:.1f} commands/s ({sim.games} games, {sim.moves} moves)')
+    print(f'Event loop lag: p50 {percentile(lag, 0.5) * 1000:.2f} ms, p99 {percentile(lag, 0.99) * 1000:.2f} ms, '
+          f'max {max(lag, default=0.0) * 1000:.2f} ms')
+    print(f'API calls: {calls.total} (send {calls.send}, edit {calls.edit}, delete {calls.delete}, '
+          f'react {calls.react}), {calls.total / sim.games if sim.games else 0.0:.1f} per game, '
+          f'{calls.total / sim.moves if sim.moves else 0.0:.2f} per move')
+    print(f"Matchmaking: {mm['matches']} matches, {mm['average_wait']:.2f}s average wait, "
+          f"{mm['average_quality']:.2f} average quality")
+    print(f'Throttle: {bot.command_throttle.stats()}')
+    print(f'Memory: max RSS grew by {(rss_after - rss_before) / 1024:.1f} MB to {rss_after / 1024:.1f} MB')
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f'Traced memory: {(current - traced_before) / 2 ** 20:.1f} MB retained, {peak / 2 ** 20:.1f} MB peak')
+    return len(pending) == 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline load simulator of the bot')
+    parser.add_argument('--users', type=int, default=1000, help='Number of simulated users')
+    parser.add_argument('--rate', type=float, default=100.0, help='Users arriving per second')
+    parser.add_argument('--games', type=int, default=2, help='Games each user plays before leaving')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean seconds of a simulated API call')
+    parser.add_argument('--think', type=float, default=1.5, help='Mean seconds a user thinks about a move')
+    parser.add_argument('--rematch', type=float, default=0.7, help='Probability of accepting a rematch')
+    parser.add_argument('--timeout', type=float, default=600.0, help='Seconds before giving up on the users')
+    parser.add_argument('--seed', type=int, default=2021)
+    parser.add_argument('--tracemalloc', action='store_true', help='Also trace allocations. Slows the run down')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    if args.tracemalloc:
+        tracemalloc.start()
+    return 0 if asyncio.run(simulate(args)) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
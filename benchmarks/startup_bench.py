@@ -0,0 +1,201 @@
+"""Startup benchmark of the bot: how long a restart takes until commands are served.
+
+Each run starts a fresh interpreter that imports ``app.main``, runs its ``on_ready`` with the gateway stood in for
+(no token, no network), and sends ``() help`` as the first command. Optionally, a snapshot of --games games in
+progress is written first, so that the run includes restoring them.
+
+Usage (from the repository root):
+    python -m benchmarks.startup_bench                    Five runs, no snapshot
+    python -m benchmarks.startup_bench --games 20000      Include the restore of 20000 games
+
+Reports the median of each phase: interpreter start, importing discord, importing the rest of the bot, on_ready until
+commands are served, and the first command. Exits with status 1 when the median time to the first command is over
+--budget seconds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ('interpreter', 'import discord', 'import bot', 'on_ready', 'first command', 'total')
+
+
+# ==========================
+# Child process side
+# ==========================
+class Channel:
+    """ Stands in for the channel of the first command. Sets answered once the bot replies """
+    id = 1
+
+    def __init__(self):
+        self.answered = asyncio.Event()
+
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.answered.set()
+
+
+class QuietChannel:
+    """ Stands in for the channels of the restored games """
+    async def send(self, content=None, embed=None, **kwargs):
+        return QuietMessage()
+
+
+class QuietMessage:
+    def __init__(self):
+        self.id = id(self)
+
+
+    async def edit(self, **kwargs):
+        pass
+
+
+    async def delete(self):
+        pass
+
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class Client:
+    def __init__(self, channel):
+        self.channel = channel
+        self.quiet = QuietChannel()
+        self.user = None
+
+
+    def get_user(self, user_id):
+        return None
+
+
+    def get_channel(self, channel_id):
+        return self.channel if channel_id == Channel.id else self.quiet
+
+
+class Message:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.author = Author()
+
+
+class Author:
+    id = 2
+    name = 'first'
+    mention = '<@2>'
+
+
+def child(spawned: float):
+    started = time.monotonic()
+    # Imported alone first, only to time it apart from the bot's own modules
+    import discord  # noqa: F401
+    discord_imported = time.monotonic()
+    import app.main as bot
+    bot_imported = time.monotonic()
+
+    async def run():
+        channel = Channel()
+        bot.Player.client = Client(channel)
+
+        async def change_presence(**kwargs):
+            pass
+
+        bot.my_bot.change_presence = change_presence
+        await bot.on_ready()
+        ready = time.monotonic()
+        await bot.on_message(Message(channel, '() help'))
+        await channel.answered.wait()
+        return ready, time.monotonic()
+
+    ready, answered = asyncio.run(run())
+    print(json.dumps({'interpreter': started - spawned, 'import discord': discord_imported - started,
+                      'import bot': bot_imported - discord_imported, 'on_ready': ready - bot_imported,
+                      'first command': answered - ready, 'total': answered - spawned}))
+
+
+# ==========================
+# Parent side
+# ==========================
+def write_snapshot(path: str, games: int, seed: int):
+    """ Writes a snapshot of games in progress between distinct players, with random moves """
+    from app.Snapshot import HEADER, PLAYER, GAME, MAGIC
+    from app.MoveLog import pack_moves
+    from app.Board import Board
+
+    rng = random.Random(seed)
+    players, body = [], []
+    for i in range(games):
+        user_id1, user_id2 = 10 ** 6 + 2 * i, 10 ** 6 + 2 * i + 1
+        for user_id in (user_id1, user_id2):
+            name = f'player{user_id}'.encode()
+            players.append(PLAYER.pack(user_id, user_id, 1500.0, 0, 0, 0, len(name)) + name)
+        board, columns, token = Board(), [], 1
+        for _ in range(rng.randrange(20)):
+            column = rng.choice([c for c in range(7) if not board.is_column_full(c)])
+            board.insert_token(token, column)
+            if board.check_win() is not None:
+                break
+            columns.append(column)
+            token = -token
+        # The last move won the game, so it is left out. The snapshot is taken at time 0, with a minute left to move
+        body.append(GAME.pack(user_id1, user_id2, time.time(), 60.0, len(columns)) + pack_moves(columns))
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, 0.0, len(players), games, 0, 0, 0))
+        file.write(b''.join(players))
+        file.write(b''.join(body))
+
+
+def run_once(directory: str, snapshot: str):
+    env = dict(os.environ, STATS_DB=os.path.join(directory, 'stats.db'), MOVE_LOG=os.path.join(directory, 'moves'),
+               SNAPSHOT=snapshot, METRICS_PORT='0')
+    spawned = time.monotonic()
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.startup_bench', '--child', repr(spawned)],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Startup benchmark of the bot')
+    parser.add_argument('--runs', type=int, default=5, help='Number of cold starts. The median is reported')
+    parser.add_argument('--games', type=int, default=0, help='Games in progress in the snapshot restored')
+    parser.add_argument('--budget', type=float, default=5.0, help='Seconds allowed until the first command')
+    parser.add_argument('--seed', type=int, default=2021)
+    parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child is not None:
+        child(args.child)
+        return 0
+
+    directory = tempfile.mkdtemp()
+    snapshot = os.path.join(directory, 'snapshot.bin')
+    runs = []
+    for _ in range(args.runs):
+        if args.games:
+            write_snapshot(snapshot, args.games, args.seed)
+        elif os.path.exists(snapshot):
+            os.unlink(snapshot)
+        runs.append(run_once(directory, snapshot))
+
+    print(f'Runs: {args.runs}, games restored: {args.games}')
+    print(f'{"phase":<16}{"median ms":>12}{"max ms":>10}')
+    for phase in PHASES:
+        samples = [run[phase] for run in runs]
+        print(f'{phase:<16}{statistics.median(samples) * 1000:>12.1f}{max(samples) * 1000:>10.1f}')
+
+    total = statistics.median(run['total'] for run in runs)
+    if total > args.budget:
+        print(f'FAIL: {total:.2f}s to the first command, over the budget of {args.budget}s')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())